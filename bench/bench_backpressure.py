@@ -0,0 +1,102 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure how much output is queued when the child writes faster than it
+is consumed, with an unbounded output queue and with a byte limit.
+
+The child is a thread that writes to an os.pipe() as fast as it can. The
+pipe is read like winspawn reads it: by a reader thread, as in
+_child_reader(), and by a reactor that pauses the pipe when the queue is
+full, as with winspawn(reactor=...). The consumer takes one chunk per
+millisecond.
+
+Usage: python bench/bench_backpressure.py [megabytes] [maxqueue-kilobytes]
+"""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from winpexpect_io import output_queue, reactor, select_transport
+
+
+def producer(fd, size):
+    block = 'x'.encode('ascii') * 4096
+    for i in range(size // 4096):
+        os.write(fd, block)
+    os.close(fd)
+
+
+def thread_reader(fd, queue):
+    """Like winspawn._child_reader()."""
+    while True:
+        queue.wait_writable()
+        data = os.read(fd, 4096)
+        if not data:
+            queue.put((fd, 'eof', data))
+            break
+        queue.put((fd, 'data', data))
+
+
+def run(mode, size, maxqueue):
+    queue = output_queue(maxqueue)
+    r, w = os.pipe()
+    pool = None
+    if mode == 'thread':
+        reader = threading.Thread(target=thread_reader, args=(r, queue))
+        reader.setDaemon(True)
+        reader.start()
+    else:
+        pool = reactor(transport=select_transport)
+        keys = []
+        def output(status, data):
+            return queue.put((r, status, data),
+                             lambda: pool.resume(keys[0]))
+        keys.append(pool.register(r, output))
+    writer = threading.Thread(target=producer, args=(w, size))
+    start = time.time()
+    writer.start()
+    nbytes = 0
+    while True:
+        item = queue.get()
+        if item[1] != 'data':
+            break
+        nbytes += len(item[2])
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    writer.join()
+    if pool is not None:
+        pool.close()
+    os.close(r)
+    assert nbytes == size
+    return elapsed, queue
+
+
+def main():
+    size = 8
+    maxqueue = 64
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        maxqueue = int(sys.argv[2])
+    print '%d MB of output, consumed at one chunk per ms' % size
+    print '%8s %10s %14s %8s %14s %10s' % ('reader', 'maxqueue',
+            'peak queue', 'stalls', 'stalled (s)', 'time (s)')
+    for mode in ('thread', 'reactor'):
+        for limit in (None, maxqueue << 10):
+            elapsed, queue = run(mode, size << 20, limit)
+            print '%8s %10s %11d KB %8d %14.2f %10.2f' % (mode,
+                    limit and '%d KB' % (limit >> 10) or 'none',
+                    queue.maxbytes >> 10, queue.stalls, queue.stalltime,
+                    elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure the latency of starting a child: through a new stub process per
+child, as winspawn does by default, and through one spawn broker.
+
+Both speak the control protocol of winpexpect_broker over the stdin and
+stdout of a Python process, which starts the child with subprocess instead
+of CreateProcess(), so this runs on any Unix-like system. The latency is
+the time from sending the request until the pid is read back. Like the
+stub of winspawn, the stub here imports the modules that winpexpect
+imports before it reads its request.
+
+Usage: python bench/bench_broker.py [spawns] [command]
+"""
+
+import os
+import sys
+import time
+import shlex
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from winpexpect_broker import broker, broker_client
+
+
+def create_process(request):
+    devnull = open(os.devnull, 'w')
+    try:
+        proc = subprocess.Popen(shlex.split(request['args']),
+                                stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+    return proc.pid
+
+
+def serve(count):
+    """The stub (count=1) or the broker: serve requests on stdin."""
+    import pexpect, winpexpect_io
+    def read(size):
+        return os.read(0, size).decode('ascii')
+    def write(s):
+        os.write(1, s.encode('ascii'))
+    server = broker(read, write, create_process)
+    if count == 1:
+        server.channel.send(server.handle(server.channel.receive()))
+    else:
+        server.serve()
+
+
+def start_helper(mode):
+    return subprocess.Popen([sys.executable, __file__, mode],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+def client(proc):
+    def read(size):
+        return os.read(proc.stdout.fileno(), size).decode('ascii')
+    def write(s):
+        os.write(proc.stdin.fileno(), s.encode('ascii'))
+    return broker_client(read, write)
+
+
+def spawn(client, command):
+    start = time.time()
+    reply = client.spawn(command.split()[0], command, 'in', 'out', 'err')
+    assert reply['status'] == 'ok'
+    return time.time() - start
+
+
+def run_stub(spawns, command):
+    latencies = []
+    for i in range(spawns):
+        start = time.time()
+        proc = start_helper('--stub')
+        spawn(client(proc), command)
+        latencies.append(time.time() - start)
+        proc.wait()
+        proc.stdin.close()
+        proc.stdout.close()
+    return latencies
+
+
+def run_broker(spawns, command):
+    start = time.time()
+    proc = start_helper('--broker')
+    conn = client(proc)
+    latencies = [spawn(conn, command)]
+    startup = time.time() - start
+    for i in range(spawns - 1):
+        latencies.append(spawn(conn, command))
+    conn.quit()
+    proc.wait()
+    proc.stdin.close()
+    proc.stdout.close()
+    return latencies, startup
+
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    mean = 1000.0 * sum(latencies) / len(latencies)
+    median = 1000.0 * latencies[len(latencies) // 2]
+    print '%8s %10.2f %12.2f ms %12.2f ms %10.1f' % (name, elapsed, mean,
+            median, len(latencies) / elapsed)
+
+
+def main():
+    spawns = 200
+    command = 'true'
+    if len(sys.argv) > 1:
+        spawns = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        command = sys.argv[2]
+    print '%d spawns of %r' % (spawns, command)
+    print '%8s %10s %15s %15s %10s' % ('mode', 'time (s)', 'mean latency',
+                                       'median', 'spawns/s')
+    start = time.time()
+    latencies = run_stub(spawns, command)
+    report('stub', latencies, time.time() - start)
+    start = time.time()
+    latencies, startup = run_broker(spawns, command)
+    report('broker', latencies, time.time() - start)
+    print 'starting the broker, with its first spawn: %.2f ms' % \
+            (1000.0 * startup)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--stub':
+        serve(1)
+    elif len(sys.argv) > 1 and sys.argv[1] == '--broker':
+        serve(None)
+    else:
+        main()
@@ -0,0 +1,119 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure expect() on output that arrives in many small chunks, when
+winspawn.read_nonblocking() returns one queued chunk per call and when it
+drains and coalesces everything that is queued.
+
+winspawn needs Windows, so this uses a spawn with the same output queue,
+ChunkBuffer and read_nonblocking() logic. The output of the child is queued
+up front, as when the child writes faster than expect() searches.
+
+Usage: python bench/bench_chunkbuffer.py [megabytes] [chunk-size]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from Queue import Queue, Empty
+from pexpect import spawn, EOF
+from winpexpect_io import ChunkBuffer
+
+
+class OneChunkBuffer(object):
+    """The ChunkBuffer from before: one chunk, sliced on every read."""
+
+    def __init__(self, chunk=''):
+        self.add(chunk)
+
+    def add(self, chunk):
+        self.chunk = chunk
+        self.offset = 0
+
+    def read(self, size):
+        data = self.chunk[self.offset:self.offset+size]
+        self.offset += size
+        return data
+
+    def __len__(self):
+        return max(0, len(self.chunk)-self.offset)
+
+
+class queuespawn(spawn):
+    """A spawn that reads from a queue of output like winspawn."""
+
+    def __init__(self, chunks, coalesce, **kwargs):
+        super(queuespawn, self).__init__(None, **kwargs)
+        self.child_output = Queue()
+        for chunk in chunks:
+            self.child_output.put((1, 'data', chunk))
+        self.child_output.put((1, 'eof', ''))
+        self.coalesce = coalesce
+        if coalesce:
+            self.chunk_buffer = ChunkBuffer()
+        else:
+            self.chunk_buffer = OneChunkBuffer()
+        self.pending_output = None
+        self.reads = 0
+        self.closed = False
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        self.reads += 1
+        buf = self.chunk_buffer
+        if len(buf):
+            if not self.coalesce:
+                return buf.read(size)
+        else:
+            item = self.pending_output
+            self.pending_output = None
+            if item is None:
+                try:
+                    item = self.child_output.get(False)
+                except Empty:
+                    raise EOF('End of output.')
+            if item[1] != 'data':
+                raise EOF('End of output.')
+            buf.add(item[2])
+        if self.coalesce and self.pending_output is None:
+            self.pending_output = buf.drain(self.child_output, size)
+        return buf.read(size)
+
+    def close(self):
+        self.closed = True
+
+
+def run(chunks, coalesce):
+    child = queuespawn(chunks, coalesce, maxread=65536, lowlatency=True)
+    start = time.time()
+    child.expect(['ERROR: .*\r\n', 'Password: ', EOF], timeout=None)
+    elapsed = time.time() - start
+    assert child.after is EOF
+    return elapsed, child.reads, len(child.before)
+
+
+def main():
+    size = 16
+    chunksize = 200
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        chunksize = int(sys.argv[2])
+    line = 'compiling module.c with optimizations enabled\r\n'
+    data = line * ((size << 20) // len(line))
+    chunks = [data[i:i+chunksize] for i in range(0, len(data), chunksize)]
+    print '%d MB in %d chunks of %d bytes' % (size, len(chunks), chunksize)
+    print '%12s %10s %10s %12s' % ('mode', 'reads', 'time (s)', 'before')
+    for name, coalesce in (('one chunk', False), ('coalesce', True)):
+        elapsed, reads, nbefore = run(chunks, coalesce)
+        print '%12s %10d %10.2f %12d' % (name, reads, elapsed, nbefore)
+
+
+if __name__ == '__main__':
+    main()
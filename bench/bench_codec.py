@@ -0,0 +1,120 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure encoding and decoding control messages with the header codec and
+the frame codec of winpexpect_broker, and reading one large message that
+arrives in small reads, as with a large environment.
+
+'concat' is how winspawn used to read a header: it appended every read to
+the header and searched all of it for the end again.
+
+Usage: python bench/bench_codec.py [messages] [env-kilobytes]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from winpexpect_broker import (header_reader, frame_reader, encode_frame,
+                               _format_header, _parse_header, _parse_env)
+
+
+def concat_reader(read):
+    """Reads headers like the old _read_header()."""
+    def next_header():
+        header = ''
+        while '\n\n' not in header:
+            header += read(4096)
+        return header
+    return next_header
+
+
+def chunked(data, size):
+    chunks = [data[i:i+size] for i in range(0, len(data), size)]
+    chunks.reverse()
+    def read(bufsize):
+        if not chunks:
+            return data[:0]
+        return chunks.pop()
+    return read
+
+
+def request(i, env):
+    return [('command', r'C:\Windows\system32\cmd.exe'),
+            ('args', 'cmd.exe /c echo %d' % i),
+            ('stdin', r'\\.\pipe\winpexpect-%06d' % i),
+            ('stdout', r'\\.\pipe\winpexpect-%06d' % (i + 1)),
+            ('stderr', r'\\.\pipe\winpexpect-%06d' % (i + 2)),
+            ('cwd', r'C:\Users\build'), ('env', env)]
+
+
+def run_headers(messages, env):
+    start = time.time()
+    data = ''.join([_format_header(request(i, env))
+                    for i in range(messages)])
+    encoded = time.time()
+    reader = header_reader(chunked(data, 4096))
+    for i in range(messages):
+        message = _parse_header(reader.next_header())
+        _parse_env(message['env'])
+    return encoded - start, time.time() - encoded, len(data)
+
+
+def run_frames(messages, env):
+    start = time.time()
+    data = ''.encode('ascii').join([encode_frame(request(i, env))
+                                    for i in range(messages)])
+    encoded = time.time()
+    reader = frame_reader(chunked(data, 4096))
+    for i in range(messages):
+        reader.next_frame()
+    return encoded - start, time.time() - encoded, len(data)
+
+
+def run_large(mode, size):
+    env = {'DATA': 'x' * size}
+    if mode == 'frame':
+        read = chunked(encode_frame([('env', env)]), 512)
+        start = time.time()
+        frame_reader(read).next_frame()
+    else:
+        read = chunked(_format_header([('env', env)]), 512)
+        start = time.time()
+        if mode == 'header':
+            header_reader(read).next_header()
+        else:
+            concat_reader(read)()
+    return time.time() - start
+
+
+def main():
+    messages = 20000
+    envsize = 1024
+    if len(sys.argv) > 1:
+        messages = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        envsize = int(sys.argv[2])
+    env = dict([('VAR%03d' % i, 'value %d' % i) for i in range(60)])
+    print '%d spawn requests with %d environment variables' % (messages,
+                                                               len(env))
+    print '%8s %12s %12s %12s %12s' % ('codec', 'encode (s)', 'decode (s)',
+                                       'messages/s', 'bytes')
+    for name, run in (('header', run_headers), ('frame', run_frames)):
+        encode, decode, nbytes = run(messages, env)
+        print '%8s %12.2f %12.2f %12.0f %12d' % (name, encode, decode,
+                messages / (encode + decode), nbytes)
+    print
+    print 'one request with a %d KB environment, read 512 bytes at a time' \
+            % envsize
+    for mode in ('concat', 'header', 'frame'):
+        print '%8s %10.3f s' % (mode, run_large(mode, envsize << 10))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Compare searcher_re with and without combinepatterns as the number of
+patterns grows. The patterns start with a literal character, so the merged
+regular expression can skip ahead over input that cannot start a match.
+
+Usage: python bench/bench_combined.py [megabytes]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import searcher_re
+
+
+LINE = 'gcc -O2 -Wall -c src/module%04d.c -o build/module%04d.o\r\n'
+
+def make_chunks(size, maxread=2000):
+    block = ''.join([LINE % (i, i) for i in range(1000)])
+    data = block * (size // len(block) + 1)
+    data = data[:size] + 'BUILD DONE in 42s\r\n'
+    return [data[i:i+maxread] for i in range(0, len(data), maxread)]
+
+
+def make_patterns(count):
+    patterns = [r'BUILD DONE in \d{1,5}s']
+    for i in range(count-1):
+        patterns.append(r"E%03d: [a-z]{1,20}\r\n" % i)
+    return [re.compile(p, re.DOTALL) for p in patterns]
+
+
+def run(patterns, chunks, combine):
+    searcher = searcher_re(patterns, combine=combine)
+    buffer = ''
+    start = time.time()
+    for chunk in chunks:
+        buffer = buffer[-256:] + chunk
+        if searcher.search(buffer, len(chunk)) >= 0:
+            break
+    else:
+        raise AssertionError('no match')
+    return time.time() - start
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    chunks = make_chunks(int(megabytes * 1024 * 1024))
+    print 'input: %.1f MB in %d chunks' % (megabytes, len(chunks))
+    print '%9s %13s %13s %8s' % ('patterns', 'separate (s)', 'combined (s)',
+                                 'speedup')
+    for count in (1, 5, 10, 20, 50, 100):
+        patterns = make_patterns(count)
+        t1 = run(patterns, chunks, False)
+        t2 = run(patterns, chunks, True)
+        print '%9d %13.3f %13.3f %8.2f' % (count, t1, t2, t1/t2)
+
+
+if __name__ == '__main__':
+    main()
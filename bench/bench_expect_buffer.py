@@ -0,0 +1,122 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure expect() throughput as the amount of output before the match
+grows, with the chunk list buffer and with the old string concatenation.
+
+The child is simulated by a spawn that reads from memory, so only the
+expect machinery is measured. Each size is run in text mode and in binary
+mode. CPython extends a string in place when nothing else refers to it, so
+the old loop stays linear for str; bytes on Python 3, and other
+interpreters, copy the whole buffer on every read. Run it after 2to3 to
+measure Python 3.
+
+Usage: python bench/bench_expect_buffer.py [max-megabytes]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import pexpect
+from pexpect import spawn, EOF, TIMEOUT
+
+
+LINE = 'gcc -O2 -Wall -c src/module%04d.c -o build/module%04d.o\r\n'
+
+class memspawn(spawn):
+    """A spawn that reads its output from a string."""
+
+    def __init__(self, data, **kwargs):
+        super(memspawn, self).__init__(None, **kwargs)
+        self.data = data
+        self.pos = 0
+        self.closed = False
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if self.pos >= len(self.data):
+            raise EOF('End of data.')
+        chunk = self.data[self.pos:self.pos+size]
+        self.pos += len(chunk)
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+
+class legacyspawn(memspawn):
+    """A memspawn with the expect_loop() that concatenates strings."""
+
+    def expect_loop(self, searcher, timeout=-1, searchwindowsize=-1,
+                    before_sink=-1):
+        self.searcher = searcher
+        if timeout == -1:
+            timeout = self.timeout
+        if timeout is not None:
+            end_time = time.time() + timeout
+        if searchwindowsize == -1:
+            searchwindowsize = self.searchwindowsize
+        incoming = self.buffer
+        freshlen = len(incoming)
+        while True:
+            index = searcher.search(incoming, freshlen, searchwindowsize)
+            if index >= 0:
+                self.buffer = incoming[searcher.end : ]
+                self.before = incoming[ : searcher.start]
+                self.after = incoming[searcher.start : searcher.end]
+                self.match = searcher.match
+                self.match_index = index
+                return self.match_index
+            c = self.read_nonblocking(self.maxread, timeout)
+            freshlen = len(c)
+            incoming = incoming + c
+            if timeout is not None:
+                timeout = end_time - time.time()
+
+
+def make_data(size):
+    block = ''.join([LINE % (i, i) for i in range(1000)])
+    data = block * (size // len(block) + 1)
+    return data[:size] + 'BUILD DONE\r\n' + 'after\r\n' * 1000
+
+
+def run(cls, data, maxread, binary):
+    if binary:
+        data = data.encode('ascii')
+        done, after = 'BUILD DONE'.encode('ascii'), 'after\r\n'.encode('ascii')
+    else:
+        done, after = 'BUILD DONE', 'after\r\n'
+    # Without the sleeps after reads, so that only the buffer is measured.
+    child = cls(data, maxread=maxread, lowlatency=True, binary=binary)
+    start = time.time()
+    child.expect(done)
+    # A few more expects with a large buffer left over.
+    for i in range(1000):
+        child.expect(after)
+    return time.time() - start
+
+
+def main():
+    maximum = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    print '%8s %8s %8s %12s %12s' % ('MB', 'maxread', 'mode', 'legacy (s)',
+                                     'buffer (s)')
+    size = 1
+    while size <= maximum:
+        data = make_data(size * 1024 * 1024)
+        for maxread in (2000, 65536):
+            for mode in ('text', 'binary'):
+                t1 = run(legacyspawn, data, maxread, mode == 'binary')
+                t2 = run(memspawn, data, maxread, mode == 'binary')
+                print '%8d %8d %8s %12.3f %12.3f' % (size, maxread, mode, t1,
+                                                     t2)
+        size *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure the round-trip time of a sendline()/expect() exchange, with the
+default delays and with lowlatency=True.
+
+The child is a thread on the other end of a socket pair that answers every
+line with a prompt, so the time is spent in spawn and not in the child.
+
+Usage: python bench/bench_latency.py [exchanges]
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import spawn
+
+
+class socketspawn(spawn):
+    """A spawn that talks to a thread over a socket pair."""
+
+    def __init__(self, **kwargs):
+        super(socketspawn, self).__init__(None, **kwargs)
+        self.sock, peer = socket.socketpair()
+        self.child_fd = self.sock.fileno()
+        self.closed = False
+        self.thread = threading.Thread(target=self.responder, args=(peer,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def responder(self, peer):
+        data = ''
+        while True:
+            chunk = peer.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+            while '\n' in data:
+                line, data = data.split('\n', 1)
+                peer.sendall('ok %s\r\n> ' % line)
+        peer.close()
+
+    def isalive(self):
+        return not self.closed
+
+    def close(self):
+        if not self.closed:
+            self.sock.close()
+            self.closed = True
+
+
+def run(exchanges, **kwargs):
+    child = socketspawn(**kwargs)
+    start = time.time()
+    for i in range(exchanges):
+        child.sendline('command %d' % i)
+        child.expect_exact('> ')
+    elapsed = time.time() - start
+    child.close()
+    return elapsed
+
+
+def main():
+    if len(sys.argv) > 1:
+        exchanges = int(sys.argv[1])
+    else:
+        exchanges = 200
+    print '%12s %10s %12s %14s' % ('mode', 'exchanges', 'total (s)',
+                                   'per exchange')
+    for name, kwargs in (('default', {}), ('lowlatency', {'lowlatency': True})):
+        elapsed = run(exchanges, **kwargs)
+        print '%12s %10d %12.3f %11.3f ms' % (name, exchanges, elapsed,
+                                             1000.0 * elapsed / exchanges)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Compare reading a child's output line by line with the old expect() based
+readline(), the new readline(), and iterlines().
+
+The child is simulated by a spawn that reads from memory, so only the line
+splitting is measured.
+
+Usage: python bench/bench_lines.py [lines]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import spawn, EOF
+
+
+LINE = 'gcc -O2 -Wall -c src/module%04d.c -o build/module%04d.o\r\n'
+
+class memspawn(spawn):
+    """A spawn that reads its output from a string."""
+
+    def __init__(self, data, **kwargs):
+        super(memspawn, self).__init__(None, **kwargs)
+        self.data = data
+        self.pos = 0
+        self.closed = False
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if self.pos >= len(self.data):
+            raise EOF('End of data.')
+        chunk = self.data[self.pos:self.pos+size]
+        self.pos += len(chunk)
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+
+class legacyspawn(memspawn):
+    """A memspawn with the readline() that uses expect()."""
+
+    def readline(self, size=-1):
+        index = self.expect(['\r\n', EOF])
+        if index == 0:
+            return self.before + '\r\n'
+        return self.before
+
+
+def legacy(data):
+    child = legacyspawn(data)
+    n = 0
+    while child.readline():
+        n += 1
+    return n
+
+def readline(data):
+    child = memspawn(data)
+    n = 0
+    for line in child:
+        n += 1
+    return n
+
+def iterlines(data):
+    n = 0
+    for line in memspawn(data).iterlines():
+        n += 1
+    return n
+
+def batched(data):
+    n = 0
+    for lines in memspawn(data).iterlines(batch=1000):
+        n += len(lines)
+    return n
+
+
+def main():
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 200000
+    data = ''.join([LINE % (i % 10000, i % 10000) for i in range(count)])
+    print '%20s %10s %10s %12s' % ('method', 'lines', 'time (s)', 'lines/s')
+    for name, func in (('readline (expect)', legacy), ('for line in child', readline),
+                       ('iterlines()', iterlines), ('iterlines(1000)', batched)):
+        start = time.time()
+        n = func(data)
+        elapsed = time.time() - start
+        assert n == count
+        print '%20s %10d %10.3f %12d' % (name, n, elapsed, n / elapsed)
+
+
+if __name__ == '__main__':
+    main()
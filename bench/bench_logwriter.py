@@ -0,0 +1,78 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure logging the output of a child: to a plain file, which spawn
+writes and flushes for every chunk, and to a log_writer, which writes in
+batches from a thread, with and without compression.
+
+The output is written as the chunks that read_nonblocking() returns, with
+a write() and a flush() per chunk, to three log files as with logfile,
+logfile_read and logfile_send all set. 'caller' is the time spent in those
+calls, which is what holds up expect(); 'total' also includes closing the
+logs, so everything is on disk. Flushes are cheap on a RAM disk and
+expensive on a slow or scanned disk; pass a directory to measure there.
+
+Usage: python bench/bench_logwriter.py [megabytes] [chunk-size] [directory]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import log_writer
+
+
+def run(make, size, chunk):
+    data = ''.join(['line %d of the output of the child\r\n' % i
+                    for i in range(chunk // 32 + 1)])[:chunk]
+    logs = [make(i) for i in range(3)]
+    start = time.time()
+    for i in range(size // chunk):
+        for log in logs:
+            log.write(data)
+            log.flush()
+    caller = time.time() - start
+    for log in logs:
+        log.close()
+    return caller, time.time() - start
+
+
+def main():
+    size = 64
+    chunk = 1024
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        chunk = int(sys.argv[2])
+    directory = None
+    if len(sys.argv) > 3:
+        directory = sys.argv[3]
+    tmpdir = tempfile.mkdtemp(dir=directory)
+    def path(name, i):
+        return os.path.join(tmpdir, '%s.%d.log' % (name, i))
+    runs = [('file', lambda i: open(path('file', i), 'w')),
+            ('log_writer', lambda i: log_writer(path('log_writer', i))),
+            ('gzip', lambda i: log_writer(path('gzip', i), compress=True))]
+    print '%d MB in chunks of %d bytes, to 3 logs each' % (size, chunk)
+    print '%12s %11s %10s %10s %14s' % ('log', 'caller (s)', 'total (s)',
+                                        'MB/s', 'bytes on disk')
+    try:
+        for name, make in runs:
+            caller, total = run(make, size << 20, chunk)
+            ondisk = os.path.getsize(path(name, 0))
+            print '%12s %11.2f %10.2f %10.1f %14d' % (name, caller, total,
+                    3 * size / total, ondisk)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
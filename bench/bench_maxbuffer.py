@@ -0,0 +1,93 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure the peak memory use of expect() on a stream that never matches,
+with and without a bound on the read buffer, and with a before_sink.
+
+Every configuration runs in a subprocess, so that the peak resident set
+size can be read with getrusage(). This needs the resource module, i.e. a
+Unix-like system.
+
+Usage: python bench/bench_maxbuffer.py [megabytes] [maxbuffer-megabytes]
+"""
+
+import os
+import sys
+import time
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import spawn, EOF, MAXBUFFER
+
+
+class streamspawn(spawn):
+    """A spawn that produces 'size' bytes of output that never match."""
+
+    def __init__(self, size, **kwargs):
+        super(streamspawn, self).__init__(None, **kwargs)
+        self.remaining = size
+        self.block = 'all work and no play makes jack a dull boy\r\n' * 2000
+        self.count = 0
+        self.closed = False
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if self.remaining <= 0:
+            raise EOF('End of stream.')
+        # Slice at an offset, so that every chunk is a new string.
+        self.count += 1
+        offset = 1 + self.count % 8
+        chunk = self.block[offset:offset+min(size, self.remaining)]
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+
+def child(size, maxbuffer, policy):
+    s = streamspawn(size, maxread=65536)
+    sunk = []
+    if policy == 'sink':
+        s.before_sink = lambda data: sunk.append(len(data))
+    elif policy != 'none':
+        s.maxbuffer = maxbuffer
+        s.maxbufferpolicy = policy
+    start = time.time()
+    try:
+        s.expect_exact(['Password:', EOF], timeout=None)
+        result = 'EOF, before=%d' % len(s.before)
+    except MAXBUFFER:
+        result = 'MAXBUFFER, buffer=%d' % len(s.buffer)
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    print '%10s %10.2f %10d   %s' % (policy, elapsed, rss // 1024, result)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4])
+        return
+    size = 1024
+    maxbuffer = 16
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        maxbuffer = int(sys.argv[2])
+    print '%d MB of output, maxbuffer %d MB' % (size, maxbuffer)
+    print '%10s %10s %10s   %s' % ('policy', 'time (s)', 'peak (MB)', 'result')
+    sys.stdout.flush()
+    for policy in ('none', 'raise', 'window', 'headtail', 'sink'):
+        subprocess.call([sys.executable, __file__, '--child', str(size << 20),
+                         str(maxbuffer << 20), policy])
+
+
+if __name__ == '__main__':
+    main()
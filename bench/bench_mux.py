@@ -0,0 +1,137 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure the throughput of the output of a child: read from a pipe per
+stream, as winspawn does by default, and multiplexed over one channel, as
+with winspawn(multiplex=True), for a few packet sizes.
+
+The child is two threads that write to os.pipe()s as fast as they can, one
+for stdout and one for stderr. With 'pipes' each pipe is read by a thread
+of its own, as in winspawn._child_reader(). With 'mux' the relay of
+winpexpect_mux reads them, as the stub does on Windows, and sends them over
+a socketpair to one reader. Both put what they read on an output queue.
+
+Usage: python bench/bench_mux.py [megabytes]
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from winpexpect_io import output_queue
+from winpexpect_mux import mux_channel, relay, STDOUT, STDERR
+
+
+def producer(fd, size):
+    block = 'x'.encode('ascii') * 4096
+    for i in range(size // 4096):
+        os.write(fd, block)
+    os.close(fd)
+
+
+def start_child(size):
+    """Start the writers; return the read ends of stdout and stderr."""
+    fds = {}
+    for stream in (STDOUT, STDERR):
+        r, w = os.pipe()
+        writer = threading.Thread(target=producer, args=(w, size // 2))
+        writer.setDaemon(True)
+        writer.start()
+        fds[stream] = r
+    return fds
+
+
+def consume(queue):
+    nbytes = 0
+    items = 0
+    ended = 0
+    while ended < 2:
+        stream, status, data = queue.get()
+        if status != 'data':
+            ended += 1
+        nbytes += len(data)
+        items += 1
+    return nbytes, items
+
+
+def run_pipes(size):
+    queue = output_queue()
+    start = time.time()
+    fds = start_child(size)
+    def reader(stream):
+        while True:
+            data = os.read(fds[stream], 65536)
+            if not data:
+                queue.put((stream, 'eof', data))
+                break
+            queue.put((stream, 'data', data))
+    for stream in fds:
+        thread = threading.Thread(target=reader, args=(stream,))
+        thread.setDaemon(True)
+        thread.start()
+    nbytes, items = consume(queue)
+    elapsed = time.time() - start
+    for fd in fds.values():
+        os.close(fd)
+    return elapsed, nbytes, items, 2
+
+
+def run_mux(size, maxpacket):
+    queue = output_queue()
+    parent, child = socket.socketpair()
+    start = time.time()
+    fds = start_child(size)
+    outputs = dict([(stream, lambda n, fd=fd: os.read(fd, n))
+                    for stream, fd in fds.items()])
+    channel = mux_channel(child.recv, child.sendall, maxpacket=maxpacket)
+    stub = threading.Thread(target=relay, args=(channel, None, lambda: None,
+                                                outputs))
+    stub.setDaemon(True)
+    stub.start()
+    ours = mux_channel(parent.recv, parent.sendall, maxpacket=maxpacket)
+    def deliver(stream, status, data):
+        queue.put((stream, status, data))
+    reader = threading.Thread(target=ours.serve, args=(deliver,))
+    reader.setDaemon(True)
+    reader.start()
+    nbytes, items = consume(queue)
+    elapsed = time.time() - start
+    parent.shutdown(socket.SHUT_WR)
+    stub.join()
+    parent.close()
+    child.close()
+    for fd in fds.values():
+        os.close(fd)
+    return elapsed, nbytes, items, 1
+
+
+def main():
+    size = 256
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    print '%d MB of output, half on stdout and half on stderr' % size
+    print '%14s %10s %10s %12s %10s' % ('transport', 'time (s)', 'MB/s',
+                                        'queued', 'readers')
+    runs = [('pipes', lambda: run_pipes(size << 20))]
+    for maxpacket in (4096, 16384, 65535):
+        runs.append(('mux %d' % maxpacket,
+                     lambda m=maxpacket: run_mux(size << 20, m)))
+    for name, run in runs:
+        elapsed, nbytes, items, readers = run()
+        assert nbytes == size << 20
+        print '%14s %10.2f %10.1f %12d %10d' % (name, elapsed,
+                (nbytes >> 20) / elapsed, items, readers)
+    print
+    print 'per child: 4 named pipes without multiplex, 1 with it'
+
+
+if __name__ == '__main__':
+    main()
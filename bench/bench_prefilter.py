@@ -0,0 +1,60 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure the literal prefilter of searcher_re.
+
+A build log is streamed line by line into an expect_buffer and searched after
+every line for a few typical prompts, one of which has an unbounded length,
+with and without the prefilter.
+
+Usage: python bench/bench_prefilter.py [lines]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import searcher_re, expect_buffer
+
+
+LINE = 'gcc -O2 -Wall -c src/module%04d.c -o build/module%04d.o\r\n'
+PATTERNS = [r'[Pp]assword: ', r'\$ $', r'ERROR\d+', r'Connection (refused|closed)',
+            r'login: ?', r'Traceback.*Error']
+
+
+def run(lines, prefilter):
+    searcher = searcher_re([re.compile(p) for p in PATTERNS])
+    if not prefilter:
+        searcher._separate = [search[:4] + (None,)
+                              for search in searcher._separate]
+    buffer = expect_buffer()
+    start = time.time()
+    for i in range(lines):
+        line = LINE % (i, i)
+        buffer.append(line)
+        assert searcher.search(buffer, len(line)) == -1
+    return time.time() - start, searcher.regex_calls, searcher.regex_skipped
+
+
+def main():
+    if len(sys.argv) > 1:
+        lines = int(sys.argv[1])
+    else:
+        lines = 5000
+    print '%10s %8s %10s %12s %12s' % ('prefilter', 'lines', 'time (s)',
+                                        'regex calls', 'skipped')
+    for prefilter in (False, True):
+        elapsed, calls, skipped = run(lines, prefilter)
+        print '%10s %8d %10.3f %12d %12d' % (prefilter, lines, elapsed,
+                                             calls, skipped)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure how reading the output of many children scales: two reader
+threads per child, as winspawn does by default, against a reactor.
+
+Every child is a pair of os.pipe()s for stdout and stderr, so this runs on
+any Unix-like system; the reactor uses its select_transport. The output is
+written in 4 KB blocks to all stdout pipes in turn. Every configuration runs
+in a subprocess; the resident set size is measured once all readers are
+set up, before any output is written.
+
+Usage: python bench/bench_reactor.py [kilobytes-per-child]
+"""
+
+import os
+import sys
+import time
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from winpexpect_io import reactor, select_transport
+
+
+class session(object):
+    """The reading side of a child; counts the bytes it gets."""
+
+    def __init__(self):
+        self.nbytes = 0
+        self.eofs = 0
+
+    def output(self, status, data):
+        if status == 'data':
+            self.nbytes += len(data)
+        else:
+            self.eofs += 1
+            if self.eofs == 2:
+                done.release()
+
+
+done = threading.Semaphore(0)
+
+
+def reader(fd, callback):
+    """Like winspawn._child_reader()."""
+    while True:
+        data = os.read(fd, 4096)
+        if not data:
+            callback('eof', data)
+            break
+        callback('data', data)
+
+
+def rss():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) // 1024
+    return 0
+
+
+def child(mode, nchildren, size):
+    sessions = []
+    writers = []
+    pool = None
+    if mode != 'threads':
+        pool = reactor(threads=int(mode[7:] or 1), transport=select_transport)
+    for i in range(nchildren):
+        s = session()
+        for stream in ('stdout', 'stderr'):
+            r, w = os.pipe()
+            if pool is None:
+                t = threading.Thread(target=reader, args=(r, s.output))
+                t.setDaemon(True)
+                t.start()
+            else:
+                pool.register(r, s.output)
+            writers.append(w)
+        sessions.append(s)
+    nthreads = threading.activeCount()
+    memory = rss()
+    block = 'x'.encode('ascii') * 4096
+    start = time.time()
+    for i in range(size // 4096):
+        for w in writers[::2]:
+            os.write(w, block)
+    for w in writers:
+        os.close(w)
+    for s in sessions:
+        done.acquire()
+    elapsed = time.time() - start
+    total = sum([s.nbytes for s in sessions])
+    assert total == nchildren * (size // 4096) * 4096
+    print '%10s %9d %9d %10d %10.1f' % (mode, nchildren, nthreads, memory,
+                                        total / elapsed / (1 << 20))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        return
+    size = 256
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    print '%d KB of output per child' % size
+    print '%10s %9s %9s %10s %10s' % ('mode', 'children', 'threads',
+                                      'rss (MB)', 'MB/s')
+    sys.stdout.flush()
+    for nchildren in (10, 100, 500, 1000):
+        for mode in ('threads', 'reactor', 'reactor4'):
+            subprocess.call([sys.executable, __file__, '--child', mode,
+                             str(nchildren), str(size << 10)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure an expect script against a live child, and against a replay of
+its transcript at the recorded speed and as fast as possible.
+
+The child is a thread at the other end of a socket pair that acts like a
+slow command line tool: it answers every command after a delay, with a
+number of lines. The script runs the commands and waits for the prompt
+after each. The live run records the transcript that the replays use.
+
+Usage: python bench/bench_replay.py [commands] [lines] [delay-ms]
+"""
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import spawn
+from pexpect_replay import transcript, read_transcript, replayspawn
+
+
+class socketspawn(spawn):
+
+    def __init__(self, **kwargs):
+        super(socketspawn, self).__init__(None, **kwargs)
+        self.sock, self.peer = socket.socketpair()
+        self.child_fd = self.sock.fileno()
+        self.closed = False
+
+    def isalive(self):
+        return not self.closed
+
+    def close(self):
+        if not self.closed:
+            self._sync_logs()
+            self.sock.close()
+            self.peer.close()
+            self.closed = True
+
+
+def tool(sock, lines, delay):
+    """The child: answer every command line after `delay' seconds."""
+    prompt = 'C:\\> '.encode('ascii')
+    sock.sendall(prompt)
+    pending = ''.encode('ascii')
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        pending += data
+        while '\n'.encode('ascii') in pending:
+            line, pending = pending.split('\n'.encode('ascii'), 1)
+            time.sleep(delay)
+            output = ''.join(['%s: line %d of the output\r\n' %
+                              (line.decode('ascii'), i) for i in range(lines)])
+            sock.sendall(output.encode('ascii') + prompt)
+
+
+def script(child, commands):
+    """The expect script."""
+    child.expect_exact('C:\\> ')
+    for i in range(commands):
+        child.sendline('dir %d' % i)
+        child.expect_exact('C:\\> ')
+
+
+def run_live(path, commands, lines, delay):
+    child = socketspawn(timeout=30, lowlatency=True)
+    child.transcript = transcript(path)
+    thread = threading.Thread(target=tool, args=(child.peer, lines, delay))
+    thread.setDaemon(True)
+    thread.start()
+    start = time.time()
+    script(child, commands)
+    elapsed = time.time() - start
+    child.sock.shutdown(socket.SHUT_WR)
+    thread.join()
+    child.close()
+    child.transcript.close()
+    return elapsed
+
+
+def run_replay(records, commands, speed):
+    child = replayspawn(records, speed=speed, timeout=30, lowlatency=True)
+    start = time.time()
+    script(child, commands)
+    elapsed = time.time() - start
+    child.close()
+    return elapsed
+
+
+def main():
+    commands = 100
+    lines = 50
+    delay = 10
+    if len(sys.argv) > 1:
+        commands = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        lines = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        delay = int(sys.argv[3])
+    fd, path = tempfile.mkstemp(suffix='.pxt')
+    os.close(fd)
+    try:
+        print '%d commands, %d lines of output each after %d ms' % (commands,
+                lines, delay)
+        live = run_live(path, commands, lines, delay / 1000.0)
+        records = read_transcript(path)
+        print 'transcript: %d records, %d bytes' % (len(records),
+                                                    os.path.getsize(path))
+        print '%12s %10s %12s' % ('run', 'time (s)', 'commands/s')
+        for name, elapsed in (('live', live),
+                ('replay 1.0', run_replay(records, commands, 1.0)),
+                ('replay fast', run_replay(records, commands, None))):
+            print '%12s %10.3f %12.0f' % (name, elapsed, commands / elapsed)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
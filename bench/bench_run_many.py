@@ -0,0 +1,87 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure running a batch of short commands with run_many(), one at a time
+as with run() in a loop, and with more of them at the same time.
+
+Every command asks for a password, gets it through an event, and exits a
+little later. The children talk over pipes, so this runs on any Unix-like
+system. The number of searchers that had to be built shows that the
+compiled patterns are shared by all runs.
+
+Usage: python bench/bench_run_many.py [commands]
+"""
+
+import os
+import sys
+import time
+import shlex
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import spawn, run_many
+
+command = 'sh -c "printf \'Password: \'; read p; sleep 0.05; echo ok $p"'
+
+
+class pipespawn(spawn):
+    """A spawn that runs a command with its output on a pipe."""
+
+    def __init__(self, command, **kwargs):
+        super(pipespawn, self).__init__(None, **kwargs)
+        self.proc = subprocess.Popen(shlex.split(command),
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        self.child_fd = self.proc.stdout.fileno()
+        self.closed = False
+
+    def _write(self, s):
+        return os.write(self.proc.stdin.fileno(), s)
+
+    def isalive(self):
+        self.exitstatus = self.proc.poll()
+        return self.exitstatus is None
+
+    def terminate(self, force=False):
+        self.proc.kill()
+        self.wait()
+
+    def wait(self):
+        self.exitstatus = self.proc.wait()
+        return self.exitstatus
+
+    def close(self, force=True):
+        if not self.closed:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.closed = True
+
+
+def main():
+    ncommands = 200
+    if len(sys.argv) > 1:
+        ncommands = int(sys.argv[1])
+    events = {'Password: ': 'secret\n'}
+    print '%d commands' % ncommands
+    print '%12s %10s %12s %10s' % ('concurrency', 'time (s)', 'commands/s',
+                                   'searchers')
+    for concurrency in (1, 8, 32):
+        spawn.searchercache.clear()
+        start = time.time()
+        for name, output, status in run_many([command] * ncommands,
+                concurrency, events, timeout=10, factory=pipespawn,
+                lowlatency=True):
+            assert output == 'Password: ok secret\n' and status == 0
+        elapsed = time.time() - start
+        print '%12d %10.2f %12.1f %10d' % (concurrency, elapsed,
+                ncommands / elapsed, spawn.searchercache.misses)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Compare incremental searcher_re searches against full buffer rescans.
+
+A long build log is streamed in maxread sized chunks and searched after every
+chunk, like expect_loop() does, with the only match at the very end. The full
+rescan is quadratic, so it is only run over the first few megabytes.
+
+Usage: python bench/bench_searcher_re.py [megabytes] [rescan-megabytes]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import searcher_re
+
+
+LINE = 'gcc -O2 -Wall -c src/module%04d.c -o build/module%04d.o\r\n'
+
+def stream(size, maxread=2000):
+    block = ''.join([LINE % (i, i) for i in range(1000)])
+    data = block * (size // len(block) + 1)
+    data = data[:size] + 'BUILD DONE in 42s\r\n'
+    for i in range(0, len(data), maxread):
+        yield data[i:i+maxread]
+
+
+def run(patterns, size, full):
+    searcher = searcher_re(patterns)
+    buffer = ''
+    start = time.time()
+    for chunk in stream(size):
+        buffer += chunk
+        freshlen = len(buffer) if full else len(chunk)
+        if searcher.search(buffer, freshlen) >= 0:
+            break
+    else:
+        raise AssertionError('no match')
+    return time.time() - start
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rescan = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    patterns = [re.compile(p, re.DOTALL) for p in
+                (r'BUILD DONE in \d{1,5}s', r'error: [^\r\n]{0,200}\r\n',
+                 r'\$ $', r'(?i)password:')]
+    print 'patterns:', ', '.join([p.pattern for p in patterns])
+    print '%10s %10s %12s %10s' % ('mode', 'MB', 'seconds', 'MB/s')
+    for mode, size in (('rescan', rescan), ('rescan', 2*rescan),
+                       ('fresh', rescan), ('fresh', megabytes)):
+        t = run(patterns, size * 1024 * 1024, mode == 'rescan')
+        print '%10s %10d %12.3f %10.2f' % (mode, size, t, size/t)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Compare the Aho-Corasick automaton of searcher_string against the old
+one-find()-per-string searcher as the number of strings grows, to find where
+they cross. searcher_string itself uses find() below its
+automaton_threshold and the automaton from there on.
+
+The input is a stream of compiler-like output fed in maxread sized chunks,
+with the only match at the very end. This is what expect_exact() sees when
+it waits for one of many prompts or error markers.
+
+Usage: python bench/bench_searcher_string.py [megabytes]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import searcher_string
+
+
+class searcher_find(object):
+    """The searcher_string from before the Aho-Corasick automaton."""
+
+    def __init__(self, strings):
+        self._strings = list(enumerate(strings))
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        first_match = len(buffer)
+        best_index = -1
+        for index, s in self._strings:
+            if searchwindowsize is None:
+                offset = -(freshlen+len(s))
+            else:
+                offset = -searchwindowsize
+            n = buffer.find(s, offset)
+            if n >= 0 and n < first_match:
+                first_match = n
+                best_index = index
+        return best_index
+
+
+class searcher_automaton(searcher_string):
+    """A searcher_string that always uses the automaton."""
+
+    automaton_threshold = 1
+
+
+def make_chunks(size, maxread=2000):
+    rnd = random.Random(42)
+    words = ['gcc', '-O2', '-c', 'src/module.c', '-o', 'module.o',
+             'warning:', 'unused', 'variable', 'note:', 'in', 'function']
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join([rnd.choice(words) for i in range(10)]) + '\r\n'
+        lines.append(line)
+        total += len(line)
+    data = ''.join(lines) + 'BUILD DONE\r\n'
+    return [data[i:i+maxread] for i in range(0, len(data), maxread)]
+
+
+def make_strings(count):
+    strings = ['BUILD DONE']
+    for i in range(count-1):
+        strings.append('FATAL-%03d:' % i)
+    return strings
+
+
+def run(factory, strings, chunks):
+    searcher = factory(strings)
+    buffer = ''
+    start = time.time()
+    for chunk in chunks:
+        # Keep the buffer short so that only the search is measured.
+        buffer = buffer[-64:] + chunk
+        if searcher.search(buffer, len(chunk)) >= 0:
+            break
+    else:
+        raise AssertionError('no match')
+    return time.time() - start
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    chunks = make_chunks(int(megabytes * 1024 * 1024))
+    print 'input: %.1f MB in %d chunks' % (megabytes, len(chunks))
+    print 'searcher_string uses the automaton from %d strings' % \
+            searcher_string.automaton_threshold
+    print '%8s %10s %14s %16s %8s' % ('strings', 'find (s)', 'automaton (s)',
+                                      'searcher_string', 'speedup')
+    for count in (1, 2, 4, 6, 8, 10, 16, 30, 50, 80):
+        strings = make_strings(count)
+        t1 = run(searcher_find, strings, chunks)
+        t2 = run(searcher_automaton, strings, chunks)
+        t3 = run(searcher_string, strings, chunks)
+        print '%8d %10.3f %14.3f %16.3f %8.2f' % (count, t1, t2, t3, t1/t2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure waiting for many children at once: polling each child with
+expect(timeout=0) against one session_group.
+
+The children are socket pairs. A thread writes a line to a random child
+every few milliseconds; the time from that write until the line is matched
+is the latency. The CPU time is that of the whole process.
+
+Usage: python bench/bench_session_group.py [children] [events]
+"""
+
+import os
+import sys
+import time
+import random
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import spawn, session_group, TIMEOUT
+
+
+class socketspawn(spawn):
+    """A spawn that talks to the other end of a socket pair."""
+
+    def __init__(self, **kwargs):
+        super(socketspawn, self).__init__(None, **kwargs)
+        self.sock, self.peer = socket.socketpair()
+        self.child_fd = self.sock.fileno()
+        self.closed = False
+
+    def isalive(self):
+        return not self.closed
+
+    def close(self):
+        if not self.closed:
+            self.sock.close()
+            self.peer.close()
+            self.closed = True
+
+
+def feeder(children, events, sent):
+    rnd = random.Random(0)
+    for i in range(events):
+        time.sleep(0.002)
+        child = rnd.choice(children)
+        sent.append(time.time())
+        child.peer.send('done\r\n')
+
+
+def poll_each(children, events, latencies, sent):
+    found = 0
+    while found < events:
+        for child in children:
+            try:
+                child.expect_exact('done\r\n', timeout=0)
+            except TIMEOUT:
+                continue
+            latencies.append(time.time() - sent[found])
+            found += 1
+
+
+def group_wait(children, events, latencies, sent):
+    group = session_group()
+    for child in children:
+        group.add(child, 'done\r\n', timeout=None, exact=True)
+    for found in range(events):
+        child, index = group.expect()
+        latencies.append(time.time() - sent[found])
+        group.add(child, 'done\r\n', timeout=None, exact=True)
+    group.close()
+
+
+def run(wait, nchildren, events):
+    children = [socketspawn() for i in range(nchildren)]
+    sent = []
+    latencies = []
+    thread = threading.Thread(target=feeder, args=(children, events, sent))
+    cpu = sum(os.times()[:2])
+    start = time.time()
+    thread.start()
+    wait(children, events, latencies, sent)
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu
+    thread.join()
+    for child in children:
+        child.close()
+    return elapsed, cpu, 1000.0 * sum(latencies) / len(latencies)
+
+
+def main():
+    nchildren = 300
+    events = 500
+    if len(sys.argv) > 1:
+        nchildren = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        events = int(sys.argv[2])
+    print '%12s %9s %8s %10s %10s %14s' % ('wait', 'children', 'events',
+            'wall (s)', 'cpu (s)', 'mean latency')
+    for name, wait in (('poll each', poll_each), ('group', group_wait)):
+        elapsed, cpu, latency = run(wait, nchildren, events)
+        print '%12s %9d %8d %10.2f %10.2f %11.3f ms' % (name, nchildren,
+                events, elapsed, cpu, latency)
+
+
+if __name__ == '__main__':
+    main()
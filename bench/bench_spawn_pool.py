@@ -0,0 +1,122 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure short tasks in a REPL: starting a new child for every task
+against taking one from a spawn_pool.
+
+The child is a Python interpreter that evaluates one expression per line,
+and a task is one expression. The child talks over pipes, so this runs on
+any Unix-like system. A task arrives every few milliseconds; its latency is
+the time from its arrival until its result is read.
+
+Usage: python bench/bench_spawn_pool.py [tasks] [pool-size]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from pexpect import spawn, spawn_pool
+
+repl = '''
+import sys
+sys.stdout.write('> ')
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    sys.stdout.write('%r\\n> ' % eval(line))
+'''
+
+
+class pipespawn(spawn):
+    """A spawn that talks to a subprocess over pipes."""
+
+    def __init__(self, command, args, **kwargs):
+        super(pipespawn, self).__init__(None, **kwargs)
+        self.proc = subprocess.Popen([command] + args, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.child_fd = self.proc.stdout.fileno()
+        self.closed = False
+
+    def _write(self, s):
+        return os.write(self.proc.stdin.fileno(), s)
+
+    def isalive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        if not self.closed:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc.stdout.close()
+            self.closed = True
+
+
+def setup(child):
+    child.expect_exact('> ')
+
+
+def task(child, i):
+    child.sendline('%d * %d' % (i, i))
+    child.expect_exact('> ')
+    assert child.before.strip() == str(i * i)
+
+
+def run(tasks, pool):
+    latencies = []
+    args = ['-u', '-c', repl]
+    start = time.time()
+    for i in range(tasks):
+        arrival = time.time()
+        if pool is None:
+            child = pipespawn(sys.executable, args, lowlatency=True)
+            setup(child)
+            task(child, i)
+            child.close()
+        else:
+            child = pool.checkout()
+            task(child, i)
+            pool.checkin(child)
+        latencies.append(time.time() - arrival)
+        time.sleep(max(0, arrival + 0.02 - time.time()))
+    elapsed = time.time() - start
+    return elapsed, 1000.0 * sum(latencies) / len(latencies)
+
+
+def main():
+    tasks = 100
+    size = 2
+    if len(sys.argv) > 1:
+        tasks = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        size = int(sys.argv[2])
+    print '%d tasks, one every 20 ms' % tasks
+    print '%12s %10s %14s %10s %10s' % ('mode', 'time (s)', 'mean latency',
+                                        'hit rate', 'saved (s)')
+    elapsed, latency = run(tasks, None)
+    print '%12s %10.2f %11.2f ms %10s %10s' % ('spawn each', elapsed,
+                                               latency, '-', '-')
+    # A child that was used is put back, so the pool only needs to replace
+    # children when a task spoils one; this pool does so for every task.
+    for name, reset in (('pool', None), ('pool, fresh', lambda c: False)):
+        pool = spawn_pool(sys.executable, ['-u', '-c', repl], size,
+                          pipespawn, setup=setup, reset=reset,
+                          lowlatency=True)
+        while len(pool) < size:
+            time.sleep(0.01)
+        elapsed, latency = run(tasks, pool)
+        print '%12s %10.2f %11.2f ms %9.0f%% %10.2f' % (name, elapsed,
+                latency, 100 * pool.hit_rate, pool.saved)
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Measure expect() on a child that writes progress bars to stderr while
+its useful output goes to stdout: with stdout and stderr mixed, as winspawn
+does by default, and with separate_stderr, searching stdout only, and with
+stderr passed to a sink.
+
+winspawn needs Windows, so this uses a spawn with the same output queue and
+read_nonblocking() logic. The output of the child is queued up front.
+
+Usage: python bench/bench_streams.py [megabytes] [stderr-share]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from Queue import Empty
+from pexpect import spawn, EOF, TIMEOUT
+from winpexpect_io import ChunkBuffer, output_queue, output_streams
+
+
+class queuespawn(spawn):
+    """A spawn that reads from a queue of output like winspawn."""
+
+    def __init__(self, items, stream, sink=None, **kwargs):
+        super(queuespawn, self).__init__(None, **kwargs)
+        self.child_output = output_queue()
+        for item in items:
+            self.child_output.put(item)
+        self.stream = stream
+        self.chunk_buffer = ChunkBuffer()
+        self.pending_output = None
+        self.output_streams = None
+        if stream != 'both':
+            self.output_streams = output_streams(self.child_output, 1, sink)
+        self.closed = False
+
+    def _get_output(self, timeout):
+        return self.child_output.get(False)
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if self.output_streams is not None:
+            try:
+                stream, status, data = self.output_streams.read(self.stream,
+                        size, self._get_output, 0)
+            except Empty:
+                raise TIMEOUT('Timeout exceeded in read_nonblocking().')
+            if status != 'data':
+                raise EOF('End of file in read_nonblocking().')
+            return data
+        buf = self.chunk_buffer
+        if not len(buf):
+            item = self.pending_output
+            self.pending_output = None
+            if item is None:
+                item = self.child_output.get(False)
+            if item[1] != 'data':
+                raise EOF('End of file in read_nonblocking().')
+            buf.add(item[2])
+        if self.pending_output is None:
+            self.pending_output = buf.drain(self.child_output, size)
+        return buf.read(size)
+
+    def close(self):
+        self.closed = True
+
+
+def output(size, share):
+    """The output of a build: compiler lines on stdout and, for `share' of
+    the output, progress bars on stderr."""
+    line = 'compiling module.c with optimizations enabled\r\n'
+    bar = '\r[' + '#' * 30 + ' ' * 30 + '] 50%'
+    items = []
+    nbytes = 0
+    noise = 0
+    while nbytes < size:
+        if noise < share * nbytes:
+            items.append((2, 'data', bar * 40))
+            noise += len(bar) * 40
+        else:
+            items.append((1, 'data', line * 20))
+        nbytes += len(items[-1][2])
+    items.append((1, 'eof', ''))
+    items.append((2, 'eof', ''))
+    return items
+
+
+def run(items, stream, sink=None):
+    child = queuespawn(items, stream, sink, maxread=65536, lowlatency=True)
+    start = time.time()
+    child.expect([r'(?i)(error|fatal)\s*[A-Z]\d+:', EOF], timeout=None,
+                 maxwidths=[20, None])
+    elapsed = time.time() - start
+    assert child.after is EOF
+    return elapsed, len(child.before)
+
+
+def main():
+    size = 16
+    share = 0.75
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        share = float(sys.argv[2])
+    items = output(size << 20, share)
+    print '%d MB of output, %d%% of it on stderr' % (size, 100 * share)
+    print '%14s %10s %12s' % ('searched', 'time (s)', 'before')
+    sunk = []
+    for name, stream, sink in (('both', 'both', None),
+                               ('stdout', 'stdout', None),
+                               ('stdout + sink', 'stdout', sunk.append)):
+        elapsed, nbefore = run(items, stream, sink)
+        print '%14s %10.2f %12d' % (name, elapsed, nbefore)
+
+
+if __name__ == '__main__':
+    main()
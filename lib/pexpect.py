@@ -68,6 +68,11 @@ try:
     import select
     import string
     import re
+    try:
+        from re import _parser as sre_parse, _constants as sre_constants
+    except ImportError:
+        import sre_parse
+        import sre_constants
     import struct
     #import resource
     import types
@@ -78,16 +83,28 @@ try:
     import errno
     import traceback
     import signal
+    import threading
+    import collections
 except ImportError, e:
     raise ImportError (str(e) + """
 
 A critical module was not found. Probably this operating system does not
 support it. Pexpect is intended for UNIX-like operating systems.""")
 
+try:
+    bytes
+except NameError:
+    bytes = str # Python < 2.6
+
+# The types that expect() and expect_exact() accept as pattern strings.
+_string_types = types.StringTypes + (bytes,)
+_linesep_bytes = os.linesep.encode('ascii')
+
 __version__ = '2.3'
 __revision__ = '$Revision: 399 $'
-__all__ = ['ExceptionPexpect', 'EOF', 'TIMEOUT', 'spawn', 'run', 'which',
-    'split_command_line', '__version__', '__revision__']
+__all__ = ['ExceptionPexpect', 'EOF', 'TIMEOUT', 'MAXBUFFER', 'spawn', 'run', 'which',
+    'split_command_line', 'session_group', 'expect_any', 'spawn_pool',
+    'run_many', 'log_writer', '__version__', '__revision__']
 
 # Exception classes used by this module.
 class ExceptionPexpect(Exception):
@@ -138,8 +155,9 @@ class TIMEOUT(ExceptionPexpect):
 ##    give output, thus never give a TIMEOUT, but the output
 ##    may never match a pattern.
 ##    """
-##class MAXBUFFER(ExceptionPexpect):
-##    """Raised when a scan buffer fills before matching an expected pattern."""
+class MAXBUFFER(ExceptionPexpect):
+
+    """Raised when a scan buffer fills before matching an expected pattern."""
 
 def run (command, timeout=-1, withexitstatus=False, events=None, extra_args=None, logfile=None, cwd=None, env=None):
 
@@ -259,12 +277,337 @@ def run (command, timeout=-1, withexitstatus=False, events=None, extra_args=None
     else:
         return child_result
 
+def run_many (commands, concurrency=4, events=None, timeout=-1, factory=None, **kwargs):
+
+    """This runs many commands like run() does, up to 'concurrency' of them
+    at the same time, and yields a tuple (command, output, exitstatus) for
+    each command as soon as it is finished, in the order they finish::
+
+        for command, output, status in run_many (commands, concurrency=8,
+                events={'(?i)password': 'secret\\n'}, timeout=60):
+            ...
+
+    The children are waited on together by one session_group, so they need
+    no thread each. 'events' is a dictionary of patterns and responses as
+    for run(). The patterns are compiled once, and the searchers that are
+    built for them are reused from run to run. A callback is passed a
+    dictionary with 'child', 'command', 'event_count' and 'extra_args'; the
+    value for 'extra_args' is taken from the keyword arguments.
+
+    A command ends at EOF or when it times out after 'timeout' seconds,
+    unless those are in 'events', or when a callback returns True. The
+    child is then closed; if it timed out or was stopped it is terminated.
+    The children are made with 'factory', spawn by default, which is called
+    with the command and the other keyword arguments. It also works with
+    factory=winpexpect.winspawn. If the generator is not run to the end, the
+    children that are still running are terminated. """
+
+    if factory is None:
+        factory = spawn
+    extra_args = kwargs.pop('extra_args', None)
+    if events is not None:
+        patterns = events.keys()
+        responses = events.values()
+    else:
+        patterns = []
+        responses = []
+    # The index of the pattern after the events, if it is not one of them.
+    stops = []
+    for stop in (EOF, TIMEOUT):
+        if stop not in patterns:
+            stops.append(stop)
+    patterns = patterns + stops
+    compiled = False
+    commands = iter(commands)
+    group = session_group()
+    running = {}
+    try:
+        while True:
+            while len(running) < concurrency:
+                try:
+                    command = commands.next()
+                except StopIteration:
+                    break
+                child = factory(command, **kwargs)
+                if not compiled:
+                    patterns = child.compile_pattern_list(patterns)
+                    compiled = True
+                running[child] = _batch_run(command, child, extra_args)
+                group.add(child, patterns, timeout)
+            if not running:
+                break
+            child, index = group.expect()
+            batch = running[child]
+            if type(child.after) in _string_types:
+                batch.output.append(child.before + child.after)
+            else: # child.after may have been a TIMEOUT or EOF, so don't cat those.
+                batch.output.append(child.before)
+            done = index >= len(responses)
+            if not done:
+                response = responses[index]
+                if type(response) in _string_types:
+                    child.send(response)
+                elif callable(response):
+                    callback_result = response(batch.locals())
+                    if type(callback_result) in _string_types:
+                        child.send(callback_result)
+                    elif callback_result:
+                        done = True
+                else:
+                    raise TypeError ('The callback must be a string or function type.')
+                batch.event_count += 1
+            if done:
+                del running[child]
+                batch.finish(child.after is EOF)
+                yield batch.command, child._empty.join(batch.output), child.exitstatus
+            else:
+                group.add(child, patterns, timeout)
+    finally:
+        group.close()
+        for batch in running.values():
+            batch.finish(False)
+
+class _batch_run (object):
+
+    """INTERNAL: this is a command that is run by run_many(). """
+
+    def __init__(self, command, child, extra_args):
+
+        self.command = command
+        self.child = child
+        self.extra_args = extra_args
+        self.output = []
+        self.event_count = 0
+
+    def locals(self):
+
+        """This returns the dictionary that is passed to callbacks. """
+
+        return {'child': self.child, 'command': self.command,
+                'event_count': self.event_count,
+                'extra_args': self.extra_args}
+
+    def finish(self, eof):
+
+        """This closes the child and waits for it to exit. If it did not reach
+        EOF, it is terminated. """
+
+        child = self.child
+        child.close()
+        if child.exitstatus is None and child.signalstatus is None \
+                and child.isalive():
+            if eof:
+                child.wait()
+            else:
+                child.terminate()
+
+class expect_buffer (object):
+
+    """This is the read buffer used by expect_loop(). It is a list of the
+    chunks that were read, so that appending a chunk does not copy the data
+    that was read before it. The searchers ask for a contiguous window at the
+    end of the buffer with window(); only the chunks in that window are joined.
+    When a match is found the buffer is split in place at the match, and the
+    parts are only joined into strings when somebody asks for them. """
+
+    def __init__(self, data=''):
+
+        self._empty = data[:0]
+        self._chunks = []
+        self._length = 0
+        if data:
+            self.append(data)
+
+    def __len__(self):
+
+        return self._length
+
+    def append(self, data):
+
+        """This adds 'data' to the end of the buffer. """
+
+        if data:
+            if not self._chunks:
+                self._empty = data[:0]
+            self._chunks.append(data)
+            self._length += len(data)
+
+    def extend(self, other):
+
+        """This adds the contents of the expect_buffer 'other' to the end of
+        the buffer. The chunks are shared. """
+
+        for chunk in other._chunks:
+            self.append(chunk)
+
+    def window(self, start):
+
+        """This returns a tuple (data, base) where 'data' is a string with the
+        contents of the buffer from offset 'base' to the end. The offset 'base'
+        is at most 'start'; it is less if that avoids copying. """
+
+        chunks = self._chunks
+        base = self._length
+        i = len(chunks)
+        while i > 0 and base > start:
+            i -= 1
+            base -= len(chunks[i])
+        if i == len(chunks):
+            return self._empty, base
+        if i == len(chunks) - 1:
+            return chunks[i], base
+        first = chunks[i]
+        if base < start:
+            first = first[start-base:]
+            base = start
+        return self._empty.join([first] + chunks[i+1:]), base
+
+    def split(self, pos):
+
+        """This removes the first 'pos' bytes from the buffer and returns
+        them as a new expect_buffer. If the buffer is shorter, all of it is
+        removed. """
+
+        pos = min(pos, self._length)
+        front = expect_buffer(self._empty)
+        chunks = self._chunks
+        taken = 0
+        i = 0
+        while i < len(chunks) and taken + len(chunks[i]) <= pos:
+            taken += len(chunks[i])
+            i += 1
+        front._chunks = chunks[:i]
+        if taken < pos:
+            chunk = chunks[i]
+            front._chunks.append(chunk[:pos-taken])
+            chunks[i] = chunk[pos-taken:]
+            taken = pos
+        del chunks[:i]
+        front._length = taken
+        self._length -= taken
+        return front
+
+    def copy(self):
+
+        """This returns a copy of the buffer. The chunks are shared. """
+
+        other = expect_buffer(self._empty)
+        other._chunks = self._chunks[:]
+        other._length = self._length
+        return other
+
+    def getvalue(self):
+
+        """This returns the contents of the buffer as a single string. """
+
+        chunks = self._chunks
+        if not chunks:
+            return self._empty
+        if len(chunks) > 1:
+            chunks[:] = [self._empty.join(chunks)]
+        return chunks[0]
+
+def _window(buffer, start):
+
+    """This returns a tuple (data, base) where 'data' is a string holding
+    'buffer' from at least offset 'start' onwards. The searchers accept either
+    a string or an expect_buffer. """
+
+    if isinstance(buffer, expect_buffer):
+        return buffer.window(max(start, 0))
+    return buffer, 0
+
+class searcher_cache (object):
+
+    """This is a bounded LRU cache of searcher objects. It is used by spawn so
+    that expect() in a loop does not compile the same patterns and build the
+    same searcher over and over again.
+
+    A searcher keeps state while it is being used, so it is taken out of the
+    cache with checkout() and put back with checkin() when expect() is done
+    with it. If two expect() calls use the same patterns at the same time, the
+    second one simply gets a cache miss and builds its own searcher.
+
+    The 'hits' and 'misses' attributes count the checkout() calls that did and
+    did not find a searcher. """
+
+    def __init__(self, maxsize=100):
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._order = collections.deque() # (tick, key), least recently used first.
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def checkout(self, key):
+
+        """This removes the searcher stored under 'key' from the cache and
+        returns it, or returns None if there is none. """
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def checkin(self, key, searcher):
+
+        """This stores 'searcher' under 'key'. If the cache is full, the
+        least recently used searcher is dropped. """
+
+        self._lock.acquire()
+        try:
+            self._tick += 1
+            self._entries[key] = (self._tick, searcher)
+            order = self._order
+            order.append((self._tick, key))
+            # Items of 'order' whose tick is not that of the entry are stale:
+            # the entry was checked out or checked in again since.
+            while len(self._entries) > self.maxsize:
+                tick, k = order.popleft()
+                entry = self._entries.get(k)
+                if entry is not None and entry[0] == tick:
+                    del self._entries[k]
+            if len(order) > 2 * len(self._entries) + 16:
+                self._order = collections.deque([item for item in order
+                        if self._entries.get(item[1], (None,))[0] == item[0]])
+        finally:
+            self._lock.release()
+
+    def clear(self):
+
+        """This empties the cache and resets the counters. """
+
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._order.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
 class spawn (object):
 
     """This is the main class interface for Pexpect. Use this class to start
     and control child applications. """
 
-    def __init__(self, command, args=[], timeout=30, maxread=2000, searchwindowsize=None, logfile=None, cwd=None, env=None):
+    # Searchers built by expect(), expect_list() and expect_exact(). Set this
+    # to None in a subclass or instance to disable caching.
+    searchercache = searcher_cache(100)
+
+    def __init__(self, command, args=[], timeout=30, maxread=2000, searchwindowsize=None, logfile=None, cwd=None, env=None, lowlatency=False, binary=False):
 
         """This is the constructor. The command parameter may be a string that
         includes a command and any arguments to the command. For example::
@@ -344,6 +687,17 @@ class spawn (object):
         
             self.logfile_send = fout
 
+        A log file is written and flushed for every chunk. To write logs in
+        the background, in batches, use a log_writer::
+
+            child.logfile_read = pexpect.log_writer('output.log')
+
+        To record a session with the time of every read and send, so that it
+        can be played back later with pexpect_replay.replayspawn, set
+        transcript::
+
+            child.transcript = pexpect_replay.transcript('session.pxt')
+
         The delaybeforesend helps overcome a weird behavior that many users
         were experiencing. The typical problem was that a user would expect() a
         "Password:" prompt and then immediately call sendline() to send the
@@ -361,6 +715,65 @@ class spawn (object):
         delaybeforesend to 0 to return to the old behavior. Most Linux machines
         don't like this to be below 0.03. I don't know why.
 
+        If you have a long dialog with the child, these delays add up. Pass
+        lowlatency=True to the constructor to remove them: delaybeforesend is
+        set to 0, sendline() writes the line and the line feed in a single
+        write, and expect() does not sleep between reads. Reads still wait for
+        the child in select(), so nothing busy-loops. Without the delay you may
+        see your password echoed back; call waitnoecho() before sending it
+        instead. ::
+
+            child = pexpect.spawn('some_command', lowlatency=True)
+
+        By default the data that is sent to and read from the child is text,
+        and it must be ASCII. On Python 3 every chunk is encoded or decoded.
+        Pass binary=True to the constructor to work with bytes instead. The
+        data is then passed through as is: send() takes bytes, and 'buffer',
+        'before', 'after' and the log files get bytes. Use bytes patterns with
+        expect() and expect_exact(). On Python 2 bytes are plain strings, so
+        the only difference is that non-ASCII output does not raise an error.
+        ::
+
+            child = pexpect.spawn('some_command', binary=True)
+            child.expect(b'\xe9t\xe9')
+
+        While expect() waits for a pattern, everything the child writes is
+        kept in the read buffer. Set maxbuffer to a number of bytes to bound
+        it. What happens when the buffer grows past it is chosen with
+        maxbufferpolicy:
+
+            'raise'    - raise MAXBUFFER. This is the default.
+            'window'   - throw away the oldest data, keeping the last half of
+                         maxbuffer, or searchwindowsize bytes if that is less.
+                         A match that would have started in the dropped data
+                         is not found.
+            'headtail' - like 'window', but first set aside the first half of
+                         maxbuffer. The 'before' attribute then has this head
+                         followed by the data that was kept at the end.
+
+        The policy is applied after the data that was read has been searched,
+        so a match in the chunk that pushed the buffer past maxbuffer is
+        found. 'window' and 'headtail' always keep that chunk. ::
+
+            child.maxbuffer = 10 * 1024 * 1024
+            child.maxbufferpolicy = 'window'
+
+        Normally expect() searches for each pattern in turn. If you expect a
+        long list of patterns, set combinepatterns to True. The patterns are
+        then merged into one regular expression, so that one scan over the
+        input finds the first match of any of them. The index, 'match',
+        'before' and 'after' are the same as without it. Patterns that cannot
+        be merged (for example because of backreferences) are still searched
+        for separately. ::
+
+            child.combinepatterns = True
+
+        The searchers that expect() builds for a list of patterns are kept in
+        spawn.searchercache, a bounded cache shared by all instances of the
+        class, so calling expect() with the same patterns in a loop does not
+        compile them again. Its 'hits' and 'misses' attributes show how well
+        it works.
+
         Note that spawn is clever about finding commands on your path.
         It uses the same logic that "which" uses to find executables.
 
@@ -383,6 +796,7 @@ class spawn (object):
 
         self.searcher = None
         self.ignorecase = False
+        self.combinepatterns = False # Search all patterns in a single pass.
         self.before = None
         self.after = None
         self.match = None
@@ -396,14 +810,27 @@ class spawn (object):
         self.child_fd = -1 # initially closed
         self.timeout = timeout
         self.delimiter = EOF
+        self.lineterminator = '\r\n' # Used by readline() and iterlines().
         self.logfile = logfile
         self.logfile_read = None # input from child (read_nonblocking)
         self.logfile_send = None # output to send (send, sendline)
+        self.transcript = None # Records reads and sends with their times; see pexpect_replay.
         self.maxread = maxread # max bytes to read at one time into buffer
-        self.buffer = '' # This is the read buffer. See maxread.
+        self.binary = binary # Send and read bytes instead of ASCII text.
+        if binary:
+            self._empty = ''.encode('ascii')
+        else:
+            self._empty = ''
+        self.buffer = self._empty # This is the read buffer. See maxread.
         self.searchwindowsize = searchwindowsize # Anything before searchwindowsize point is preserved, but not searched.
+        self.maxbuffer = None # Bound on the read buffer in expect(). None means no bound.
+        self.maxbufferpolicy = 'raise' # What to do when maxbuffer is exceeded: 'raise', 'window' or 'headtail'.
+        self.before_sink = None # Default for the before_sink argument of expect().
         # Most Linux machines don't like delaybeforesend to be below 0.03 (30 ms).
         self.delaybeforesend = 0.05 # Sets sleep time used just before sending data to child. Time in seconds.
+        self.lowlatency = lowlatency # No sleeps in send(), sendline() and expect().
+        if lowlatency:
+            self.delaybeforesend = 0
         self.delayafterclose = 0.1 # Sets delay in close() method to allow kernel time to update process status. Time in seconds.
         self.delayafterterminate = 0.1 # Sets delay in terminate() method to allow kernel time to update process status. Time in seconds.
         self.softspace = False # File-like object.
@@ -469,17 +896,61 @@ class spawn (object):
         s.append('closed: ' + str(self.closed))
         s.append('timeout: ' + str(self.timeout))
         s.append('delimiter: ' + str(self.delimiter))
+        s.append('lineterminator: ' + repr(self.lineterminator))
         s.append('logfile: ' + str(self.logfile))
         s.append('logfile_read: ' + str(self.logfile_read))
         s.append('logfile_send: ' + str(self.logfile_send))
         s.append('maxread: ' + str(self.maxread))
         s.append('ignorecase: ' + str(self.ignorecase))
+        s.append('combinepatterns: ' + str(self.combinepatterns))
         s.append('searchwindowsize: ' + str(self.searchwindowsize))
+        s.append('maxbuffer: ' + str(self.maxbuffer))
+        s.append('maxbufferpolicy: ' + str(self.maxbufferpolicy))
+        s.append('before_sink: ' + str(self.before_sink))
         s.append('delaybeforesend: ' + str(self.delaybeforesend))
+        s.append('lowlatency: ' + str(self.lowlatency))
+        s.append('binary: ' + str(self.binary))
         s.append('delayafterclose: ' + str(self.delayafterclose))
         s.append('delayafterterminate: ' + str(self.delayafterterminate))
         return '\n'.join(s)
 
+    # The read buffer and the 'before' and 'after' attributes are kept as
+    # expect_buffer objects by expect_loop(). They are only turned into
+    # strings when they are accessed. Lines that readline() and iterlines()
+    # have split off but not returned yet are in _lines, from _linepos on;
+    # they are logically at the front of the buffer.
+
+    def _get_buffer(self):
+        self._unread_lines()
+        return self._buffer.getvalue()
+
+    def _set_buffer(self, value):
+        self._buffer = expect_buffer(value)
+        self._lines = []
+        self._linepos = 0
+
+    buffer = property(_get_buffer, _set_buffer)
+
+    def _get_before(self):
+        if isinstance(self._before, expect_buffer):
+            self._before = self._before.getvalue()
+        return self._before
+
+    def _set_before(self, value):
+        self._before = value
+
+    before = property(_get_before, _set_before)
+
+    def _get_after(self):
+        if isinstance(self._after, expect_buffer):
+            self._after = self._after.getvalue()
+        return self._after
+
+    def _set_after(self, value):
+        self._after = value
+
+    after = property(_get_after, _set_after)
+
     def _spawn(self,command,args=[]):
 
         """This starts the given command in a child process. This does all the
@@ -659,6 +1130,7 @@ class spawn (object):
 
         if not self.closed:
             self.flush()
+            self._sync_logs()
             os.close (self.child_fd)
             time.sleep(self.delayafterclose) # Give kernel time to update process status.
             if self.isalive():
@@ -675,6 +1147,23 @@ class spawn (object):
 
         pass
 
+    def _sync_logs(self):
+
+        """INTERNAL: this waits until the log files that write in the
+        background, such as a log_writer, and the transcript have written
+        everything. """
+
+        for logfile in (self.logfile, self.logfile_read, self.logfile_send, self.transcript):
+            if logfile is not None and hasattr(logfile, 'sync'):
+                logfile.sync()
+
+    def _log_eof(self):
+
+        """INTERNAL: this records the end of the output in the transcript. """
+
+        if self.transcript is not None:
+            self.transcript.record_eof()
+
     def isatty (self):   # File-like object.
 
         """This returns True if the file descriptor is open and connected to a
@@ -803,6 +1292,7 @@ class spawn (object):
             r,w,e = self.__select([self.child_fd], [], [], 0) # timeout of 0 means "poll"
             if not r:
                 self.flag_eof = True
+                self._log_eof()
                 raise EOF ('End Of File (EOF) in read_nonblocking(). Braindead platform.')
         elif self.__irix_hack:
             # This is a hack for Irix. It seems that Irix requires a long delay before checking isalive.
@@ -810,6 +1300,7 @@ class spawn (object):
             r, w, e = self.__select([self.child_fd], [], [], 2)
             if not r and not self.isalive():
                 self.flag_eof = True
+                self._log_eof()
                 raise EOF ('End Of File (EOF) in read_nonblocking(). Pokey platform.')
 
         r,w,e = self.__select([self.child_fd], [], [], timeout)
@@ -819,18 +1310,21 @@ class spawn (object):
                 # Some platforms, such as Irix, will claim that their processes are alive;
                 # then timeout on the select; and then finally admit that they are not alive.
                 self.flag_eof = True
+                self._log_eof()
                 raise EOF ('End of File (EOF) in read_nonblocking(). Very pokey platform.')
             else:
                 raise TIMEOUT ('Timeout exceeded in read_nonblocking().')
 
         if self.child_fd in r:
             try:
-                s = os.read(self.child_fd, size)
+                s = self._decode(os.read(self.child_fd, size))
             except OSError, e: # Linux does this
                 self.flag_eof = True
+                self._log_eof()
                 raise EOF ('End Of File (EOF) in read_nonblocking(). Exception style platform.')
-            if s == '': # BSD style
+            if not s: # BSD style
                 self.flag_eof = True
+                self._log_eof()
                 raise EOF ('End Of File (EOF) in read_nonblocking(). Empty string style platform.')
 
             if self.logfile is not None:
@@ -839,24 +1333,69 @@ class spawn (object):
             if self.logfile_read is not None:
                 self.logfile_read.write (s)
                 self.logfile_read.flush()
+            if self.transcript is not None:
+                self.transcript.record_read(s)
 
             return s
 
         raise ExceptionPexpect ('Reached an unexpected state in read_nonblocking().')
 
+    def _add_reader(self, loop, callback):
+
+        """INTERNAL: this makes the asyncio event 'loop' call 'callback' when
+        read_nonblocking() may have something to return. See read_async() in
+        pexpect_async. """
+
+        loop.add_reader(self.child_fd, callback)
+
+    def _remove_reader(self, loop):
+
+        """INTERNAL: this undoes _add_reader(). """
+
+        loop.remove_reader(self.child_fd)
+
+    def _add_writer(self, loop, callback):
+
+        """INTERNAL: this makes the asyncio event 'loop' call 'callback' when
+        the child can be written to, and returns True. A subclass that cannot
+        do this returns False, and then send_async() writes from a thread. """
+
+        loop.add_writer(self.child_fd, callback)
+        return True
+
+    def _remove_writer(self, loop):
+
+        """INTERNAL: this undoes _add_writer(). """
+
+        loop.remove_writer(self.child_fd)
+
+    def _set_output_waker(self, waker):
+
+        """INTERNAL: a child that has no file descriptor to select() on calls
+        'waker' when it has output, and returns True here. spawn returns False
+        and is waited on with its child_fd. See session_group. """
+
+        return False
+
     def read (self, size = -1):   # File-like object.
 
         """This reads at most "size" bytes from the file (less if the read hits
         EOF before obtaining size bytes). If the size argument is negative or
         omitted, read all data until EOF is reached. The bytes are returned as
         a string object. An empty string is returned when EOF is encountered
-        immediately. """
+        immediately.
+
+        The bytes are taken directly from the read buffer, so read() with a
+        size does not set 'before', 'after' and 'match'. If 'delimiter' was
+        changed from EOF, expect() is used to stop at the delimiter. """
 
         if size == 0:
-            return ''
+            return self._empty
         if size < 0:
             self.expect (self.delimiter) # delimiter default is EOF
             return self.before
+        if self.delimiter is EOF:
+            return self._read_size(size)
 
         # I could have done this more directly by not using expect(), but
         # I deliberately decided to couple read() to expect() so that
@@ -865,12 +1404,50 @@ class spawn (object):
         # worry about if I have to later modify read() or expect().
         # Note, it's OK if size==-1 in the regex. That just means it
         # will never match anything in which case we stop only on EOF.
-        cre = re.compile('.{%d}' % size, re.DOTALL)
+        cre = re.compile(_like(self._empty, '.{%d}' % size), re.DOTALL)
         index = self.expect ([cre, self.delimiter]) # delimiter default is EOF
         if index == 0:
             return self.after ### self.before should be ''. Should I assert this?
         return self.before
 
+    def readinto (self, b):   # File-like object.
+
+        """This reads up to len(b) bytes into 'b', a writable buffer such as a
+        bytearray, and returns the number of bytes read. It is like read(),
+        and returns 0 at EOF. """
+
+        data = self.read(len(b))
+        if not isinstance(data, bytes):
+            data = data.encode('ascii')
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def _read_size (self, size, timeout = -1):
+
+        """INTERNAL: this reads until there are 'size' bytes in the buffer or
+        EOF is read, and then removes and returns up to 'size' bytes from the
+        front of the buffer. TIMEOUT is raised like by expect(); the data that
+        was read stays in the buffer. """
+
+        self._unread_lines()
+        if timeout == -1:
+            timeout = self.timeout
+        if timeout is not None:
+            end_time = time.time() + timeout
+        incoming = self._buffer
+        while len(incoming) < size:
+            if timeout is not None and timeout < 0:
+                raise TIMEOUT ('Timeout exceeded in read().')
+            try:
+                c = self.read_nonblocking (self.maxread, timeout)
+            except EOF:
+                break
+            incoming.append(c)
+            if timeout is not None:
+                timeout = end_time - time.time()
+        return incoming.split(size).getvalue()
+
     def readline (self, size = -1):    # File-like object.
 
         """This reads and returns one entire line. A trailing newline is kept
@@ -880,13 +1457,28 @@ class spawn (object):
         you may expect you will receive the newline as \\r\\n. An empty string
         is returned when EOF is hit immediately. Currently, the size argument is
         mostly ignored, so this behavior is not standard for a file-like
-        object. If size is 0 then an empty string is returned. """
+        object. If size is 0 then an empty string is returned.
+
+        The line terminator can be changed with the 'lineterminator'
+        attribute, for example to '\\n'. Lines are split off the read buffer
+        directly, not with expect(), so readline() does not set 'before',
+        'after' and 'match'. If 'delimiter' was changed from EOF, expect() is
+        used to find the end of the line or the delimiter. """
 
         if size == 0:
-            return ''
-        index = self.expect (['\r\n', self.delimiter]) # delimiter default is EOF
+            return self._empty
+        if self.delimiter is EOF:
+            if self._linepos < len(self._lines) or self._read_lines(-1):
+                line = self._lines[self._linepos]
+                self._linepos += 1
+                return line
+            rest = self.buffer
+            self.buffer = self._empty
+            return rest
+        crlf = _like(self._empty, self.lineterminator)
+        index = self.expect ([crlf, self.delimiter]) # delimiter default is EOF
         if index == 0:
-            return self.before + '\r\n'
+            return self.before + crlf
         else:
             return self.before
 
@@ -903,7 +1495,7 @@ class spawn (object):
         """
 
         result = self.readline()
-        if result == "":
+        if not result:
             raise StopIteration
         return result
 
@@ -913,12 +1505,120 @@ class spawn (object):
         the lines thus read. The optional "sizehint" argument is ignored. """
 
         lines = []
+        for batch in self.iterlines(batch=1000):
+            lines.extend(batch)
+        return lines
+
+    def iterlines (self, batch=None, timeout=-1):
+
+        """This returns a generator over the lines of the child's output,
+        until EOF. It is like iterating over the spawn object, but faster. The
+        lines end in 'lineterminator', except maybe the last one. If 'batch' is
+        given, the generator produces lists of at most that many lines, with
+        all the lines that have been read so far, which avoids a Python level
+        call for every line::
+
+            for lines in child.iterlines(batch=1000):
+                for line in lines:
+                    ...
+
+        The timeout applies to every read from the child. TIMEOUT is raised
+        like with readline(); the data that was read stays in the buffer. """
+
         while True:
-            line = self.readline()
-            if not line:
+            if self.delimiter is not EOF:
+                line = self.readline()
+                if not line:
+                    return
+                lines = [line]
+            elif self._linepos < len(self._lines) or self._read_lines(timeout):
+                if batch is None:
+                    line = self._lines[self._linepos]
+                    self._linepos += 1
+                    yield line
+                    continue
+                lines = self._lines[self._linepos:self._linepos+batch]
+                self._linepos += len(lines)
+            else:
+                rest = self.buffer
+                self.buffer = self._empty
+                if not rest:
+                    return
+                lines = [rest]
+            if batch is None:
+                yield lines[0]
+            else:
+                yield lines
+
+    def iterlines_async (self, batch=None, timeout=-1):
+
+        """This is iterlines() for asyncio (Python 3.5 and later only). It
+        returns an asynchronous iterator that produces the same lines, or
+        lists of lines, without blocking the event loop::
+
+            async for line in child.iterlines_async():
+                ...
+        """
+
+        import pexpect_async
+        return pexpect_async.line_iterator(self, batch, timeout)
+
+    def _read_lines (self, timeout):
+
+        """INTERNAL: this reads from the child until there is at least one
+        complete line in the buffer, and then splits all complete lines off
+        into self._lines. This returns False if EOF was read first. """
+
+        self._run_steps(self._read_lines_steps(timeout))
+        return self._linepos < len(self._lines)
+
+    def _read_lines_steps (self, timeout):
+
+        """INTERNAL: this is the body of _read_lines(), as a generator that is
+        driven by _run_steps(). """
+
+        terminator = _like(self._empty, self.lineterminator)
+        if timeout == -1:
+            timeout = self.timeout
+        if timeout is not None:
+            end_time = time.time() + timeout
+        incoming = self._buffer
+        # Only the data after 'scanned' needs to be looked at for the
+        # terminator, plus the overlap for a terminator split over reads.
+        scanned = 0
+        while True:
+            data, base = incoming.window(scanned - len(terminator) + 1)
+            if data.find(terminator) >= 0:
                 break
-            lines.append(line)
-        return lines
+            scanned = len(incoming)
+            if timeout is not None and timeout < 0:
+                raise TIMEOUT ('Timeout exceeded in readline().')
+            try:
+                c = (yield timeout)
+            except EOF:
+                return
+            incoming.append(c)
+            if timeout is not None:
+                timeout = end_time - time.time()
+        lines = incoming.getvalue().split(terminator)
+        self._buffer = expect_buffer(lines.pop())
+        self._lines = [line + terminator for line in lines]
+        self._linepos = 0
+
+    def _unread_lines (self):
+
+        """INTERNAL: this puts the lines that were split off by _read_lines()
+        but not returned yet back at the front of the buffer. """
+
+        if self._linepos < len(self._lines):
+            incoming = expect_buffer(self._empty)
+            for line in self._lines[self._linepos:]:
+                incoming.append(line)
+            for chunk in self._buffer._chunks:
+                incoming.append(chunk)
+            self._buffer = incoming
+        self._lines = []
+        self._linepos = 0
 
     def write(self, s):   # File-like object.
 
@@ -943,23 +1643,68 @@ class spawn (object):
         bytes written. If a log file was set then the data is also written to
         the log. """
 
-        time.sleep(self.delaybeforesend)
+        if self.delaybeforesend:
+            time.sleep(self.delaybeforesend)
+        return self._write(s)
+
+    def send_async(self, s):
+
+        """This is send() for asyncio (Python 3.5 and later only). It returns
+        an awaitable that waits until the child can be written to, and that
+        sleeps for delaybeforesend without blocking the event loop::
+
+            await child.send_async('ls -l\n')
+        """
+
+        import pexpect_async
+        return pexpect_async.send_async(self, s)
+
+    def _write(self, s):
+
+        """INTERNAL: this is send() without the delaybeforesend. """
+
         if self.logfile is not None:
             self.logfile.write (s)
             self.logfile.flush()
         if self.logfile_send is not None:
             self.logfile_send.write (s)
             self.logfile_send.flush()
-        c = os.write(self.child_fd, s.encode('ascii'))
+        if self.transcript is not None:
+            self.transcript.record_send(s)
+        c = os.write(self.child_fd, self._encode(s))
         return c
 
+    def _encode(self, s):
+
+        """INTERNAL: this converts a string that is sent to the child to bytes.
+        In binary mode 's' already is bytes. """
+
+        if self.binary:
+            return s
+        return s.encode('ascii')
+
+    def _decode(self, data):
+
+        """INTERNAL: this converts bytes that were read from the child to a
+        string. In binary mode, and on Python 2 where text is bytes, the data
+        is returned as is. """
+
+        if self.binary or bytes is str:
+            return data
+        return data.decode('ascii')
+
     def sendline(self, s=''):
 
         """This is like send(), but it adds a line feed (os.linesep). This
         returns the number of bytes written. """
 
+        linesep = os.linesep
+        if self.binary:
+            linesep = _linesep_bytes
+        if self.lowlatency:
+            return self.send(s + linesep)
         n = self.send(s)
-        n = n + self.send (os.linesep)
+        n = n + self.send (linesep)
         return n
 
     def sendcontrol(self, char):
@@ -976,7 +1721,7 @@ class spawn (object):
         a = ord(char)
         if a>=97 and a<=122:
             a = a - ord('a') + 1
-            return self.send (chr(a))
+            return self.send (_like(self._empty, chr(a)))
         d = {'@':0, '`':0,
             '[':27, '{':27,
             '\\':28, '|':28,
@@ -986,7 +1731,7 @@ class spawn (object):
             '?':127}
         if char not in d:
             return 0
-        return self.send (chr(d[char]))
+        return self.send (_like(self._empty, chr(d[char])))
 
     def sendeof(self):
 
@@ -1019,7 +1764,7 @@ class spawn (object):
             char = termios.tcgetattr(self.child_fd)[6][termios.VEOF]
         else:
             # platform does not define VEOF so assume CTRL-D
-            char = chr(4)
+            char = _like(self._empty, chr(4))
         self.send(char)
 
     def sendintr(self):
@@ -1031,7 +1776,7 @@ class spawn (object):
             char = termios.tcgetattr(self.child_fd)[6][termios.VINTR]
         else:
             # platform does not define VINTR so assume CTRL-C
-            char = chr(3)
+            char = _like(self._empty, chr(3))
         self.send (char)
 
     def eof (self):
@@ -1048,6 +1793,7 @@ class spawn (object):
         returns True if the child was terminated. This returns False if the
         child could not be terminated. """
 
+        self._sync_logs()
         if not self.isalive():
             return True
         try:
@@ -1217,7 +1963,7 @@ class spawn (object):
             compile_flags = compile_flags | re.IGNORECASE
         compiled_pattern_list = []
         for p in patterns:
-            if type(p) in types.StringTypes:
+            if type(p) in _string_types:
                 compiled_pattern_list.append(re.compile(p, compile_flags))
             elif p is EOF:
                 compiled_pattern_list.append(EOF)
@@ -1230,7 +1976,7 @@ class spawn (object):
 
         return compiled_pattern_list
 
-    def expect(self, pattern, timeout = -1, searchwindowsize=None):
+    def expect(self, pattern, timeout = -1, searchwindowsize=None, maxwidths=None, before_sink=-1):
 
         """This seeks through the stream until a pattern is matched. The
         pattern is overloaded and may take several types. The pattern can be a
@@ -1304,13 +2050,33 @@ class spawn (object):
                 p.expect (pexpect.EOF)
                 print p.before
 
+        After each read only the new data, plus enough of the old data to hold
+        the longest possible match, is searched. Pexpect works out that length
+        from the pattern itself, but for patterns with an unbounded length
+        such as 'ERROR.*\\r\\n' it has to search the whole buffer (or the
+        searchwindowsize) again. If you know better, pass 'maxwidths': a list
+        with the maximum match length of each pattern (or None), or a single
+        number if 'pattern' is not a list. For example::
+
+                p.expect (['ERROR.*\\r\\n', 'DONE'], maxwidths=[200, None])
+
+        If you wait for a pattern after a lot of output, all of it is kept in
+        memory to end up in 'before'. Pass 'before_sink' to avoid that: a
+        callable or a file-like object with a write() method. Data that can
+        no longer be part of a match is passed to it as it arrives, and
+        'before' only holds what is left. This only works for patterns with a
+        bounded length (see 'maxwidths'), or with a searchwindowsize. If
+        before_sink is -1 the self.before_sink value is used. For example::
+
+                p.expect ('BUILD DONE', before_sink=open('build.log', 'w'))
+
         If you are trying to optimize for speed then see expect_list().
         """
 
-        compiled_pattern_list = self.compile_pattern_list(pattern)
-        return self.expect_list(compiled_pattern_list, timeout, searchwindowsize)
+        key, searcher = self._checkout_searcher('re', pattern, maxwidths)
+        return self._expect_searcher(key, searcher, timeout, searchwindowsize, before_sink)
 
-    def expect_list(self, pattern_list, timeout = -1, searchwindowsize = -1):
+    def expect_list(self, pattern_list, timeout = -1, searchwindowsize = -1, maxwidths = None, before_sink = -1):
 
         """This takes a list of compiled regular expressions and returns the
         index into the pattern_list that matched the child output. The list may
@@ -1320,11 +2086,13 @@ class spawn (object):
         may help if you are trying to optimize for speed, otherwise just use
         the expect() method.  This is called by expect(). If timeout==-1 then
         the self.timeout value is used. If searchwindowsize==-1 then the
-        self.searchwindowsize value is used. """
+        self.searchwindowsize value is used. See expect() for 'maxwidths' and
+        'before_sink'. """
 
-        return self.expect_loop(searcher_re(pattern_list), timeout, searchwindowsize)
+        key, searcher = self._checkout_searcher('list', pattern_list, maxwidths)
+        return self._expect_searcher(key, searcher, timeout, searchwindowsize, before_sink)
 
-    def expect_exact(self, pattern_list, timeout = -1, searchwindowsize = -1):
+    def expect_exact(self, pattern_list, timeout = -1, searchwindowsize = -1, before_sink = -1):
 
         """This is similar to expect(), but uses plain string matching instead
         of compiled regular expressions in 'pattern_list'. The 'pattern_list'
@@ -1336,13 +2104,100 @@ class spawn (object):
         search to just the end of the input buffer.
 
         This method is also useful when you don't want to have to worry about
-        escaping regular expression characters that you want to match."""
+        escaping regular expression characters that you want to match. See
+        expect() for 'before_sink'."""
+
+        key, searcher = self._checkout_searcher('exact', pattern_list)
+        return self._expect_searcher(key, searcher, timeout, searchwindowsize, before_sink)
+
+    def expect_async(self, pattern, timeout = -1, searchwindowsize=None, maxwidths=None, before_sink=-1):
+
+        """This is expect() for asyncio (Python 3.5 and later only). It
+        returns an awaitable that waits for the pattern without blocking the
+        event loop::
+
+            index = await child.expect_async (['password:', pexpect.EOF])
+
+        The arguments, return value and exceptions are those of expect(), and
+        'before', 'after' and 'match' are set in the same way. Like with the
+        blocking calls, only one coroutine at a time should read from a
+        child. """
+
+        import pexpect_async
+        return pexpect_async.expect_async(self, 're', pattern, timeout,
+                searchwindowsize, maxwidths, before_sink)
+
+    def expect_exact_async(self, pattern_list, timeout = -1, searchwindowsize = -1, before_sink = -1):
+
+        """This is expect_exact() for asyncio. See expect_async(). """
+
+        import pexpect_async
+        return pexpect_async.expect_async(self, 'exact', pattern_list, timeout,
+                searchwindowsize, None, before_sink)
+
+    def _checkout_searcher(self, kind, patterns, maxwidths=None):
+
+        """This returns the key and the searcher for 'patterns', as passed to
+        expect() ('re'), expect_list() ('list') or expect_exact() ('exact').
+        The searcher is taken from the searcher cache if it is there, and it
+        should be put back with _expect_searcher(). """
+
+        if kind == 'exact':
+            if type(patterns) in _string_types or patterns in (TIMEOUT, EOF):
+                patterns = [patterns]
+        elif kind == 're' and maxwidths is not None \
+                and type(patterns) is not types.ListType:
+            maxwidths = [maxwidths]
+        key = self._searcher_key(kind, patterns, maxwidths)
+        searcher = None
+        if key is not None and self.searchercache is not None:
+            searcher = self.searchercache.checkout(key)
+        if searcher is None:
+            if kind == 're':
+                searcher = searcher_re(self.compile_pattern_list(patterns),
+                                       maxwidths, self.combinepatterns)
+            elif kind == 'list':
+                searcher = searcher_re(patterns, maxwidths, self.combinepatterns)
+            else:
+                searcher = searcher_string(patterns)
+        return key, searcher
+
+    def _searcher_key(self, kind, patterns, maxwidths=None):
+
+        """This returns the key under which the searcher for 'patterns' is
+        stored in the searcher cache, or None if the patterns cannot be used
+        as a key. """
+
+        if patterns is None:
+            patterns = []
+        elif type(patterns) in _string_types or patterns in (TIMEOUT, EOF) \
+                or not hasattr(patterns, '__len__'):
+            patterns = [patterns]
+        compile_flags = re.DOTALL
+        if self.ignorecase:
+            compile_flags = compile_flags | re.IGNORECASE
+        if maxwidths is not None:
+            maxwidths = tuple(maxwidths)
+        key = (kind, tuple([(type(p), p) for p in patterns]), compile_flags,
+               maxwidths, self.combinepatterns)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
-        if type(pattern_list) in types.StringTypes or pattern_list in (TIMEOUT, EOF):
-            pattern_list = [pattern_list]
-        return self.expect_loop(searcher_string(pattern_list), timeout, searchwindowsize)
+    def _expect_searcher(self, key, searcher, timeout, searchwindowsize, before_sink=-1):
 
-    def expect_loop(self, searcher, timeout = -1, searchwindowsize = -1):
+        """This runs expect_loop() with 'searcher' and afterwards puts the
+        searcher in the searcher cache under 'key'. """
+
+        try:
+            return self.expect_loop(searcher, timeout, searchwindowsize, before_sink)
+        finally:
+            if key is not None and self.searchercache is not None:
+                self.searchercache.checkin(key, searcher)
+
+    def expect_loop(self, searcher, timeout = -1, searchwindowsize = -1, before_sink = -1):
 
         """This is the common loop used inside expect. The 'searcher' should be
         an instance of searcher_re or searcher_string, which describes how and what
@@ -1350,6 +2205,38 @@ class spawn (object):
 
         See expect() for other arguments, return value and exceptions. """
 
+        steps = self._expect_steps(searcher, timeout, searchwindowsize, before_sink)
+        self._run_steps(steps, not self.lowlatency)
+        return self.match_index
+
+    def _run_steps(self, steps, pause=False):
+
+        """INTERNAL: this drives a generator such as _expect_steps() with
+        read_nonblocking(). The generator yields the timeout for the next read
+        and is sent the data that was read, or gets the exception that the
+        read raised thrown into it. If 'pause' is set this sleeps a little
+        after each read. expect_async() drives the same generators from an
+        asyncio event loop. """
+
+        try:
+            timeout = steps.next()
+            while True:
+                try:
+                    c = self.read_nonblocking (self.maxread, timeout)
+                except:
+                    timeout = steps.throw(*sys.exc_info())
+                else:
+                    if pause:
+                        time.sleep (0.0001)
+                    timeout = steps.send(c)
+        except StopIteration:
+            pass
+
+    def _expect_steps(self, searcher, timeout, searchwindowsize, before_sink):
+
+        """INTERNAL: this is the body of expect_loop(), as a generator that is
+        driven by _run_steps(). It stops once self.match_index is set. """
+
         self.searcher = searcher
 
         if timeout == -1:
@@ -1358,62 +2245,131 @@ class spawn (object):
             end_time = time.time() + timeout 
         if searchwindowsize == -1:
             searchwindowsize = self.searchwindowsize
-
+        if before_sink == -1:
+            before_sink = self.before_sink
+        if hasattr(before_sink, 'write'):
+            before_sink = before_sink.write
+        if not hasattr(searcher, 'discardable'):
+            before_sink = None
+
+        self._unread_lines()
+        head = None # Set aside by the 'headtail' maxbuffer policy.
+        trimmed = False
         try:
-            incoming = self.buffer
+            incoming = self._buffer
             freshlen = len(incoming)
             while True: # Keep reading until exception or return.
                 index = searcher.search(incoming, freshlen, searchwindowsize)
                 if index >= 0:
-                    self.buffer = incoming[searcher.end : ]
-                    self.before = incoming[ : searcher.start]
-                    self.after = incoming[searcher.start : searcher.end]
+                    # Split the buffer in place; the strings are only built
+                    # when somebody asks for them.
+                    self.before = self._with_head(head,
+                                                  incoming.split(searcher.start))
+                    self.after = incoming.split(searcher.end - searcher.start)
                     self.match = searcher.match
                     self.match_index = index
-                    return self.match_index
+                    return
                 # No match at this point
+                if before_sink is not None:
+                    n = searcher.discardable(len(incoming), searchwindowsize)
+                    if n > 0:
+                        for chunk in incoming.split(n)._chunks:
+                            before_sink(chunk)
+                # The maxbuffer policy is applied to data that was searched,
+                # so that a match in the chunk that was just read is found.
+                if self.maxbuffer is not None and \
+                        len(incoming) + len(head or ()) > self.maxbuffer:
+                    head = self._trim_buffer(incoming, head, searcher,
+                                             freshlen, searchwindowsize)
+                    trimmed = True
                 if timeout < 0 and timeout is not None:
                     raise TIMEOUT ('Timeout exceeded in expect_any().')
                 # Still have time left, so read more data
-                c = self.read_nonblocking (self.maxread, timeout)
-                freshlen = len(c)
-                time.sleep (0.0001)
-                incoming = incoming + c
+                c = (yield timeout)
+                incoming.append(c)
+                if trimmed:
+                    # The offsets have changed, so search everything again.
+                    freshlen = len(incoming)
+                    trimmed = False
+                else:
+                    freshlen = len(c)
                 if timeout is not None:
                     timeout = end_time - time.time()
         except EOF, e:
-            self.buffer = ''
-            self.before = incoming
+            self.buffer = self._empty
+            self.before = self._with_head(head, incoming)
             self.after = EOF
             index = searcher.eof_index
             if index >= 0:
                 self.match = EOF
                 self.match_index = index
-                return self.match_index
+                return
             else:
                 self.match = None
                 self.match_index = None
                 raise EOF (str(e) + '\n' + str(self))
         except TIMEOUT, e:
-            self.buffer = incoming
-            self.before = incoming
+            self.before = self._with_head(head, incoming.copy())
             self.after = TIMEOUT
             index = searcher.timeout_index
             if index >= 0:
                 self.match = TIMEOUT
                 self.match_index = index
-                return self.match_index
+                return
             else:
                 self.match = None
                 self.match_index = None
                 raise TIMEOUT (str(e) + '\n' + str(self))
         except:
-            self.before = incoming
+            self.before = self._with_head(head, incoming.copy())
             self.after = None
             self.match = None
             self.match_index = None
             raise
 
+    def _trim_buffer(self, incoming, head, searcher, freshlen, searchwindowsize):
+
+        """INTERNAL: this applies the maxbuffer policy to 'incoming', the read
+        buffer of expect_loop(), when it has grown past maxbuffer and has been
+        searched without a match. The last 'freshlen' bytes, which were just
+        read, are always kept, with the bytes in front of them that a match
+        of 'searcher' that continues in the next chunk could start in. This
+        returns the head that was set aside, or None. """
+
+        policy = self.maxbufferpolicy
+        if policy == 'raise':
+            raise MAXBUFFER ('Read buffer exceeded maxbuffer (%d bytes) in expect().' % self.maxbuffer)
+        if policy == 'headtail':
+            keep = self.maxbuffer // 4
+        elif policy == 'window':
+            keep = self.maxbuffer // 2
+        else:
+            raise ValueError ('Unknown maxbufferpolicy: %r' % (policy,))
+        if searchwindowsize is not None:
+            keep = min(keep, searchwindowsize)
+        buflen = len(incoming)
+        needed = freshlen
+        if hasattr(searcher, 'discardable'):
+            # This is 0 for patterns of unbounded length; those are cut.
+            n = searcher.discardable(buflen, searchwindowsize)
+            if n > 0:
+                needed = max(needed, buflen - n)
+        keep = min(max(keep, needed), buflen)
+        if policy == 'headtail' and head is None:
+            head = incoming.split(min(self.maxbuffer // 2, buflen - keep))
+        incoming.split(len(incoming) - keep)
+        return head
+
+    def _with_head(self, head, buf):
+
+        """INTERNAL: this returns the expect_buffer 'buf' preceded by 'head',
+        the data set aside by the 'headtail' maxbuffer policy. """
+
+        if head is None:
+            return buf
+        head.extend(buf)
+        return head
+
     def getwinsize(self):
 
         """This returns the terminal window size of the child tty. The return
@@ -1483,9 +2439,14 @@ class spawn (object):
         """
 
         # Flush the buffer.
-        self.stdout.write (self.buffer)
-        self.stdout.flush()
-        self.buffer = ''
+        if self.binary:
+            os.write(self.STDOUT_FILENO, self.buffer)
+        else:
+            self.stdout.write (self.buffer)
+            self.stdout.flush()
+        self.buffer = self._empty
+        if self.binary and not isinstance(escape_character, bytes):
+            escape_character = escape_character.encode('ascii')
         mode = tty.tcgetattr(self.STDIN_FILENO)
         tty.setraw(self.STDIN_FILENO)
         try:
@@ -1498,8 +2459,9 @@ class spawn (object):
         """This is used by the interact() method.
         """
 
-        while data != '' and self.isalive():
-            n = os.write(fd, data.encode('ascii'))
+        data = self._encode(data)
+        while data and self.isalive():
+            n = os.write(fd, data)
             data = data[n:]
 
     def __interact_read(self, fd):
@@ -1507,7 +2469,7 @@ class spawn (object):
         """This is used by the interact() method.
         """
 
-        return os.read(fd, 1000)
+        return self._decode(os.read(fd, 1000))
 
     def __interact_copy(self, escape_character = None, input_filter = None, output_filter = None):
 
@@ -1522,7 +2484,7 @@ class spawn (object):
                 if self.logfile is not None:
                     self.logfile.write (data)
                     self.logfile.flush()
-                os.write(self.STDOUT_FILENO, data.encode('ascii'))
+                os.write(self.STDOUT_FILENO, self._encode(data))
             if self.STDIN_FILENO in r:
                 data = self.__interact_read(self.STDIN_FILENO)
                 if input_filter: data = input_filter(data)
@@ -1578,10 +2540,793 @@ class spawn (object):
 # End of spawn class
 ##############################################################################
 
+class session_group (object):
+
+    """This waits for many children at once. Each child is added with its own
+    patterns and timeout, and expect() returns the first child that matches,
+    without polling them one by one::
+
+        group = session_group()
+        for child in children:
+            group.add (child, ['\\$ ', pexpect.EOF], timeout=60)
+        while len(group):
+            child, index = group.expect()
+            ...
+
+    The children of a group are waited on together, with one poll() on their
+    file descriptors. A winspawn child has no file descriptor; its reader
+    threads mark the child ready and notify a condition of the group
+    instead, which the group waits on without polling. A group cannot hold
+    both kinds. While a child is in a group, do not read
+    from it in any other way. """
+
+    def __init__(self):
+
+        self._sessions = []
+        self._ready = []            # Children with output, for winspawn.
+        self._readable = threading.Condition(threading.Lock())
+        self._fds = {}              # The children by child_fd, for spawn.
+        self._poll = None
+        self.session = None
+
+    def __len__(self):
+
+        return len(self._sessions)
+
+    def add(self, child, pattern, timeout = -1, searchwindowsize = None, maxwidths = None, exact = False):
+
+        """This starts to wait for 'pattern' from 'child'. The pattern and the
+        other arguments are those of expect(), or of expect_exact() if 'exact'
+        is set. A timeout of -1 uses the child's own timeout. If the buffer of
+        the child already matches, the next expect() returns it right away.
+        A child can only be added once. """
+
+        for session in self._sessions:
+            if session.child is child:
+                raise ValueError ('The child is already in the session group.')
+        if child._set_output_waker(lambda: self._wake(child)):
+            fd = None
+        else:
+            fd = child.child_fd
+        if self._sessions and (fd is None) != (self._sessions[0].fd is None):
+            if fd is None:
+                child._set_output_waker(None)
+            raise ValueError ('Cannot wait for spawn and winspawn children in one session group.')
+        if fd is not None:
+            self._fds[fd] = child
+            if hasattr(select, 'poll'):
+                if self._poll is None:
+                    self._poll = select.poll()
+                self._poll.register(fd, select.POLLIN)
+        if exact:
+            key, searcher = child._checkout_searcher('exact', pattern)
+        else:
+            key, searcher = child._checkout_searcher('re', pattern, maxwidths)
+        session = _group_session(child, fd, key, searcher)
+        session.steps = child._expect_steps(searcher, timeout, searchwindowsize, -1)
+        self._sessions.append(session)
+        try:
+            session.done = self._advance(session, session.steps.next)
+            if not session.done:
+                self._feed(session, time.time())
+        except:
+            self._finish(session)
+            self.session = child
+            raise
+
+    def remove(self, child):
+
+        """This stops waiting for 'child'. Its expect is interrupted: 'before'
+        is set to the data read so far, which stays in the buffer. """
+
+        for session in self._sessions:
+            if session.child is child:
+                session.steps.close()
+                self._finish(session)
+                return
+        raise ValueError ('The child is not in the session group.')
+
+    def close(self):
+
+        """This removes all children from the group. """
+
+        while self._sessions:
+            self.remove(self._sessions[0].child)
+
+    def expect(self, timeout = None):
+
+        """This waits until one of the children matches its pattern, removes
+        it from the group, and returns the child and the index of the pattern
+        that matched. 'before', 'after' and 'match' of the child are set like
+        expect() does. Add the child again to wait for it some more.
+
+        If a child raises an exception, for example EOF or TIMEOUT because
+        these were not in its patterns, it is removed from the group as well.
+        The exception is raised from here and the child is left in the
+        'session' attribute. If 'timeout' is given and no child matches in
+        that many seconds, TIMEOUT is raised and the group is unchanged. """
+
+        if not self._sessions:
+            raise ValueError ('The session group is empty.')
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while True:
+            for session in self._sessions:
+                if session.done:
+                    self._finish(session)
+                    self.session = session.child
+                    return session.child, session.child.match_index
+            now = time.time()
+            wait = None
+            for session in self._sessions:
+                if session.deadline is not None:
+                    if wait is None or session.deadline - now < wait:
+                        wait = max(0, session.deadline - now)
+            if timeout is not None:
+                if end_time <= now:
+                    raise TIMEOUT ('Timeout exceeded in session_group.expect().')
+                if wait is None or end_time - now < wait:
+                    wait = end_time - now
+            ready = self._wait(wait)
+            now = time.time()
+            for session in self._sessions[:]:
+                if session.child in ready or (session.deadline is not None
+                                              and session.deadline <= now):
+                    try:
+                        self._feed(session, now)
+                    except:
+                        # The children that were not fed yet must not lose
+                        # their wake-up.
+                        if session.fd is None:
+                            for child in ready:
+                                self._wake(child)
+                        raise
+
+    def _feed(self, session, now):
+
+        """INTERNAL: this passes everything that the child of 'session' has
+        to read right now to its expect generator, or the TIMEOUT if its time
+        is up. """
+
+        child = session.child
+        try:
+            while not session.done:
+                try:
+                    data = child.read_nonblocking (child.maxread, 0)
+                except TIMEOUT:
+                    if session.deadline is None or now < session.deadline:
+                        return
+                    session.done = self._advance(session, session.steps.throw, *sys.exc_info())
+                except:
+                    session.done = self._advance(session, session.steps.throw, *sys.exc_info())
+                else:
+                    session.done = self._advance(session, session.steps.send, data)
+        except:
+            self._finish(session)
+            self.session = child
+            raise
+
+    def _advance(self, session, step, *args):
+
+        """INTERNAL: this runs the expect generator of 'session' up to the
+        next read and returns True if it is finished. """
+
+        try:
+            timeout = step(*args)
+        except StopIteration:
+            return True
+        if timeout is None:
+            session.deadline = None
+        else:
+            session.deadline = time.time() + timeout
+        return False
+
+    def _wait(self, timeout):
+
+        """INTERNAL: this waits at most 'timeout' seconds, or forever if it is
+        None, for output of any child and returns the children that have
+        some. """
+
+        if self._sessions[0].fd is None:
+            # Only winspawn children get here, so winpexpect_io is there.
+            import winpexpect_io
+            if timeout is not None:
+                end_time = time.time() + timeout
+            self._readable.acquire()
+            try:
+                while not self._ready:
+                    if timeout is None:
+                        self._readable.wait()
+                    elif end_time <= time.time():
+                        break
+                    else:
+                        winpexpect_io.timed_wait(self._readable, end_time)
+                ready = self._ready
+                self._ready = []
+            finally:
+                self._readable.release()
+            return ready
+        if self._poll is not None:
+            if timeout is not None:
+                timeout = int(timeout * 1000 + 0.999)
+            while True:
+                try:
+                    events = self._poll.poll(timeout)
+                    break
+                except select.error, e:
+                    if e[0] != errno.EINTR:
+                        raise
+            return [self._fds[fd] for fd, event in events]
+        while True:
+            try:
+                r, w, e = select.select(self._fds.keys(), [], [], timeout)
+                break
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+        return [self._fds[fd] for fd in r]
+
+    def _wake(self, child):
+
+        """INTERNAL: this is the output waker of a winspawn child. The reader
+        threads of the child call it when they have queued output. """
+
+        self._readable.acquire()
+        try:
+            self._ready.append(child)
+            self._readable.notify()
+        finally:
+            self._readable.release()
+
+    def _finish(self, session):
+
+        """INTERNAL: this takes 'session' out of the group and puts its
+        searcher back in the searcher cache. """
+
+        child = session.child
+        self._sessions.remove(session)
+        if session.fd is None:
+            child._set_output_waker(None)
+        else:
+            del self._fds[session.fd]
+            if self._poll is not None:
+                self._poll.unregister(session.fd)
+        if session.key is not None and child.searchercache is not None:
+            child.searchercache.checkin(session.key, session.searcher)
+
+class _group_session (object):
+
+    """INTERNAL: this is a child that is waited for by a session_group. """
+
+    def __init__(self, child, fd, key, searcher):
+
+        self.child = child
+        self.fd = fd            # None if the child has an output waker.
+        self.key = key
+        self.searcher = searcher
+        self.steps = None
+        self.deadline = None
+        self.done = False
+
+def expect_any (children, pattern, timeout = -1, searchwindowsize = None, maxwidths = None):
+
+    """This waits until any of 'children' matches 'pattern' and returns the
+    child and the index of the pattern that matched. The arguments are those
+    of expect(); each child has its own timeout. For example::
+
+        child, index = pexpect.expect_any (children, ['done', pexpect.EOF])
+
+    The other children are left as if their expect() was interrupted:
+    'before' is set to what they read, which stays in their buffer. To keep
+    waiting for them, use a session_group. """
+
+    group = session_group()
+    try:
+        for child in children:
+            group.add(child, pattern, timeout, searchwindowsize, maxwidths)
+        return group.expect()
+    finally:
+        group.close()
+
+class spawn_pool (object):
+
+    """This keeps a number of idle children of one command started, so that
+    a child can be taken from the pool when it is needed instead of waiting
+    for it to start up. This pays off for short tasks in a shell or a REPL,
+    when starting the child takes longer than the task::
+
+        pool = spawn_pool ('python', ['-i'], size=4,
+                           setup=lambda child: child.expect ('>>> '))
+        child = pool.checkout()
+        child.sendline ('1 + 1')
+        child.expect ('>>> ')
+        pool.checkin (child)
+
+    The children are made with 'factory', spawn by default, which is called
+    with 'command', 'args' and the other keyword arguments. Pass
+    factory=winpexpect.winspawn for Windows. 'setup' is called with every
+    new child, for example to wait for its prompt. A thread of the pool
+    starts new children in the background, whenever there are less than
+    'size' idle ones; every 'checkinterval' seconds it also replaces the idle
+    children that died.
+
+    checkout() returns an idle child that passes 'healthcheck', by default
+    isalive(), or if there is none it starts one. checkin() returns a child
+    to the pool after 'reset' is called with it; if that returns False or
+    raises an exception, or if the pool is full, the child is closed.
+
+    The attributes 'hits' and 'misses' count the checkouts that did and
+    did not find an idle child, 'discarded' counts the children that were
+    closed because they were dead or failed a reset, and 'spawns' and
+    'spawntime' count the children that were started and the seconds that
+    took. See also 'hit_rate' and 'saved'. """
+
+    def __init__(self, command, args = [], size = 4, factory = None, setup = None, reset = None, healthcheck = None, checkinterval = 5, **kwargs):
+
+        if factory is None:
+            factory = spawn
+        self.command = command
+        self.args = args
+        self.size = size
+        self.factory = factory
+        self.setup = setup
+        self.reset = reset
+        self.healthcheck = healthcheck
+        self.checkinterval = checkinterval
+        self.kwargs = kwargs
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.errors = 0
+        self.spawns = 0
+        self.spawntime = 0.0
+        self.closed = False
+        self._idle = []
+        self._starting = 0  # Children that are being started in the background.
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._refill)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def __len__(self):
+
+        return len(self._idle)
+
+    def _get_hit_rate(self):
+        if not self.hits:
+            return 0.0
+        return float(self.hits) / (self.hits + self.misses)
+
+    hit_rate = property(_get_hit_rate, doc = 'The part of the checkouts that found an idle child.')
+
+    def _get_saved(self):
+        if not self.spawns:
+            return 0.0
+        return self.hits * self.spawntime / self.spawns
+
+    saved = property(_get_saved, doc = 'The seconds of startup that checkouts did not wait for, by the mean startup time.')
+
+    def checkout(self):
+
+        """This takes an idle child from the pool and returns it, or starts a
+        new child if there is no idle one that passes the health check. The
+        child is the caller's until it is given to checkin(). """
+
+        if self.closed:
+            raise ValueError ('The spawn pool is closed.')
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._idle:
+                    self.misses += 1
+                    break
+                child = self._idle.pop(0)
+                self._changed.notify()
+            finally:
+                self._lock.release()
+            if self._healthy(child):
+                self._lock.acquire()
+                self.hits += 1
+                self._lock.release()
+                return child
+            self._discard(child)
+        return self._create()
+
+    def checkin(self, child):
+
+        """This gives 'child' back to the pool, to be returned by a later
+        checkout(). """
+
+        if not self.closed and child.isalive():
+            try:
+                ok = self.reset is None or self.reset(child) is not False
+            except (ExceptionPexpect, OSError, IOError):
+                ok = False
+            if ok:
+                self._lock.acquire()
+                try:
+                    if not self.closed and len(self._idle) < self.size:
+                        self._idle.append(child)
+                        return
+                finally:
+                    self._lock.release()
+                child.close()
+                return
+        self._discard(child)
+
+    def close(self):
+
+        """This stops the background thread and closes the idle children. The
+        children that are checked out are left alone. """
+
+        self._lock.acquire()
+        try:
+            self.closed = True
+            self._changed.notifyAll()
+        finally:
+            self._lock.release()
+        self._thread.join()
+        while self._idle:
+            self._idle.pop().close()
+
+    def _healthy(self, child):
+
+        """INTERNAL: this returns True if 'child' can be handed out. """
+
+        try:
+            if self.healthcheck is None:
+                return child.isalive()
+            return self.healthcheck(child)
+        except (ExceptionPexpect, OSError, IOError):
+            return False
+
+    def _discard(self, child):
+
+        """INTERNAL: this closes a child that cannot be used anymore. """
+
+        self._lock.acquire()
+        self.discarded += 1
+        self._lock.release()
+        try:
+            child.close()
+        except (ExceptionPexpect, OSError, IOError):
+            pass
+
+    def _create(self):
+
+        """INTERNAL: this starts a new child and runs the setup on it. """
+
+        start = time.time()
+        child = self.factory(self.command, self.args, **self.kwargs)
+        try:
+            if self.setup is not None:
+                self.setup(child)
+        except:
+            child.close()
+            raise
+        elapsed = time.time() - start
+        self._lock.acquire()
+        try:
+            self.spawns += 1
+            self.spawntime += elapsed
+        finally:
+            self._lock.release()
+        return child
+
+    def _refill(self):
+
+        """INTERNAL: this is the background thread that keeps the pool full. """
+
+        last_check = time.time()
+        while True:
+            self._lock.acquire()
+            try:
+                while not self.closed and len(self._idle) + self._starting >= self.size:
+                    wait = last_check + self.checkinterval - time.time()
+                    if wait <= 0:
+                        break
+                    self._changed.wait(wait)
+                if self.closed:
+                    return
+                idle = self._idle[:]
+            finally:
+                self._lock.release()
+            if time.time() >= last_check + self.checkinterval:
+                last_check = time.time()
+                self._sweep(idle)
+                continue
+            self._lock.acquire()
+            self._starting += 1
+            self._lock.release()
+            try:
+                child = self._create()
+            except Exception:
+                child = None
+            self._lock.acquire()
+            try:
+                self._starting -= 1
+                if child is None:
+                    self.errors += 1
+                elif not self.closed:
+                    self._idle.append(child)
+                    continue
+            finally:
+                self._lock.release()
+            if child is not None:
+                child.close()
+            else:
+                # Do not start a broken command again and again.
+                time.sleep(min(self.checkinterval, 1))
+
+    def _sweep(self, idle):
+
+        """INTERNAL: this closes the children in 'idle' that died. Each child
+        is taken out of the pool while it is probed, so that checkout() cannot
+        hand it out at the same time; two waitpid() calls on one child make
+        pexpect raise. """
+
+        for child in idle:
+            self._lock.acquire()
+            try:
+                if child not in self._idle:
+                    continue
+                self._idle.remove(child)
+            finally:
+                self._lock.release()
+            try:
+                alive = child.isalive()
+            except (ExceptionPexpect, OSError, IOError):
+                alive = False
+            if not alive:
+                self._discard(child)
+                continue
+            self._lock.acquire()
+            try:
+                if not self.closed and len(self._idle) < self.size:
+                    self._idle.append(child)
+                    continue
+            finally:
+                self._lock.release()
+            child.close()
+
+class log_writer (object):
+
+    """This is a logfile that writes in the background. spawn and winspawn
+    write and flush their logfiles for every chunk that they read or send;
+    with a lot of output those writes and flushes take much of the time. A
+    log_writer only queues the chunks, and a thread writes them to the file
+    in batches: after 'interval' seconds, or as soon as 'threshold' bytes
+    are queued::
+
+        child = pexpect.spawn('some_command')
+        child.logfile_read = pexpect.log_writer('output.log.gz', compress=True)
+
+    'file' is a path or a file-like object. A path is opened for appending.
+    With 'compress' the log is written with gzip. With 'maxbytes', which
+    needs a path, the log is rotated when the file grows past that many
+    bytes: the file becomes 'file.1', the one before 'file.2' and so on, up
+    to 'backups' old files.
+
+    flush() does nothing, so that the calls of spawn do not wait; sync()
+    waits until everything that was written is in the file. The close() and
+    terminate() methods of spawn and winspawn call sync(). close() of the
+    log_writer syncs it, stops the thread, and closes the file if it opened
+    it. An error in the thread stops it, and is raised by every write(),
+    sync() and close() after that.
+
+    The attributes 'nbytes', 'chunks', 'batches' and 'rotations' count
+    what was written and how often. """
+
+    def __init__(self, file, interval = 1.0, threshold = 65536, compress = False, maxbytes = None, backups = 1):
+
+        if type(file) in _string_types:
+            self.path = file
+        else:
+            self.path = None
+        if maxbytes is not None and self.path is None:
+            raise ValueError ('Rotation needs a path.')
+        self.file = file
+        self.interval = interval
+        self.threshold = threshold
+        self.compress = compress
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.nbytes = 0
+        self.chunks = 0
+        self.batches = 0
+        self.rotations = 0
+        self.closed = False
+        self.error = None
+        self._pending = collections.deque()
+        self._npending = 0  # The bytes in _pending.
+        self._written = 0   # The chunks that are in the file.
+        self._synced = 0    # The chunks that sync() waits for.
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._open()
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def write(self, s):
+
+        """This queues 's' to be written. The thread is only woken up when
+        'threshold' bytes are queued. """
+
+        self._lock.acquire()
+        try:
+            self._check()
+            if self.closed:
+                raise ValueError ('The log writer is closed.')
+            self._pending.append(s)
+            self.chunks += 1
+            self._npending += len(s)
+            if self._npending >= self.threshold:
+                self._changed.notifyAll()
+        finally:
+            self._lock.release()
+
+    def flush(self):
+
+        """This does nothing; see sync(). """
+
+        pass
+
+    def sync(self):
+
+        """This waits until all chunks that were written are in the file, and
+        the file is flushed. """
+
+        self._lock.acquire()
+        try:
+            target = self.chunks
+            # The thread checks _synced before it waits, so that it cannot
+            # miss the notify if it is busy writing now.
+            self._synced = max(self._synced, target)
+            self._changed.notifyAll()
+            while self._written < target and self.error is None and self._thread.is_alive():
+                self._changed.wait(self.interval)
+            self._check()
+        finally:
+            self._lock.release()
+
+    def close(self):
+
+        """This writes what is queued, stops the thread and closes the file.
+        Calling close() more than once is valid. """
+
+        self._lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            self._changed.notifyAll()
+        finally:
+            self._lock.release()
+        self._thread.join()
+        self._close()
+        self._lock.acquire()
+        try:
+            self._check()
+        finally:
+            self._lock.release()
+
+    def _check(self):
+
+        """INTERNAL: this raises the error of the thread. The error is kept,
+        because the thread has stopped and nothing is written anymore. """
+
+        if self.error is not None:
+            raise self.error
+
+    def _open(self):
+
+        """INTERNAL: this opens the file, or wraps the file object. """
+
+        if self.path is not None:
+            self.raw = open(self.path, 'ab')
+        else:
+            self.raw = self.file
+        if self.compress:
+            import gzip
+            self.stream = gzip.GzipFile(fileobj = self.raw, mode = 'wb')
+        else:
+            self.stream = self.raw
+
+    def _close(self):
+
+        """INTERNAL: this closes what _open() opened. """
+
+        if self.stream is not self.raw:
+            self.stream.close()
+        if self.path is not None:
+            self.raw.close()
+        else:
+            self.raw.flush()
+
+    def _encode(self, data):
+
+        """INTERNAL: files that the log_writer opens are binary. Text is
+        written as UTF-8. """
+
+        if (self.path is not None or self.compress) and not isinstance(data, bytes):
+            return data.encode('utf-8')
+        return data
+
+    def _rotate(self):
+
+        """INTERNAL: this moves the log out of the way and starts a new one. """
+
+        self._close()
+        for i in range(self.backups, 0, -1):
+            older = '%s.%d' % (self.path, i)
+            if i == 1:
+                newer = self.path
+            else:
+                newer = '%s.%d' % (self.path, i - 1)
+            if os.path.exists(older):
+                os.remove(older)
+            if os.path.exists(newer):
+                os.rename(newer, older)
+        if not self.backups:
+            os.remove(self.path)
+        self._open()
+        self.rotations += 1
+
+    def _writer(self):
+
+        """INTERNAL: this is the thread that writes the queued chunks. """
+
+        while True:
+            self._lock.acquire()
+            try:
+                if not self.closed and self._npending < self.threshold and self._synced <= self._written:
+                    self._changed.wait(self.interval)
+                closed = self.closed
+                chunks = list(self._pending)
+                self._pending.clear()
+                self._npending = 0
+            finally:
+                self._lock.release()
+            count = self._written + len(chunks)
+            try:
+                if chunks:
+                    data = self._encode(chunks[0][:0]).join([self._encode(chunk) for chunk in chunks])
+                    self.stream.write(data)
+                    self.stream.flush()
+                    self.nbytes += len(data)
+                    self.batches += 1
+                    if self.maxbytes is not None and os.fstat(self.raw.fileno()).st_size >= self.maxbytes:
+                        self._rotate()
+            except Exception, e:
+                self._lock.acquire()
+                self.error = e
+                self._changed.notifyAll()
+                self._lock.release()
+                return
+            self._lock.acquire()
+            try:
+                self._written = count
+                self._changed.notifyAll()
+            finally:
+                self._lock.release()
+            if closed:
+                return
+
 class searcher_string (object):
 
     """This is a plain string search helper for the spawn.expect_any() method.
 
+    A few strings are searched for with one find() each. From
+    'automaton_threshold' strings on, they are compiled into a single
+    Aho-Corasick automaton instead, so every byte of input is scanned once no
+    matter how many strings are searched for. The automaton state is carried
+    over between calls to search(), which means a string that is split over
+    two reads is still found without rescanning the old data. The scan is a
+    loop in Python, so for a few strings find() is faster; see
+    bench/bench_searcher_string.py for where they cross.
+
     Attributes:
 
         eof_index     - index of EOF, or -1
@@ -1595,6 +3340,8 @@ class searcher_string (object):
         match - the matching string itself
     """
 
+    automaton_threshold = 16
+
     def __init__(self, strings):
 
         """This creates an instance of searcher_string. This argument 'strings'
@@ -1611,6 +3358,24 @@ class searcher_string (object):
                 self.timeout_index = n
                 continue
             self._strings.append((n, s))
+        self._empty_index = -1
+        for n, s in self._strings:
+            if not s:
+                self._empty_index = n
+                break
+        self._by_index = dict(self._strings)
+        nonempty = [ns for ns in self._strings if ns[1]]
+        if nonempty:
+            self._maxlen = max([len(ns[1]) for ns in nonempty])
+        else:
+            self._maxlen = 0
+        if len(nonempty) >= self.automaton_threshold:
+            self._automaton = aho_corasick(nonempty)
+        else:
+            self._automaton = None
+        self._nonempty = nonempty
+        self._state = 0
+        self._scanned = -1
 
     def __str__(self):
 
@@ -1627,6 +3392,17 @@ class searcher_string (object):
         ss = [ s[1] for s in ss ]
         return '\n'.join(ss)
 
+    def discardable(self, buflen, searchwindowsize=None):
+
+        """This returns how many bytes at the start of a buffer of 'buflen'
+        bytes, that has been searched, cannot be part of a match once more
+        data is added to it. """
+
+        n = buflen - self._maxlen
+        if searchwindowsize is not None:
+            n = max(n, buflen - searchwindowsize)
+        return max(n, 0)
+
     def search(self, buffer, freshlen, searchwindowsize=None):
 
         """This searches 'buffer' for the first occurence of one of the search
@@ -1639,49 +3415,230 @@ class searcher_string (object):
         If there is a match this returns the index of that string, and sets
         'start', 'end' and 'match'. Otherwise, this returns -1. """
 
-        absurd_match = len(buffer)
-        first_match = absurd_match
+        buflen = len(buffer)
+        if searchwindowsize is None:
+            lowest = 0
+        else:
+            lowest = max(0, buflen - searchwindowsize)
+        automaton = self._automaton
+        if automaton is None:
+            return self._search_find(buffer, freshlen, lowest)
+
+        # Resume from the saved automaton state if 'buffer' is the buffer we
+        # scanned last time plus 'freshlen' new bytes. Otherwise start over,
+        # backing up far enough to catch a match that straddles the old and
+        # the fresh data.
+        if 0 < buflen - freshlen == self._scanned:
+            pos = self._scanned
+            state = self._state
+        else:
+            pos = max(lowest, buflen - freshlen - automaton.maxlen + 1, 0)
+            state = 0
+        first_match = buflen
+        best_index = -1
+        if self._empty_index >= 0:
+            first_match = max(lowest, buflen - freshlen, 0)
+            best_index = self._empty_index
+        data, base = _window(buffer, pos)
+        state, pos, start, index = automaton.scan(data, pos - base,
+                buflen - base, state, lowest - base, first_match + 1 - base)
+        pos += base
+        start += base
+        if index >= 0 and (start < first_match or
+                           (start == first_match and index < best_index)):
+            first_match, best_index = start, index
+        if best_index < 0:
+            self._state = state
+            self._scanned = pos
+            return -1
+        self._scanned = -1
+        self.match = self._by_index[best_index]
+        self.start = first_match
+        self.end = self.start + len(self.match)
+        return best_index
 
-        # 'freshlen' helps a lot here. Further optimizations could
-        # possibly include:
-        #
-        # using something like the Boyer-Moore Fast String Searching
-        # Algorithm; pre-compiling the search through a list of
-        # strings into something that can scan the input once to
-        # search for all N strings; realize that if we search for
-        # ['bar', 'baz'] and the input is '...foo' we need not bother
-        # rescanning until we've read three more bytes.
-        #
-        # Sadly, I don't know enough about this interesting topic. /grahn
-        
-        for index, s in self._strings:
-            if searchwindowsize is None:
-                # the match, if any, can only be in the fresh data,
-                # or at the very end of the old data
-                offset = -(freshlen+len(s))
-            else:
-                # better obey searchwindowsize
-                offset = -searchwindowsize
-            n = buffer.find(s, offset)
-            if n >= 0 and n < first_match:
-                first_match = n
-                best_index, best_match = index, s
-        if first_match == absurd_match:
+    def _search_find(self, buffer, freshlen, lowest):
+
+        """INTERNAL: this is search() with one find() per string. A match can
+        only end in the fresh data, and must start at or after 'lowest'. """
+
+        buflen = len(buffer)
+        first_match = buflen
+        best_index = -1
+        if self._empty_index >= 0:
+            first_match = max(lowest, buflen - freshlen, 0)
+            best_index = self._empty_index
+        data, base = _window(buffer, max(lowest, buflen - freshlen - self._maxlen + 1))
+        for index, s in self._nonempty:
+            n = data.find(s, max(lowest, buflen - freshlen - len(s) + 1, 0) - base)
+            if n < 0:
+                continue
+            n += base
+            if n < first_match or (n == first_match and index < best_index):
+                first_match, best_index = n, index
+        if best_index < 0:
             return -1
-        self.match = best_match
+        self.match = self._by_index[best_index]
         self.start = first_match
         self.end = self.start + len(self.match)
         return best_index
 
+class aho_corasick (object):
+
+    """This is the Aho-Corasick multi-string matching automaton used by
+    searcher_string. It is built once from a list of (index, string) tuples
+    and is not modified by scanning; the scan state is kept by the caller.
+
+    Transitions are computed lazily from the goto and failure functions and
+    then cached, so after warming up each input byte costs one dict lookup.
+    """
+
+    def __init__(self, strings):
+
+        """This builds the automaton for 'strings', a sequence of (index,
+        string) tuples. The strings must not be empty. """
+
+        goto = [{}]
+        outputs = [[]]
+        for index, s in strings:
+            state = 0
+            for c in s:
+                target = goto[state].get(c)
+                if target is None:
+                    target = len(goto)
+                    goto.append({})
+                    outputs.append([])
+                    goto[state][c] = target
+                state = target
+            outputs[state].append((-len(s), index))
+
+        # Breadth first, so that the failure state of a state is always
+        # complete before the state itself is visited.
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for c, target in goto[state].items():
+                queue.append(target)
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                fail[target] = goto[f].get(c, 0)
+                outputs[target].extend(outputs[fail[target]])
+
+        # Sorted longest first (i.e. earliest start), then by index.
+        for out in outputs:
+            out.sort()
+        self._goto = goto
+        self._fail = fail
+        self._outputs = [tuple([(-l, n) for l, n in out]) or None
+                         for out in outputs]
+        self._delta = [dict(g) for g in goto]
+        initial = list(goto[0].keys())
+        if initial and isinstance(initial[0], int):
+            # Iterating over bytes gives integers on Python 3.
+            self._initial = bytes(bytearray(initial))
+        else:
+            self._initial = ''.join(initial)
+        self._skip = re.compile(_like(self._initial, '[') +
+                                re.escape(self._initial) +
+                                _like(self._initial, ']'), re.DOTALL)
+        if strings:
+            self.maxlen = max([len(s) for n, s in strings])
+        else:
+            self.maxlen = 0
+
+    def _transition(self, state, c):
+
+        """This computes the transition from 'state' on character 'c' and
+        caches it. """
+
+        goto = self._goto
+        s = state
+        while s and c not in goto[s]:
+            s = self._fail[s]
+        target = goto[s].get(c, 0)
+        self._delta[state][c] = target
+        return target
+
+    def scan(self, buffer, pos, end, state=0, lowest=0, limit=None):
+
+        """This runs the automaton over buffer[pos:end] starting in 'state'.
+        It looks for the match with the lowest start offset that is not
+        before 'lowest', and among matches with the same start offset, for the
+        one with the lowest index. Matches that start at or after 'limit' are
+        not interesting to the caller.
+
+        This returns a tuple (state, pos, start, index). The first two
+        describe where the scan stopped; they can be passed to the next call
+        to resume scanning. If there was no match, 'start' and 'index' are
+        -1."""
+
+        if limit is None:
+            limit = end
+        if not self._initial:
+            return 0, end, -1, -1
+        delta = self._delta
+        outputs = self._outputs
+        skip = self._skip.search
+        maxlen = self.maxlen
+        first_match = limit
+        best_index = -1
+        stop = end
+        while pos < stop:
+            if state == 0:
+                # Fast forward to the next byte that can start a match.
+                m = skip(buffer, pos, stop)
+                if m is None:
+                    pos = stop
+                    break
+                pos = m.start()
+            c = buffer[pos]
+            target = delta[state].get(c)
+            if target is None:
+                target = self._transition(state, c)
+            state = target
+            pos += 1
+            out = outputs[state]
+            if out is None:
+                continue
+            for length, index in out:
+                start = pos - length
+                if start < lowest:
+                    continue
+                if start < first_match or \
+                        (start == first_match and index < best_index):
+                    first_match, best_index = start, index
+                    # A match that starts at or before this one must end
+                    # within 'maxlen' bytes of this start.
+                    stop = min(end, first_match + maxlen)
+                break
+        if best_index < 0:
+            return state, pos, -1, -1
+        return state, pos, first_match, best_index
+
 class searcher_re (object):
 
     """This is regular expression string search helper for the
     spawn.expect_any() method.
 
+    For each pattern the maximum length of a match is determined up front,
+    either from the pattern itself or from an explicit hint. A pattern with a
+    bounded match length only needs to be searched for in the fresh data plus
+    an overlap of that length, instead of in the whole buffer.
+
+    Most patterns also contain a literal string that every match must contain,
+    such as 'Password:' in 'Password: *$'. Before a pattern is run, the part
+    of the buffer where it is searched is scanned for that string with find(),
+    and if it is not there the regular expression is not run at all. The
+    searcher remembers how far the string is known to be absent, so that for
+    a pattern of unbounded length only the fresh data is scanned.
+
     Attributes:
 
         eof_index     - index of EOF, or -1
         timeout_index - index of TIMEOUT, or -1
+        regex_calls   - number of times a regular expression was run
+        regex_skipped - number of times the literal prefilter avoided that
 
     After a successful match by the search() method the following attributes
     are available:
@@ -1692,14 +3649,27 @@ class searcher_re (object):
 
     """
 
-    def __init__(self, patterns):
+    def __init__(self, patterns, maxwidths=None, combine=False):
 
         """This creates an instance that searches for 'patterns' Where
         'patterns' may be a list or other sequence of compiled regular
-        expressions, or the EOF or TIMEOUT types."""
+        expressions, or the EOF or TIMEOUT types.
+
+        The optional 'maxwidths' is a sequence with the same length as
+        'patterns'. A non-None entry is a promise that a match of the
+        corresponding pattern, including any lookahead, is never longer than
+        that. It is needed for patterns such as 'ERROR.*\\r\\n' whose length
+        cannot be bounded by looking at the pattern.
+
+        If 'combine' is True, the patterns are merged into as few regular
+        expressions as possible, so that a single scan finds the first match
+        of any of them. Patterns that cannot be merged safely (backreferences,
+        inline flags) are still searched for one by one. """
 
         self.eof_index = -1
         self.timeout_index = -1
+        self.regex_calls = 0
+        self.regex_skipped = 0
         self._searches = []
         for n, s in zip(range(len(patterns)), patterns):
             if s is EOF:
@@ -1708,14 +3678,40 @@ class searcher_re (object):
             if s is TIMEOUT:
                 self.timeout_index = n
                 continue
-            self._searches.append((n, s))
+            if maxwidths is not None and maxwidths[n] is not None:
+                width = maxwidths[n]
+            else:
+                width = pattern_maxwidth(s)
+            self._searches.append((n, s, width))
+        if combine:
+            combined, separate = combine_patterns(self._searches)
+        else:
+            combined, separate = [], self._searches
+        self._combined = []
+        for c, members, w in combined:
+            # The alternation can only be skipped if every member has a
+            # required literal and none of them is there.
+            literals = [pattern_literal(m) for n, m in members]
+            if None in literals:
+                literals = None
+            self._combined.append((c, members, w, pattern_margin(c), literals))
+        self._separate = []
+        for n, s, w in separate:
+            literal = pattern_literal(s)
+            if literal is not None:
+                literal = [literal]
+            self._separate.append((n, s, w, pattern_margin(s), literal))
+        # For each search, the length of the buffer up to which its literals
+        # are known not to occur. Only valid while the buffer is extended.
+        self._clean = [0] * (len(self._separate) + len(self._combined))
+        self._scanned = 0
 
     def __str__(self):
 
         """This returns a human-readable string that represents the state of
         the object."""
 
-        ss =  [ (n,'    %d: re.compile("%s")' % (n,str(s.pattern))) for n,s in self._searches]
+        ss =  [ (n,'    %d: re.compile("%s")' % (n,str(s.pattern))) for n,s,w in self._searches]
         ss.append((-1,'searcher_re:'))
         if self.eof_index >= 0:
             ss.append ((self.eof_index,'    %d: EOF' % self.eof_index))
@@ -1725,6 +3721,25 @@ class searcher_re (object):
         ss = [ s[1] for s in ss ]
         return '\n'.join(ss)
 
+    def discardable(self, buflen, searchwindowsize=None):
+
+        """This returns how many bytes at the start of a buffer of 'buflen'
+        bytes, that has been searched, cannot be part of a match or be looked
+        at by an assertion once more data is added to it. If one of the
+        patterns has an unbounded length and there is no searchwindowsize,
+        this is 0. """
+
+        n = buflen
+        for search in self._separate + self._combined:
+            width, margin = search[2], search[3]
+            if searchwindowsize is not None:
+                if width is None or width > searchwindowsize:
+                    width = searchwindowsize
+            elif width is None:
+                return 0
+            n = min(n, buflen - width - margin)
+        return max(n, 0)
+
     def search(self, buffer, freshlen, searchwindowsize=None):
 
         """This searches 'buffer' for the first occurence of one of the regular
@@ -1738,18 +3753,88 @@ class searcher_re (object):
 
         absurd_match = len(buffer)
         first_match = absurd_match
-        # 'freshlen' doesn't help here -- we cannot predict the
-        # length of a match, and the re module provides no help.
+        best_index = -1
         if searchwindowsize is None:
             searchstart = 0
         else:
             searchstart = max(0, len(buffer)-searchwindowsize)
-        for index, s in self._searches:
-            match = s.search(buffer, searchstart)
-            if match is None:
-                continue
-            n = match.start()
-            if n < first_match:
+        # A match that was not there before must extend into the fresh data.
+        # For a pattern whose matches are at most 'width' long that means it
+        # cannot start before 'width' bytes in front of the fresh data.
+        freshstart = len(buffer) - freshlen
+        searches = []
+        for index, s, width, margin, literals in self._separate:
+            if width is None or freshstart <= 0:
+                start = searchstart
+            else:
+                start = max(searchstart, freshstart - width)
+            searches.append((start, margin, literals, index, s))
+        for combined, members, width, margin, literals in self._combined:
+            if width is None or freshstart <= 0:
+                start = searchstart
+            else:
+                start = max(searchstart, freshstart - width)
+            searches.append((start, margin, literals, -1, (combined, members)))
+        if not searches:
+            return -1
+        clean = self._clean
+        if freshstart <= 0 or freshstart != self._scanned:
+            clean[:] = [0] * len(clean)
+        self._scanned = len(buffer)
+        # Where each search needs the buffer from: its start for a find()
+        # of the literals, or its start minus its margin for the regex.
+        # A literal that was not there before can only occur in the fresh
+        # data and the overlap in front of it.
+        needs = []
+        for k, (start, margin, literals, index, s) in enumerate(searches):
+            if literals is None:
+                needs.append(start - margin)
+            else:
+                overlap = max([len(literal) for literal in literals]) - 1
+                needs.append(max(start, clean[k] - overlap))
+        data, base = _window(buffer, min(needs))
+        runs = []
+        for k, search in enumerate(searches):
+            literals = search[2]
+            if literals is not None:
+                for literal in literals:
+                    if data.find(literal, needs[k] - base) >= 0:
+                        break
+                else:
+                    clean[k] = len(buffer)
+                    self.regex_skipped += 1
+                    continue
+            runs.append(search)
+        if not runs:
+            return -1
+        # Searching from an offset (rather than slicing) keeps '^' and
+        # lookbehind assertions working, as long as the window has 'margin'
+        # bytes of context.
+        lowest = min([start - margin for start, margin, l, i, s in runs])
+        if lowest < base:
+            data, base = _window(buffer, lowest)
+        for start, margin, literals, index, s in runs:
+            self.regex_calls += 1
+            if index >= 0:
+                match = s.search(data, start - base)
+                if match is None:
+                    continue
+            else:
+                combined, members = s
+                match = combined.search(data, start - base)
+                if match is None:
+                    continue
+                n = match.start() + base
+                if n > first_match:
+                    continue
+                # The alternation picks the first member that matches at 'n'.
+                # Run that member by itself, so that 'match' has its groups.
+                for index, s in members:
+                    match = s.match(data, n - base)
+                    if match is not None:
+                        break
+            n = match.start() + base
+            if n < first_match or (n == first_match and index < best_index):
                 first_match = n
                 the_match = match
                 best_index = index
@@ -1757,9 +3842,264 @@ class searcher_re (object):
             return -1
         self.start = first_match
         self.match = the_match
-        self.end = self.match.end()
+        self.end = self.match.end() + base
         return best_index
 
+_inline_flags = re.compile(r'\(\?[aiLmsux]+\)')
+
+def combine_patterns(searches):
+
+    """This merges compiled regular expressions into alternations. The
+    'searches' argument is a list of (index, pattern, width) tuples as used by
+    searcher_re.
+
+    Patterns are only merged with others of the same type and flags. Bounded
+    ones are kept apart from unbounded ones so that the former can still be
+    searched incrementally, and patterns that start with a literal character
+    are kept together, because the re module can then skip ahead to the next
+    position where one of those characters occurs.
+
+    This returns a tuple (combined, separate). The first is a list of
+    (regex, members, width) tuples, where 'members' is the list of (index,
+    pattern) tuples that were merged, in order. The second lists the searches
+    that could not be merged. """
+
+    groups = {}
+    order = []
+    separate = []
+    for index, s, width in searches:
+        try:
+            parsed = sre_parse.parse(s.pattern, s.flags)
+        except (sre_constants.error, TypeError, ValueError):
+            parsed = None
+        # Backreferences would be renumbered, and inline flags are global.
+        if parsed is None or _has_groupref(parsed) or \
+                _inline_flags.search(_pattern_text(s)):
+            separate.append((index, s, width))
+            continue
+        literal = bool(parsed.data) and \
+                parsed.data[0][0] == sre_constants.LITERAL and \
+                not s.flags & re.IGNORECASE
+        key = (type(s.pattern), s.flags, width is None, literal)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        branch = len(parsed.data) == 1 and \
+                parsed.data[0][0] == sre_constants.BRANCH
+        groups[key].append((index, s, width, branch))
+    combined = []
+    for key in order:
+        # Python limits the number of groups in a regular expression, so
+        # merge in batches.
+        batches = [[]]
+        ngroups = 0
+        for item in groups[key]:
+            if ngroups + item[1].groups >= 99:
+                batches.append([])
+                ngroups = 0
+            batches[-1].append(item)
+            ngroups += item[1].groups
+        for batch in batches:
+            result = None
+            if len(batch) > 1:
+                result = _combine_batch(batch)
+            if result is None:
+                separate.extend([item[:3] for item in batch])
+            else:
+                combined.append(result)
+    separate.sort()
+    return combined, separate
+
+def _combine_batch(batch):
+
+    """This compiles a list of (index, pattern, width, branch) tuples with the
+    same flags into one regular expression, or returns None if that fails.
+    Only patterns that are alternations themselves ('branch') need to be put
+    in a group; that group would hide a literal first character. """
+
+    flags = batch[0][1].flags
+    parts = []
+    for index, s, width, branch in batch:
+        part = s.pattern
+        if flags & re.VERBOSE:
+            part += _like(part, '\n')  # end a trailing comment
+        if branch:
+            part = _like(part, '(?:') + part + _like(part, ')')
+        parts.append(part)
+    try:
+        combined = re.compile(_like(parts[0], '|').join(parts), flags)
+    except (re.error, TypeError, ValueError):
+        return None
+    members = [(index, s) for index, s, width, branch in batch]
+    widths = [width for index, s, width, branch in batch]
+    if None in widths:
+        width = None
+    else:
+        width = max(widths)
+    return combined, members, width
+
+def _has_groupref(parsed):
+
+    """This returns True if a parsed regular expression contains
+    backreferences or conditional groups. """
+
+    for op, av in _walk_parsed(parsed):
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return True
+    return False
+
+def _pattern_text(pattern):
+
+    """This returns the source of a compiled regular expression as text. """
+
+    s = pattern.pattern
+    if not isinstance(s, str) and isinstance(s, bytes):
+        s = s.decode('latin-1')
+    return s
+
+def _like(s, text):
+
+    """This returns 'text' as the same string type as 's'. """
+
+    if isinstance(s, bytes) and not isinstance(text, bytes):
+        return text.encode('ascii')
+    return text
+
+_pattern_info_cache = {}
+
+def pattern_maxwidth(pattern):
+
+    """This returns the maximum length of a match of the compiled regular
+    expression 'pattern', including the input examined by lookahead
+    assertions. If the length is unbounded or cannot be determined, for
+    example for patterns containing backreferences, this returns None. """
+
+    return _pattern_info(pattern)[0]
+
+def pattern_literal(pattern):
+
+    """This returns the longest literal string that every match of the
+    compiled regular expression 'pattern' must contain, or None if there is
+    no such string or it cannot be determined. For example, for 'ERROR\\d+'
+    this returns 'ERROR'. """
+
+    return _pattern_info(pattern)[2]
+
+def pattern_margin(pattern):
+
+    """This returns how many bytes in front of the position where a search
+    starts the compiled regular expression 'pattern' may look at, for '^',
+    '\\b' and lookbehind assertions. """
+
+    return _pattern_info(pattern)[1]
+
+def _pattern_info(pattern):
+
+    """INTERNAL: this returns (maxwidth, margin, literal) for a compiled
+    regular expression. """
+
+    key = (type(pattern.pattern), pattern.pattern, pattern.flags)
+    try:
+        return _pattern_info_cache[key]
+    except KeyError:
+        pass
+    margin = 1
+    literal = None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+        width = parsed.getwidth()[1]
+        if not pattern.flags & re.IGNORECASE:
+            runs = list(_literal_runs(parsed))
+            if runs:
+                literal = _literal_string(pattern, max(runs, key=len))
+        for op, av in _walk_parsed(parsed):
+            if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                width = None
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                if av[0] > 0:
+                    if width is not None:
+                        width += av[1].getwidth()[1]
+                else:
+                    margin += av[1].getwidth()[1]
+    except (sre_constants.error, TypeError, ValueError):
+        width = None
+        margin = None
+        literal = None
+    if width is not None and width >= sre_constants.MAXREPEAT - 1:
+        width = None
+    if margin is not None and margin >= sre_constants.MAXREPEAT - 1:
+        margin = None
+    if margin is None:
+        margin = sys.maxint
+    if len(_pattern_info_cache) > 100:
+        _pattern_info_cache.clear()
+    _pattern_info_cache[key] = (width, margin, literal)
+    return width, margin, literal
+
+_repeats = [sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT]
+if hasattr(sre_constants, 'POSSESSIVE_REPEAT'):
+    _repeats.append(sre_constants.POSSESSIVE_REPEAT)
+
+def _literal_runs(parsed):
+
+    """This yields the lists of character codes that every match of the
+    parsed regular expression must contain as a contiguous string. Only the
+    top level sequence, groups and repeats of at least once are looked at;
+    alternatives and assertions are not. """
+
+    run = []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(av)
+            continue
+        if run:
+            yield run
+            run = []
+        if op == sre_constants.SUBPATTERN:
+            # On Python 3, av is (group, add_flags, del_flags, pattern).
+            if len(av) == 4 and av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+                continue
+            sub = av[-1]
+        elif op in _repeats and av[0] >= 1:
+            sub = av[2]
+        else:
+            continue
+        for subrun in _literal_runs(sub):
+            yield subrun
+    if run:
+        yield run
+
+def _literal_string(pattern, codes):
+
+    """This returns a string of the same type as the pattern of the compiled
+    regular expression 'pattern' with the characters 'codes'. """
+
+    if isinstance(pattern.pattern, unicode):
+        return u''.join([unichr(c) for c in codes])
+    if bytes is not str:
+        return bytes(bytearray(codes))
+    return ''.join([chr(c) for c in codes])
+
+def _walk_parsed(parsed):
+
+    """This yields all (op, av) tuples of a parsed regular expression,
+    including those of nested subpatterns. """
+
+    for op, av in parsed:
+        yield op, av
+        if not isinstance(av, (tuple, list)):
+            continue
+        for item in av:
+            if isinstance(item, sre_parse.SubPattern):
+                items = [item]
+            elif isinstance(item, list):
+                items = [i for i in item if isinstance(i, sre_parse.SubPattern)]
+            else:
+                continue
+            for item in items:
+                for opav in _walk_parsed(item):
+                    yield opav
+
 def which (filename):
 
     """This takes a given filename; tries to find it in the environment path;
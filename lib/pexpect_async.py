@@ -0,0 +1,159 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Asyncio support for spawn and winspawn (Python 3.5 and later only).
+
+You do not need to import this module yourself. It is used by the
+expect_async(), expect_exact_async(), send_async() and iterlines_async()
+methods of spawn, which return awaitables::
+
+    index = await child.expect_async(['login:', pexpect.EOF])
+    await child.send_async('root\\n')
+    async for line in child.iterlines_async():
+        ...
+
+The expect and readline loops are the same generators that the blocking
+calls use, so 'before', 'after' and 'match' are set in exactly the same way.
+Only the waiting is different: spawn registers its child_fd with the event
+loop, and the reader threads of winspawn wake up the event loop when they
+queue output. Nothing is polled.
+"""
+
+import asyncio
+
+from pexpect import EOF, TIMEOUT, _like
+
+# get_event_loop() inside a coroutine is deprecated since Python 3.10.
+# Before 3.7 there is no get_running_loop(), but get_event_loop() returns
+# the running loop.
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+async def read_async(child, size=1, timeout=-1):
+    """This is read_nonblocking() for asyncio: it waits for output of the
+    child without blocking the event loop."""
+    loop = _running_loop()
+    if timeout == -1:
+        timeout = child.timeout
+    if timeout is not None:
+        end_time = loop.time() + timeout
+    while True:
+        try:
+            return child.read_nonblocking(size, 0)
+        except TIMEOUT:
+            if timeout is not None and loop.time() >= end_time:
+                raise
+        ready = loop.create_future()
+        def wakeup():
+            if not ready.done():
+                ready.set_result(None)
+        child._add_reader(loop, wakeup)
+        try:
+            if timeout is None:
+                await ready
+            else:
+                await asyncio.wait_for(ready, end_time - loop.time())
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            child._remove_reader(loop)
+
+
+async def run_steps(child, steps):
+    """This drives a generator such as spawn._expect_steps() from the event
+    loop, like spawn._run_steps() does with blocking reads."""
+    try:
+        timeout = next(steps)
+        while True:
+            try:
+                data = await read_async(child, child.maxread, timeout)
+            except BaseException as e:
+                timeout = steps.throw(e)
+            else:
+                timeout = steps.send(data)
+    except StopIteration:
+        pass
+
+
+async def expect_async(child, kind, pattern, timeout=-1, searchwindowsize=-1,
+                       maxwidths=None, before_sink=-1):
+    """The coroutine behind spawn.expect_async() and
+    spawn.expect_exact_async(). See spawn._checkout_searcher() for 'kind'."""
+    key, searcher = child._checkout_searcher(kind, pattern, maxwidths)
+    try:
+        steps = child._expect_steps(searcher, timeout, searchwindowsize,
+                                    before_sink)
+        await run_steps(child, steps)
+    finally:
+        if key is not None and child.searchercache is not None:
+            child.searchercache.checkin(key, searcher)
+    return child.match_index
+
+
+async def send_async(child, s):
+    """The coroutine behind spawn.send_async()."""
+    loop = _running_loop()
+    if child.delaybeforesend:
+        await asyncio.sleep(child.delaybeforesend)
+    ready = loop.create_future()
+    def wakeup():
+        if not ready.done():
+            ready.set_result(None)
+    if not child._add_writer(loop, wakeup):
+        return await loop.run_in_executor(None, child._write, s)
+    try:
+        await ready
+    finally:
+        child._remove_writer(loop)
+    return child._write(s)
+
+
+class line_iterator(object):
+    """The asynchronous iterator that is returned by spawn.iterlines_async().
+    It produces the same lines, or lists of lines, as spawn.iterlines()."""
+
+    def __init__(self, child, batch=None, timeout=-1):
+        self.child = child
+        self.batch = batch
+        self.timeout = timeout
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        child = self.child
+        if child.delimiter is not EOF:
+            crlf = _like(child._empty, child.lineterminator)
+            index = await expect_async(child, 're', [crlf, child.delimiter],
+                                       self.timeout, None)
+            if index == 0:
+                line = child.before + crlf
+            else:
+                line = child.before
+            if not line:
+                raise StopAsyncIteration
+            lines = [line]
+        elif child._linepos < len(child._lines) or \
+                await self._read_lines():
+            end = child._linepos + (self.batch or 1)
+            lines = child._lines[child._linepos:end]
+            child._linepos += len(lines)
+        else:
+            rest = child.buffer
+            child.buffer = child._empty
+            if not rest:
+                raise StopAsyncIteration
+            lines = [rest]
+        if self.batch is None:
+            return lines[0]
+        return lines
+
+    async def _read_lines(self):
+        child = self.child
+        await run_steps(child, child._read_lines_steps(self.timeout))
+        return child._linepos < len(child._lines)
@@ -0,0 +1,317 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Recording sessions and playing them back.
+
+A transcript records what a spawn or winspawn reads and sends, and when,
+in a compact binary file::
+
+    child = winspawn('cmd.exe')
+    child.transcript = pexpect_replay.transcript('session.pxt')
+    ...
+    child.close()
+    child.transcript.close()
+
+A replayspawn plays a transcript back to the same expect script, on any
+platform, without the program that was recorded::
+
+    child = pexpect_replay.replayspawn('session.pxt')
+
+Output that was recorded after a send is only returned once the script has
+sent that data, so the script sees the output in the same order as it did.
+With 'speed' set, output is returned at the recorded times, counted from the
+last send; speed=1.0 is the recorded speed and speed=2.0 twice as fast. By
+default the output is returned as fast as possible.
+
+With separate_stderr, winspawn records what it reads from stderr with its own
+tag, STDERR_READ. A replay returns it together with the other output, in the
+order it was recorded; it has no separate streams.
+
+The file starts with a magic string and a version. Every record is a tag,
+the time since the previous record in microseconds, and the size of the
+data, followed by the data.
+"""
+
+import time
+import struct
+
+from pexpect import spawn, EOF, TIMEOUT, ExceptionPexpect
+
+
+READ = 1
+SEND = 2
+END = 3     # The end of the output (EOF).
+STDERR_READ = 4     # Output that was read from stderr, with separate_stderr.
+
+MAGIC = 'PXTR'.encode('ascii')
+VERSION = 1
+
+_file_header = struct.Struct('>4sB')
+_record_header = struct.Struct('>BII')
+_empty = ''.encode('ascii')
+
+try:
+    _clock = time.monotonic
+except AttributeError:
+    _clock = time.time
+
+
+def _encode(data):
+    """INTERNAL: transcripts hold bytes. Text is stored as UTF-8."""
+    if not isinstance(data, bytes):
+        return data.encode('utf-8')
+    return data
+
+
+class transcript(object):
+    """Records a session. Set it as the 'transcript' of a spawn or
+    winspawn."""
+
+    def __init__(self, file):
+        """Constructor. `file' is a path, which is created, or a file
+        object that is open for writing bytes."""
+        if isinstance(file, basestring):
+            self.file = open(file, 'wb')
+            self.owned = True
+        else:
+            self.file = file
+            self.owned = False
+        self.file.write(_file_header.pack(MAGIC, VERSION))
+        self.last = None
+        self.records = 0
+        self.closed = False
+
+    def record(self, tag, data):
+        """Record `data' with `tag' at the current time."""
+        now = _clock()
+        if self.last is None:
+            delta = 0
+        else:
+            delta = min(int((now - self.last) * 1000000), 0xffffffff)
+        self.last = now
+        data = _encode(data)
+        self.file.write(_record_header.pack(tag, delta, len(data)) + data)
+        self.records += 1
+
+    def record_read(self, data, stream=None):
+        """Record output that was read. `stream' is 'stderr' for output
+        that was read from stderr by itself."""
+        if stream == 'stderr':
+            self.record(STDERR_READ, data)
+        else:
+            self.record(READ, data)
+
+    def record_send(self, data):
+        """Record data that was sent."""
+        self.record(SEND, data)
+
+    def record_eof(self):
+        """Record the end of the output."""
+        self.record(END, _empty)
+
+    def sync(self):
+        """Flush the file."""
+        self.file.flush()
+
+    def close(self):
+        """Flush the file, and close it if it was opened here."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+def read_transcript(file):
+    """Read a transcript. `file' is a path or a file object that is open for
+    reading bytes. Return a list of (tag, time, data) tuples, with the time
+    in seconds since the first record. A file that is not a transcript, or
+    that ends inside a record, raises ValueError."""
+    if isinstance(file, basestring):
+        f = open(file, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    else:
+        data = file.read()
+    if len(data) < _file_header.size:
+        raise ValueError, 'Not a transcript'
+    magic, version = _file_header.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError, 'Not a transcript'
+    if version != VERSION:
+        raise ValueError, 'Unsupported transcript version: %d' % version
+    records = []
+    pos = _file_header.size
+    hsize = _record_header.size
+    elapsed = 0
+    while pos < len(data):
+        if len(data) - pos < hsize:
+            raise ValueError, 'Truncated transcript'
+        tag, delta, size = _record_header.unpack_from(data, pos)
+        pos += hsize
+        if len(data) - pos < size:
+            raise ValueError, 'Truncated transcript'
+        elapsed += delta
+        records.append((tag, elapsed / 1000000.0, data[pos:pos+size]))
+        pos += size
+    return records
+
+
+class replayspawn(spawn):
+    """A spawn that plays a transcript back."""
+
+    def __init__(self, transcript, speed=None, strict=True, **kwargs):
+        """Constructor. `transcript' is a path, a file object, or a list of
+        records as read_transcript() returns them. `speed' is None to return
+        output as fast as possible, or the factor to play the recorded times
+        at. With `strict', sending data that differs from what was recorded
+        raises ExceptionPexpect; without it, every send is taken to be the
+        recorded sends up to the next output. The other keyword arguments are those of
+        spawn."""
+        super(replayspawn, self).__init__(None, **kwargs)
+        if not isinstance(transcript, list):
+            transcript = read_transcript(transcript)
+        self.records = transcript
+        self.position = 0
+        self.speed = speed
+        self.strict = strict
+        if speed is None:
+            self.delaybeforesend = 0
+        self.name = '<replay>'
+        self.sent = []
+        self.closed = False
+        self.terminated = False
+        self._unsent = _empty   # Recorded sends that were not matched yet.
+        self._unread = _empty   # The rest of a read record.
+        self._anchor = (0.0, _clock())
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        """Return the next output of the transcript, at most `size'
+        characters. When the transcript waits for a send, or the output is
+        not due within `timeout', this raises TIMEOUT. Without `speed' it
+        does so at once. At the end of the transcript it raises EOF."""
+        if self.closed:
+            raise ValueError, 'I/O operation on closed file in read_nonblocking().'
+        if timeout == -1:
+            timeout = self.timeout
+        if not self._unread:
+            if self.position == len(self.records):
+                self.flag_eof = True
+                self._log_eof()
+                raise EOF, 'End of transcript.'
+            tag, when, data = self.records[self.position]
+            if tag == SEND:
+                self._wait(timeout, None)
+                raise TIMEOUT, 'The transcript waits for a send.'
+            if self.speed is not None:
+                recorded, real = self._anchor
+                self._wait(timeout, real + (when - recorded) / self.speed)
+            self.position += 1
+            if tag == END:
+                self.flag_eof = True
+                self._log_eof()
+                raise EOF, 'End of file in the transcript.'
+            self._unread = data
+        data = self._unread[:size]
+        self._unread = self._unread[size:]
+        s = self._decode(data)
+        if self.logfile is not None:
+            self.logfile.write(s)
+            self.logfile.flush()
+        if self.logfile_read is not None:
+            self.logfile_read.write(s)
+            self.logfile_read.flush()
+        if self.transcript is not None:
+            self.transcript.record_read(s)
+        return s
+
+    def _wait(self, timeout, due):
+        """INTERNAL: wait until `due', a time of _clock(), or None for never.
+        Raise TIMEOUT if that is more than `timeout' seconds away. Without
+        `speed' this does not wait."""
+        if self.speed is None:
+            return
+        if due is None:
+            delay = None
+        else:
+            delay = due - _clock()
+        if delay is None or (timeout is not None and delay > timeout):
+            if timeout is not None:
+                time.sleep(timeout)
+            raise TIMEOUT, 'Timeout exceeded in read_nonblocking().'
+        if delay > 0:
+            time.sleep(delay)
+
+    def _write(self, s):
+        """INTERNAL: this is send() without the delaybeforesend. The data is
+        compared with the sends in the transcript, and output that was
+        recorded after them becomes available."""
+        if self.logfile is not None:
+            self.logfile.write(s)
+            self.logfile.flush()
+        if self.logfile_send is not None:
+            self.logfile_send.write(s)
+            self.logfile_send.flush()
+        if self.transcript is not None:
+            self.transcript.record_send(s)
+        data = self._encode(s)
+        self.sent.append(data)
+        records = self.records
+        # Without strict, a send stands for all recorded sends up to the
+        # next output.
+        while (not self.strict or len(self._unsent) < len(data)) and \
+                self.position < len(records) and \
+                records[self.position][0] == SEND:
+            self._unsent += records[self.position][2]
+            self._anchor = (records[self.position][1], _clock())
+            self.position += 1
+        if not self.strict:
+            self._unsent = _empty
+            return len(data)
+        expected = self._unsent[:len(data)]
+        self._unsent = self._unsent[len(data):]
+        if expected != data:
+            raise ExceptionPexpect, 'Sent %r, but the transcript has %r.' \
+                    % (data, expected)
+        return len(data)
+
+    def sendeof(self):
+        """This sends a Ctrl-D."""
+        return self.sendcontrol('d')
+
+    def sendintr(self):
+        """This sends a Ctrl-C."""
+        return self.sendcontrol('c')
+
+    def isalive(self):
+        """The child is alive until the end of the transcript is read."""
+        return not self.closed and not self.flag_eof
+
+    def wait(self):
+        """The exit status is not recorded. This returns None."""
+        return self.exitstatus
+
+    def kill(self, sig):
+        """This does nothing."""
+        pass
+
+    def terminate(self, force=False):
+        """This closes the replay."""
+        self.close()
+        return True
+
+    def close(self, force=True):
+        """This closes the replay. The transcript is not played further."""
+        if not self.closed:
+            self._sync_logs()
+            self.closed = True
+            self.terminated = True
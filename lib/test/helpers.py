@@ -0,0 +1,51 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Fakes and helpers that are shared by the tests."""
+
+import socket
+from pexpect import spawn
+
+
+def b(s):
+    return s.encode('ascii')
+
+
+def reader_of(parts):
+    """A read() function that returns `parts' one by one, and then an empty
+    string of their type."""
+    parts = list(parts)
+    if parts:
+        end = parts[0][:0]
+    else:
+        end = ''
+    def read(size):
+        if not parts:
+            return end
+        return parts.pop(0)
+    return read
+
+
+class socketspawn(spawn):
+    """A spawn that talks to the other end of a socket pair."""
+
+    def __init__(self, **kwargs):
+        super(socketspawn, self).__init__(None, **kwargs)
+        self.sock, self.peer = socket.socketpair()
+        self.child_fd = self.sock.fileno()
+        self.closed = False
+
+    def isalive(self):
+        return not self.closed
+
+    def close(self):
+        if not self.closed:
+            self._sync_logs()
+            self.sock.close()
+            self.peer.close()
+            self.closed = True
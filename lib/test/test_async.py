@@ -0,0 +1,142 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+import socket
+from pexpect import EOF, TIMEOUT
+
+from nose.tools import assert_raises
+from nose.plugins.skip import SkipTest
+
+from helpers import socketspawn
+
+try:
+    import asyncio
+    import pexpect_async
+except (ImportError, SyntaxError):
+    asyncio = None
+
+
+class TestAsync(object):
+
+    def setUp(self):
+        if asyncio is None:
+            raise SkipTest('asyncio is not available')
+        self.loop = asyncio.new_event_loop()
+        self.child = socketspawn(timeout=5)
+
+    def tearDown(self):
+        self.child.close()
+        self.loop.close()
+
+    def run(self, aw):
+        return self.loop.run_until_complete(aw)
+
+    def later(self, delay, data):
+        self.loop.call_later(delay, self.child.peer.send, data.encode('ascii'))
+
+    def test_expect(self):
+        child = self.child
+        self.later(0.01, 'hello ')
+        self.later(0.02, 'world!')
+        assert self.run(child.expect_async(['nomatch', 'w(or)ld'])) == 1
+        assert child.before == 'hello '
+        assert child.after == 'world'
+        assert child.match.group(1) == 'or'
+        assert self.run(child.expect_exact_async('!')) == 0
+        assert child.before == ''
+
+    def test_same_as_sync(self):
+        child = self.child
+        child.peer.send('abc\r\ndef\r\nghi'.encode('ascii'))
+        assert self.run(child.expect_async('def')) == 0
+        result = (child.before, child.after, child.match.group(0))
+        other = socketspawn()
+        try:
+            other.peer.send('abc\r\ndef\r\nghi'.encode('ascii'))
+            assert other.expect('def') == 0
+            assert (other.before, other.after, other.match.group(0)) == result
+        finally:
+            other.close()
+
+    def test_loop_not_blocked(self):
+        child = self.child
+        ticks = []
+        def tick():
+            ticks.append(None)
+            self.loop.call_later(0.005, tick)
+        tick()
+        self.later(0.1, 'done')
+        assert self.run(child.expect_async('done')) == 0
+        assert len(ticks) > 5
+
+    def test_timeout(self):
+        child = self.child
+        self.later(0.01, 'partial')
+        assert_raises(TIMEOUT, self.run, child.expect_async('x', timeout=0.1))
+        assert child.before == 'partial'
+        assert child.match is None
+        index = self.run(child.expect_async(['x', TIMEOUT], timeout=0.05))
+        assert index == 1
+        assert child.after is TIMEOUT
+
+    def test_eof(self):
+        child = self.child
+        child.peer.send('last words'.encode('ascii'))
+        self.loop.call_later(0.01, child.peer.shutdown, socket.SHUT_WR)
+        assert self.run(child.expect_async(['x', EOF])) == 1
+        assert child.before == 'last words'
+        assert child.after is EOF
+        assert_raises(EOF, self.run, child.expect_async('x'))
+
+    def test_cancel(self):
+        child = self.child
+        child.peer.send('some'.encode('ascii'))
+        task = self.loop.create_task(child.expect_async('never'))
+        self.loop.call_later(0.05, task.cancel)
+        assert_raises(asyncio.CancelledError, self.run, task)
+        assert child.before == 'some'
+        # The reader was removed, so the child can be used again.
+        self.later(0.01, 'thing')
+        assert self.run(child.expect_async('thing')) == 0
+        assert child.before == 'some'
+
+    def test_send(self):
+        child = self.child
+        assert self.run(child.send_async('ping')) == 4
+        assert child.peer.recv(100) == 'ping'.encode('ascii')
+
+    def test_iterlines(self):
+        child = self.child
+        child.peer.send('one\r\ntwo\r\n'.encode('ascii'))
+        self.later(0.01, 'three\r\nfour')
+        self.loop.call_later(0.02, child.peer.shutdown, socket.SHUT_WR)
+        lines = child.iterlines_async()
+        result = []
+        while True:
+            try:
+                result.append(self.run(lines.__anext__()))
+            except StopAsyncIteration:
+                break
+        assert result == ['one\r\n', 'two\r\n', 'three\r\n', 'four']
+
+    def test_iterlines_batch(self):
+        child = self.child
+        child.peer.send('a\r\nb\r\nc\r\n'.encode('ascii'))
+        child.peer.shutdown(socket.SHUT_WR)
+        lines = child.iterlines_async(batch=2)
+        assert self.run(lines.__anext__()) == ['a\r\n', 'b\r\n']
+        assert self.run(lines.__anext__()) == ['c\r\n']
+        assert_raises(StopAsyncIteration, self.run, lines.__anext__())
+
+    def test_iterlines_delimiter(self):
+        child = self.child
+        child.delimiter = 'END'
+        child.peer.send('a\r\nbEND'.encode('ascii'))
+        lines = child.iterlines_async()
+        assert self.run(lines.__anext__()) == 'a\r\n'
+        assert self.run(lines.__anext__()) == 'b'
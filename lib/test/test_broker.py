@@ -0,0 +1,405 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+import os
+import sys
+import time
+import shlex
+import random
+import struct
+import tempfile
+import threading
+import subprocess
+from winpexpect_broker import (header_reader, frame_reader, header_codec,
+                               frame_codec, broker, broker_client,
+                               encode_frame, decode_frames, PROTOCOL_VERSION,
+                               _parse_header, _format_header, _format_env,
+                               _parse_env)
+
+from nose.tools import assert_raises
+
+from helpers import reader_of
+
+
+def channel(binary=False):
+    """Return the read() and write() functions of both ends of a channel
+    over two pipes. The channel carries text, or bytes if `binary' is
+    set."""
+    r1, w1 = os.pipe()
+    r2, w2 = os.pipe()
+    if binary:
+        read = lambda fd: lambda size: os.read(fd, size)
+        write = lambda fd: lambda s: os.write(fd, s)
+    else:
+        read = lambda fd: lambda size: os.read(fd, size).decode('ascii')
+        write = lambda fd: lambda s: os.write(fd, s.encode('ascii'))
+    return (read(r1), write(w2)), (read(r2), write(w1)), [r1, w1, r2, w2]
+
+
+# Frames carry text; on Python 2 that is str, which is passed as is.
+if sys.version_info[0] == 3:
+    alphabet = 'abcXYZ019 =\n\t\\:;"\'\xe9\u20ac'
+else:
+    alphabet = 'abcXYZ019 =\n\t\\:;"\''
+
+
+def random_text(rnd, size):
+    return ''.join([rnd.choice(alphabet) for i in range(size)])
+
+
+class TestHeader(object):
+
+    def test_parse(self):
+        header = 'command=cmd.exe\nargs=/c dir\n\n'
+        assert _parse_header(header) == {'command': 'cmd.exe',
+                                         'args': '/c dir'}
+
+    def test_continuation(self):
+        header = 'message=first\n second=2\n third\nstatus=error\n\n'
+        assert _parse_header(header) == {'message': 'first\nsecond=2\nthird',
+                                         'status': 'error'}
+        assert_raises(ValueError, _parse_header, ' first\n\n')
+        assert_raises(ValueError, _parse_header, 'novalue\n\n')
+
+    def test_round_trip(self):
+        fields = [('status', 'error'), ('message', 'a\n b\nc=d\n'),
+                  ('pid', 42)]
+        parsed = _parse_header(_format_header(fields))
+        assert parsed == {'status': 'error', 'message': 'a\n b\nc=d\n',
+                          'pid': '42'}
+
+    def test_env(self):
+        env = {'PATH': r'C:\Windows;C:\Python', '=C:': 'C:\\', 'EMPTY': '',
+               'EQ': 'a=b'}
+        assert _parse_env(_format_env(env)) == env
+        assert _parse_env(_format_env(env, '\0'), '\0') == env
+        header = _format_header([('env', env)])
+        assert _parse_env(_parse_header(header)['env']) == env
+
+
+class TestHeaderReader(object):
+
+    def test_split(self):
+        read = reader_of(['a=1\n', 'b=2\n', '\n'])
+        assert header_reader(read).next_header() == 'a=1\nb=2\n\n'
+
+    def test_split_terminator(self):
+        read = reader_of(['a=1\n', '\nb=2\n\n'])
+        headers = header_reader(read)
+        assert headers.next_header() == 'a=1\n\n'
+        assert headers.next_header() == 'b=2\n\n'
+        assert headers.next_header() == ''
+
+    def test_many(self):
+        read = reader_of(['a=1\n\nb=2\n\nc=', '3\n\n'])
+        headers = header_reader(read)
+        parsed = []
+        while True:
+            header = headers.next_header()
+            if not header:
+                break
+            parsed.append(_parse_header(header))
+        assert parsed == [{'a': '1'}, {'b': '2'}, {'c': '3'}]
+
+    def test_eof(self):
+        headers = header_reader(reader_of(['a=1\n']))
+        assert headers.next_header() == ''
+        assert header_reader(reader_of([])).next_header() == ''
+
+    def test_large(self):
+        value = 'x' * 100000
+        header = _format_header([('value', value)])
+        chunks = [header[i:i+7] for i in range(0, len(header), 7)]
+        headers = header_reader(reader_of(chunks), 7)
+        assert _parse_header(headers.next_header()) == {'value': value}
+
+
+class TestFrames(object):
+
+    def test_round_trip(self):
+        env = {'PATH': r'C:\Windows', '=C:': 'C:\\', 'EMPTY': ''}
+        fields = [('command', r'C:\Windows\cmd.exe'),
+                  ('args', 'cmd.exe /c "echo a\nb"'), ('env', env),
+                  ('cwd', r'C:\temp'), ('parent_sid', 'S-1-5-21'),
+                  ('status', 'ok'), ('pid', 1234), ('message', ''),
+                  ('stdin', 'in'), ('stdout', 'out'), ('stderr', 'err'),
+                  ('op', 'quit')]
+        frames, used = decode_frames(encode_frame(fields))
+        assert used == len(encode_frame(fields))
+        expected = dict(fields)
+        expected['pid'] = '1234'
+        assert frames == [expected]
+
+    def test_format(self):
+        frame = encode_frame([('status', 'ok'), ('pid', 42)])
+        assert frame[:5] == struct.pack('>BI', PROTOCOL_VERSION, 14)
+        assert frame[5:] == struct.pack('>BI', 7, 2) + 'ok'.encode('ascii') \
+                + struct.pack('>BI', 8, 2) + '42'.encode('ascii')
+
+    def test_unicode(self):
+        fields = [('message', u'caf\xe9 \u20ac'), ('env', {'A': u'\xe9'})]
+        frames, used = decode_frames(encode_frame(fields))
+        message, value = u'caf\xe9 \u20ac', u'\xe9'
+        if sys.version_info[0] == 2:
+            message, value = message.encode('utf-8'), value.encode('utf-8')
+        assert frames[0]['message'] == message
+        assert frames[0]['env'] == {'A': value}
+
+    def test_unknown_field(self):
+        assert_raises(ValueError, encode_frame, [('color', 'red')])
+        body = struct.pack('>BI', 200, 3) + 'red'.encode('ascii') + \
+                encode_frame([('status', 'ok')])[5:]
+        frame = struct.pack('>BI', PROTOCOL_VERSION, len(body)) + body
+        assert decode_frames(frame)[0] == [{'status': 'ok'}]
+
+    def test_errors(self):
+        frame = encode_frame([('status', 'ok')])
+        bad = struct.pack('>B', PROTOCOL_VERSION + 1) + frame[1:]
+        assert_raises(ValueError, decode_frames, bad)
+        body = struct.pack('>BI', 7, 10) + 'ok'.encode('ascii')
+        bad = struct.pack('>BI', PROTOCOL_VERSION, len(body)) + body
+        assert_raises(ValueError, decode_frames, bad)
+        bad = struct.pack('>BI', PROTOCOL_VERSION, 3) + '\0\0\0'.encode('ascii')
+        assert_raises(ValueError, decode_frames, bad)
+        bad = struct.pack('>BI', PROTOCOL_VERSION, 1 << 30)
+        assert_raises(ValueError, decode_frames, bad)
+
+    def test_partial(self):
+        data = encode_frame([('status', 'ok')]) * 2
+        for end in range(len(data) + 1):
+            frames, used = decode_frames(data[:end])
+            assert used == len(frames) * (len(data) // 2)
+
+    def test_reader(self):
+        frames = [encode_frame([('pid', i)]) for i in range(3)]
+        reader = frame_reader(reader_of([''.encode('ascii').join(frames)]))
+        assert [reader.next_frame() for i in range(4)] == \
+                [{'pid': '0'}, {'pid': '1'}, {'pid': '2'}, None]
+        reader = frame_reader(reader_of([frames[0][:3]]))
+        assert_raises(ValueError, reader.next_frame)
+        reader = frame_reader(reader_of([frames[0][:-1]]))
+        assert_raises(ValueError, reader.next_frame)
+
+    def test_fuzz_round_trip(self):
+        rnd = random.Random(1)
+        names = ['op', 'command', 'args', 'cwd', 'parent_sid', 'status',
+                 'message', 'stdin', 'stdout', 'stderr']
+        messages = []
+        for i in range(200):
+            message = {}
+            for name in rnd.sample(names, rnd.randint(0, len(names))):
+                message[name] = random_text(rnd, rnd.randint(0, 50))
+            if rnd.random() < 0.5:
+                message['env'] = dict([('V%d' % j, random_text(rnd, 10)
+                                        .replace('\0', ''))
+                                       for j in range(rnd.randint(0, 5))])
+            messages.append(message)
+        data = ''.encode('ascii').join([encode_frame(m.items())
+                                        for m in messages])
+        # Any split of the stream into reads gives the same messages.
+        for bufsize in (1, 7, 4096):
+            pos = [0]
+            def read(size):
+                size = rnd.randint(1, max(1, min(size, bufsize)))
+                chunk = data[pos[0]:pos[0]+size]
+                pos[0] += len(chunk)
+                return chunk
+            reader = frame_reader(read, bufsize)
+            decoded = []
+            while True:
+                frame = reader.next_frame()
+                if frame is None:
+                    break
+                decoded.append(frame)
+            assert decoded == messages
+
+    def test_fuzz_garbage(self):
+        rnd = random.Random(2)
+        frame = encode_frame([('command', 'cmd.exe'), ('args', 'cmd.exe'),
+                              ('env', {'A': 'B'})])
+        for i in range(2000):
+            data = bytearray(frame)
+            for j in range(rnd.randint(1, 4)):
+                data[rnd.randrange(len(data))] = rnd.randrange(256)
+            data = bytes(data[:rnd.randint(0, len(data))])
+            # Damaged frames decode or raise ValueError, nothing else.
+            try:
+                decode_frames(data, maxsize=1024)
+                frame_reader(reader_of([data]), maxsize=1024).next_frame()
+            except ValueError:
+                pass
+
+    def test_throughput(self):
+        # A large value that arrives in small reads is read in linear time.
+        value = 'x' * (4 << 20)
+        data = encode_frame([('message', value)])
+        chunks = [data[i:i+4096] for i in range(0, len(data), 4096)]
+        start = time.time()
+        frame = frame_reader(reader_of(chunks)).next_frame()
+        assert frame['message'] == value
+        # Many small frames that arrive in one read.
+        data = encode_frame([('status', 'ok'), ('pid', 1)]) * 50000
+        frames, used = decode_frames(data)
+        reader = frame_reader(reader_of([data]))
+        for i in range(50000):
+            assert reader.next_frame() == {'status': 'ok', 'pid': '1'}
+        assert reader.next_frame() is None
+        assert time.time() - start < 10
+
+
+class TestBroker(object):
+
+    codec = header_codec
+    binary = False
+
+    def setUp(self):
+        (sread, swrite), (cread, cwrite), self.fds = channel(self.binary)
+        self.requests = []
+        self.broker = broker(sread, swrite, self.create_process, self.codec)
+        self.server = threading.Thread(target=self.broker.serve)
+        self.server.start()
+        self.client = broker_client(cread, cwrite, self.codec)
+
+    def tearDown(self):
+        if self.server.is_alive():
+            self.client.quit()
+        self.server.join()
+        for fd in self.fds:
+            os.close(fd)
+
+    def create_process(self, request):
+        if request['command'] == 'missing':
+            raise OSError('The system cannot find the file specified.')
+        self.requests.append(request)
+        return 1000 + len(self.requests)
+
+    def test_spawn(self):
+        for i in range(3):
+            reply = self.client.spawn('cmd.exe', 'cmd.exe /c echo %d' % i,
+                                      'in%d' % i, 'out%d' % i, 'err%d' % i)
+            assert reply == {'status': 'ok', 'pid': str(1001 + i)}
+        assert [r['args'] for r in self.requests] == \
+                ['cmd.exe /c echo %d' % i for i in range(3)]
+        assert self.requests[2]['stderr'] == 'err2'
+        assert 'env' not in self.requests[0]
+        assert self.broker.spawns == 3
+
+    def test_env_cwd(self):
+        env = {'PATH': r'C:\Windows', '=C:': 'C:\\temp'}
+        reply = self.client.spawn('cmd.exe', 'cmd.exe', 'in', 'out', 'err',
+                                  cwd=r'C:\temp', env=env, parent_sid='S-1-5')
+        assert reply['status'] == 'ok'
+        request = self.requests[0]
+        assert request['env'] == env
+        assert request['cwd'] == r'C:\temp'
+        assert request['parent_sid'] == 'S-1-5'
+
+    def test_error(self):
+        reply = self.client.spawn('missing', 'missing', 'in', 'out', 'err')
+        assert reply['status'] == 'error'
+        assert 'cannot find' in reply['message']
+        reply = self.client.request([('command', 'cmd.exe')])
+        assert reply['status'] == 'error'
+        # The broker keeps serving after an error.
+        reply = self.client.spawn('cmd.exe', 'cmd.exe', 'in', 'out', 'err')
+        assert reply == {'status': 'ok', 'pid': '1001'}
+
+    def test_concurrent(self):
+        replies = []
+        def spawn(i):
+            for j in range(10):
+                replies.append(self.client.spawn('cmd.exe', '%d %d' % (i, j),
+                                                 'in', 'out', 'err'))
+        threads = [threading.Thread(target=spawn, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pids = sorted([int(reply['pid']) for reply in replies])
+        assert pids == list(range(1001, 1041))
+
+    def test_quit(self):
+        assert self.client.quit() == {'status': 'ok'}
+        self.server.join(5)
+        assert not self.server.is_alive()
+
+
+class TestBrokerFrames(TestBroker):
+
+    codec = frame_codec
+    binary = True
+
+    def test_default(self):
+        (sread, swrite), (cread, cwrite), fds = channel(True)
+        try:
+            assert isinstance(broker(sread, swrite, None).channel, frame_codec)
+            assert isinstance(broker_client(cread, cwrite).channel,
+                              frame_codec)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def test_message(self):
+        message = 'line 1\nline 2\n\nline 4'
+        def create_process(request):
+            raise OSError(message)
+        self.broker.create_process = create_process
+        reply = self.client.spawn('cmd.exe', 'cmd.exe', 'in', 'out', 'err')
+        assert reply == {'status': 'error', 'message': message}
+
+
+class TestBrokerProcess(object):
+    """A broker that starts real processes, with files for their output."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.procs = []
+
+    def tearDown(self):
+        for name in os.listdir(self.tmpdir):
+            os.remove(os.path.join(self.tmpdir, name))
+        os.rmdir(self.tmpdir)
+
+    def create_process(self, request):
+        stdout = open(request['stdout'], 'w')
+        try:
+            proc = subprocess.Popen(shlex.split(request['args']),
+                                    stdout=stdout, env=request.get('env'),
+                                    cwd=request.get('cwd'))
+        finally:
+            stdout.close()
+        self.procs.append(proc)
+        return proc.pid
+
+    def test_processes(self):
+        (sread, swrite), (cread, cwrite), fds = channel(True)
+        server = threading.Thread(target=broker(sread, swrite,
+                self.create_process, frame_codec).serve)
+        server.start()
+        client = broker_client(cread, cwrite, frame_codec)
+        script = 'import os; print(os.environ["WORD"] + " " + os.getcwd())'
+        args = '%s -c \'%s\'' % (sys.executable, script)
+        env = dict(os.environ)
+        for i in range(3):
+            env['WORD'] = 'word%d' % i
+            name = os.path.join(self.tmpdir, 'out%d' % i)
+            reply = client.spawn(sys.executable, args, 'in', name, 'err',
+                                 cwd=self.tmpdir, env=env)
+            assert reply['status'] == 'ok'
+            assert int(reply['pid']) == self.procs[i].pid
+        client.quit()
+        server.join()
+        for fd in fds:
+            os.close(fd)
+        for i, proc in enumerate(self.procs):
+            assert proc.wait() == 0
+            output = open(os.path.join(self.tmpdir, 'out%d' % i)).read()
+            word, cwd = output.split()
+            assert word == 'word%d' % i
+            assert os.path.realpath(cwd) == os.path.realpath(self.tmpdir)
@@ -0,0 +1,1125 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+import os
+import re
+import gzip
+import time
+import shutil
+import tempfile
+import random
+import socket
+import threading
+from pexpect import (spawn, searcher_cache, expect_buffer, EOF, TIMEOUT,
+                     MAXBUFFER, session_group, expect_any, spawn_pool,
+                     run_many, log_writer)
+
+from nose.tools import assert_raises
+
+from helpers import socketspawn
+
+
+class scriptspawn(spawn):
+    """A spawn that reads its input from a list of chunks."""
+
+    def __init__(self, chunks, **kwargs):
+        super(scriptspawn, self).__init__(None, **kwargs)
+        self.chunks = list(chunks)
+        self.closed = False
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if not self.chunks:
+            self.flag_eof = True
+            raise EOF('End of script.')
+        chunk = self.chunks.pop(0)
+        if chunk is TIMEOUT:
+            raise TIMEOUT('Timeout in script.')
+        if len(chunk) > size:
+            self.chunks.insert(0, chunk[size:])
+            chunk = chunk[:size]
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+
+def tobytes(s):
+    """Return 's' as bytes, with one byte per character."""
+    if bytes is str:
+        return s
+    return s.encode('latin-1')
+
+
+class TestExpectBuffer(object):
+
+    def test_append(self):
+        b = expect_buffer()
+        for chunk in ('ab', '', 'cde', 'f'):
+            b.append(chunk)
+        assert len(b) == 6
+        assert b.getvalue() == 'abcdef'
+        assert len(expect_buffer()) == 0
+        assert expect_buffer().getvalue() == ''
+
+    def test_window(self):
+        b = expect_buffer()
+        for chunk in ('ab', 'cde', 'f'):
+            b.append(chunk)
+        assert b.window(6) == ('', 6)
+        assert b.window(5) == ('f', 5)
+        assert b.window(4) == ('ef', 4)
+        assert b.window(2) == ('cdef', 2)
+        assert b.window(0) == ('abcdef', 0)
+        assert b.getvalue() == 'abcdef'
+
+    def test_split(self):
+        b = expect_buffer()
+        for chunk in ('ab', 'cde', 'f'):
+            b.append(chunk)
+        front = b.split(3)
+        assert front.getvalue() == 'abc'
+        assert b.getvalue() == 'def'
+        assert len(front) == 3 and len(b) == 3
+        assert b.split(0).getvalue() == ''
+        assert b.split(3).getvalue() == 'def'
+        assert len(b) == 0
+
+    def test_copy(self):
+        b = expect_buffer('abc')
+        c = b.copy()
+        b.append('d')
+        assert c.getvalue() == 'abc'
+        assert b.getvalue() == 'abcd'
+
+
+class TestExpect(object):
+
+    def test_expect(self):
+        s = scriptspawn(['login', ': ', 'abc\r\n'])
+        assert s.expect(['foo', 'login: ']) == 1
+        assert s.before == ''
+        assert s.after == 'login: '
+        assert s.buffer == ''
+        assert s.expect('b') == 0
+        assert s.before == 'a'
+        assert s.readline() == 'c\r\n'
+
+    def test_eof(self):
+        s = scriptspawn(['abc'])
+        assert s.expect(['x', EOF]) == 1
+        assert s.before == 'abc'
+        assert s.after is EOF
+        assert_raises(EOF, s.expect, 'x')
+
+    def test_timeout(self):
+        s = scriptspawn(['abc', TIMEOUT, 'def'])
+        assert s.expect(['x', TIMEOUT]) == 1
+        assert s.before == 'abc'
+        assert s.expect('e') == 0
+        assert s.before == 'abcd'
+
+    def test_buffer_attributes(self):
+        s = scriptspawn(['xyz'])
+        s.buffer = 'abc'
+        assert s.expect('b') == 0
+        assert (s.before, s.after, s.buffer) == ('a', 'b', 'c')
+        assert s.expect('y') == 0
+        assert (s.before, s.after, s.buffer) == ('cx', 'y', 'z')
+
+    def test_expect_exact(self):
+        s = scriptspawn(['a.c', 'abc'])
+        assert s.expect_exact(['abc', 'a.c']) == 1
+        assert s.expect_exact('abc') == 0
+
+
+class recorder(object):
+    """A log file that records the writes."""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, s):
+        self.writes.append(s)
+
+    def flush(self):
+        pass
+
+
+class TestLowLatency(object):
+
+    def test_delays(self):
+        assert spawn(None).delaybeforesend > 0
+        assert spawn(None, lowlatency=True).delaybeforesend == 0
+
+    def test_sendline(self):
+        r, w = os.pipe()
+        try:
+            for lowlatency, writes in ((False, ['abc', os.linesep]),
+                                       (True, ['abc' + os.linesep])):
+                child = spawn(None, lowlatency=lowlatency)
+                child.delaybeforesend = 0
+                child.child_fd = w
+                child.logfile_send = recorder()
+                assert child.sendline('abc') == 3 + len(os.linesep)
+                assert child.logfile_send.writes == writes
+                assert os.read(r, 100).decode('ascii') == 'abc' + os.linesep
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_expect(self):
+        child = scriptspawn(['ab', 'c> '], lowlatency=True)
+        assert child.expect('> ') == 0
+        assert child.before == 'abc'
+
+
+class TestBinary(object):
+
+    def test_expect(self):
+        child = socketspawn(binary=True)
+        child.peer.sendall(tobytes('caf\xe9\r\n> '))
+        assert child.expect([tobytes('\xe9'), tobytes('> ')]) == 0
+        assert child.before == tobytes('caf')
+        assert child.expect_exact(tobytes('> ')) == 0
+        assert child.before == tobytes('\r\n')
+        assert child.buffer == tobytes('')
+        child.close()
+
+    def test_readline(self):
+        child = socketspawn(binary=True)
+        child.peer.sendall(tobytes('\xff\r\nx'))
+        child.peer.shutdown(socket.SHUT_WR)
+        assert child.readline() == tobytes('\xff\r\n')
+        assert child.readline() == tobytes('x')
+        assert child.readline() == tobytes('')
+        child.close()
+
+    def test_send(self):
+        child = socketspawn(binary=True)
+        child.delaybeforesend = 0
+        child.logfile_send = recorder()
+        child.sendline(tobytes('\xe9'))
+        child.sendcontrol('c')
+        data = tobytes('\xe9') + os.linesep.encode('ascii') + tobytes('\x03')
+        assert child.peer.recv(100) == data
+        assert tobytes('').join(child.logfile_send.writes) == data
+        child.close()
+
+    def test_text(self):
+        child = socketspawn()
+        child.delaybeforesend = 0
+        assert_raises(UnicodeError, child.send, '\xe9')
+        child.peer.sendall(tobytes('abc'))
+        assert child.expect('b') == 0
+        assert child.before == 'a'
+        child.close()
+
+
+class TestLines(object):
+
+    def test_readline(self):
+        child = scriptspawn(['ab\r', '\ncd\r\nef'])
+        assert child.readline() == 'ab\r\n'
+        assert child.readline() == 'cd\r\n'
+        assert child.readline() == 'ef'
+        assert child.readline() == ''
+
+    def test_iter(self):
+        child = scriptspawn(['a\r\nb', '\r\n\r\n', 'c'])
+        assert list(child) == ['a\r\n', 'b\r\n', '\r\n', 'c']
+        child = scriptspawn(['a\r\nb', '\r\n\r\n', 'c'])
+        assert child.readlines() == ['a\r\n', 'b\r\n', '\r\n', 'c']
+
+    def test_iterlines_batch(self):
+        child = scriptspawn(['a\r\nb\r\nc\r\n', 'd\r\ne'])
+        batches = list(child.iterlines(batch=2))
+        assert batches == [['a\r\n', 'b\r\n'], ['c\r\n'], ['d\r\n'], ['e']]
+
+    def test_lineterminator(self):
+        child = scriptspawn(['a\nb\r\n'])
+        child.lineterminator = '\n'
+        assert list(child.iterlines()) == ['a\n', 'b\r\n']
+
+    def test_mixed_with_expect(self):
+        child = scriptspawn(['l1\r\nl2\r\nprompt> '])
+        assert child.readline() == 'l1\r\n'
+        assert child.buffer == 'l2\r\nprompt> '
+        assert child.readline() == 'l2\r\n'
+        child = scriptspawn(['l1\r\nl2\r\nprompt> ', 'l3\r\n'])
+        assert child.readline() == 'l1\r\n'
+        assert child.expect('> ') == 0
+        assert child.before == 'l2\r\nprompt'
+        assert child.readline() == 'l3\r\n'
+
+    def test_timeout(self):
+        child = scriptspawn(['ab', TIMEOUT, 'c\r\n'])
+        assert_raises(TIMEOUT, child.readline)
+        assert child.buffer == 'ab'
+        assert child.readline() == 'abc\r\n'
+
+    def test_delimiter(self):
+        child = scriptspawn(['a\r\nb!c\r\n'])
+        child.delimiter = '!'
+        assert child.readline() == 'a\r\n'
+        assert child.readline() == 'b'
+        assert child.readline() == 'c\r\n'
+
+    def test_random(self):
+        rnd = random.Random(2468)
+        for i in range(100):
+            text = ''.join([rnd.choice('ab\r\n') for k in range(50)])
+            chunks = []
+            pos = 0
+            while pos < len(text):
+                n = rnd.randint(1, 7)
+                chunks.append(text[pos:pos+n])
+                pos += n
+            lines = [line + '\r\n' for line in text.split('\r\n')]
+            lines[-1] = lines[-1][:-2]
+            if not lines[-1]:
+                del lines[-1]
+            child = scriptspawn(chunks, maxread=rnd.randint(1, 10))
+            batches = list(child.iterlines(batch=rnd.randint(1, 3)))
+            assert sum(batches, []) == lines
+            child = scriptspawn(chunks, maxread=rnd.randint(1, 10))
+            assert list(child) == lines
+
+
+class TestRead(object):
+
+    def test_read(self):
+        child = scriptspawn(['ab', 'cdef', 'g'])
+        assert child.read(3) == 'abc'
+        assert child.buffer == 'def'
+        assert child.read(2) == 'de'
+        assert child.read(10) == 'fg'
+        assert child.read(10) == ''
+        assert child.read(0) == ''
+
+    def test_read_all(self):
+        child = scriptspawn(['ab', 'cd'])
+        assert child.read(1) == 'a'
+        assert child.read() == 'bcd'
+
+    def test_timeout(self):
+        child = scriptspawn(['ab', TIMEOUT, 'cd'])
+        assert_raises(TIMEOUT, child.read, 3)
+        assert child.buffer == 'ab'
+        assert child.read(3) == 'abc'
+
+    def test_after_readline(self):
+        child = scriptspawn(['a\r\nb\r\nc'])
+        assert child.readline() == 'a\r\n'
+        assert child.read(4) == 'b\r\nc'
+
+    def test_delimiter(self):
+        child = scriptspawn(['ab!cd'])
+        child.delimiter = '!'
+        assert child.read(10) == 'ab'
+
+    def test_readinto(self):
+        child = scriptspawn(['abc', 'de'])
+        b = bytearray(4)
+        assert child.readinto(b) == 4
+        assert b == bytearray(tobytes('abcd'))
+        assert child.readinto(b) == 1
+        assert b[:1] == bytearray(tobytes('e'))
+        assert child.readinto(b) == 0
+
+
+class TestMaxBuffer(object):
+
+    def chunks(self):
+        return ['%04d' % i for i in range(100)] + ['END']
+
+    def test_unbounded(self):
+        child = scriptspawn(self.chunks())
+        assert child.expect('END') == 0
+        assert len(child.before) == 400
+
+    def test_raise(self):
+        child = scriptspawn(self.chunks())
+        child.maxbuffer = 40
+        assert_raises(MAXBUFFER, child.expect, 'END')
+        assert child.before == ''.join(self.chunks()[:11])
+
+    def test_window(self):
+        child = scriptspawn(self.chunks())
+        child.maxbuffer = 40
+        child.maxbufferpolicy = 'window'
+        assert child.expect(['0005', 'END']) == 0
+        assert child.expect(['x', 'END']) == 1
+        assert len(child.before) <= 40
+        assert child.before.endswith('0099')
+
+    def test_window_searchwindowsize(self):
+        child = scriptspawn(self.chunks(), searchwindowsize=8)
+        child.maxbuffer = 40
+        child.maxbufferpolicy = 'window'
+        assert child.expect(['END']) == 0
+        assert child.before.endswith('00980099')
+        assert len(child.before) <= 40
+
+    def test_headtail(self):
+        child = scriptspawn(self.chunks())
+        child.maxbuffer = 40
+        child.maxbufferpolicy = 'headtail'
+        assert child.expect(['END']) == 0
+        assert child.before.startswith(''.join(self.chunks()[:5]))
+        assert child.before.endswith('0099')
+        assert len(child.before) <= 40
+
+    def test_headtail_eof(self):
+        child = scriptspawn(self.chunks()[:-1])
+        child.maxbuffer = 40
+        child.maxbufferpolicy = 'headtail'
+        assert child.expect(['END', EOF]) == 1
+        assert child.before.startswith('00000001')
+        assert child.before.endswith('0099')
+
+    def test_straddling_trim(self):
+        child = scriptspawn(['x' * 30, 'ab', 'cd'])
+        child.maxbuffer = 31
+        child.maxbufferpolicy = 'window'
+        assert child.expect('abcd') == 0
+        assert child.before == 'x' * 13
+
+    def test_match_in_last_chunk(self):
+        # The chunk with the prompt pushes the buffer past maxbuffer; it is
+        # searched before the policy is applied.
+        for policy in ('raise', 'window', 'headtail'):
+            child = scriptspawn(['x' * 900, 'y' * 150 + 'PROMPT> '])
+            child.maxbuffer = 1000
+            child.maxbufferpolicy = policy
+            assert child.expect('PROMPT> ') == 0, policy
+            assert child.before == 'x' * 900 + 'y' * 150
+
+    def test_keep_last_chunk(self):
+        # The chunk that was just read is kept whole, so a match that
+        # continues in the next chunk is found.
+        for policy in ('window', 'headtail'):
+            child = scriptspawn(['x' * 900, 'PROMPT' + 'z' * 1000, '> '])
+            child.maxbuffer = 1000
+            child.maxbufferpolicy = policy
+            assert child.expect(r'PROMPTz+> ') == 0, policy
+            child = scriptspawn(['x' * 900, 'PROMPT> ' + 'z' * 1000])
+            child.maxbuffer = 1000
+            child.maxbufferpolicy = policy
+            assert child.expect('PROMPT> ') == 0, policy
+
+
+
+class TestBeforeSink(object):
+
+    def chunks(self):
+        return ['line %d\r\n' % i for i in range(50)] + ['BUILD DONE\r\n']
+
+    def test_callable(self):
+        sunk = []
+        child = scriptspawn(self.chunks())
+        assert child.expect('BUILD DONE', before_sink=sunk.append) == 0
+        assert ''.join(sunk) + child.before == ''.join(self.chunks()[:-1])
+        assert len(child.before) < 20
+        assert child.after == 'BUILD DONE'
+
+    def test_file(self):
+        sink = recorder()
+        child = scriptspawn(self.chunks())
+        child.before_sink = sink
+        assert child.expect_exact(['BUILD DONE']) == 0
+        assert ''.join(sink.writes) + child.before == \
+                ''.join(self.chunks()[:-1])
+        assert len(child.before) < 20
+
+    def test_override(self):
+        sink = recorder()
+        child = scriptspawn(self.chunks())
+        child.before_sink = sink
+        assert child.expect('BUILD DONE', before_sink=None) == 0
+        assert sink.writes == []
+        assert child.before == ''.join(self.chunks()[:-1])
+
+    def test_unbounded(self):
+        sunk = []
+        child = scriptspawn(self.chunks())
+        assert child.expect('B.*E', before_sink=sunk.append) == 0
+        assert sunk == []
+        child = scriptspawn(self.chunks())
+        assert child.expect('B.*E', before_sink=sunk.append,
+                            searchwindowsize=100) == 0
+        assert ''.join(sunk) + child.before == ''.join(self.chunks()[:-1])
+
+    def test_straddling(self):
+        sunk = []
+        child = scriptspawn(['x' * 10, 'BUI', 'LD', ' DONE'])
+        assert child.expect('(?<=x)BUILD DONE', before_sink=sunk.append) == 0
+        assert ''.join(sunk) + child.before == 'x' * 10
+        assert sunk and child.before
+
+    def test_eof(self):
+        sunk = []
+        child = scriptspawn(self.chunks()[:-1])
+        assert child.expect(['DONE', EOF], before_sink=sunk.append) == 1
+        assert ''.join(sunk) + child.before == ''.join(self.chunks()[:-1])
+
+
+class TestSearcherCache(object):
+
+    def setUp(self):
+        self.saved = scriptspawn.searchercache
+        scriptspawn.searchercache = searcher_cache(2)
+
+    def tearDown(self):
+        scriptspawn.searchercache = self.saved
+
+    def test_hits(self):
+        s = scriptspawn(['a\r\nb\r\nc\r\n'])
+        cache = s.searchercache
+        for i in range(3):
+            s.expect('\r\n')
+        assert (cache.hits, cache.misses) == (2, 1)
+        assert len(cache) == 1
+
+    def test_searcher_reused(self):
+        s = scriptspawn(['abcabc'])
+        s.expect(['b', 'c'])
+        searcher = s.searcher
+        s.expect(['b', 'c'])
+        assert s.searcher is searcher
+        s.ignorecase = True
+        s.expect(['b', 'c'])
+        assert s.searcher is not searcher
+
+    def test_kinds(self):
+        s = scriptspawn(['abcabcabc'])
+        s.expect('b')
+        s.expect_exact('b')
+        s.expect_list([re.compile('b')])
+        assert s.searchercache.misses == 3
+
+    def test_lru(self):
+        cache = searcher_cache(2)
+        cache.checkin('a', 1)
+        cache.checkin('b', 2)
+        assert cache.checkout('a') == 1
+        cache.checkin('a', 1)
+        cache.checkin('c', 3)
+        assert cache.checkout('b') is None
+        assert cache.checkout('a') == 1
+        assert cache.checkout('c') == 3
+        assert (cache.hits, cache.misses) == (3, 1)
+
+    def test_stale_order(self):
+        cache = searcher_cache(3)
+        for i in range(1000):
+            cache.checkin('a', 1)
+            assert cache.checkout('a') == 1
+        cache.checkin('b', 2)
+        cache.checkin('a', 1)
+        cache.checkin('c', 3)
+        cache.checkin('b', 2)
+        cache.checkin('d', 4)
+        # 'a' was used least recently; 'b' was checked in again.
+        assert cache.checkout('a') is None
+        assert [cache.checkout(k) for k in 'bcd'] == [2, 3, 4]
+        assert len(cache._order) < 30
+
+    def test_checked_out(self):
+        cache = searcher_cache(2)
+        cache.checkin('a', 1)
+        assert cache.checkout('a') == 1
+        assert cache.checkout('a') is None
+
+    def test_unhashable(self):
+        s = scriptspawn(['abc'])
+        assert s._searcher_key('re', [['b']]) is None
+        assert_raises(TypeError, s.expect, [['b']])
+
+
+class queuespawn(spawn):
+    """A spawn that has no file descriptor, like winspawn. Its output is
+    fed from another thread and it calls its output waker."""
+
+    def __init__(self, **kwargs):
+        super(queuespawn, self).__init__(None, **kwargs)
+        self.output = []
+        self.eof = False
+        self.waker = None
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def _set_output_waker(self, waker):
+        self.waker = waker
+        return True
+
+    def feed(self, data=None):
+        self.lock.acquire()
+        try:
+            if data is None:
+                self.eof = True
+            else:
+                self.output.append(data)
+        finally:
+            self.lock.release()
+        if self.waker is not None:
+            self.waker()
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        self.lock.acquire()
+        try:
+            if self.output:
+                return self.output.pop(0)
+            if self.eof:
+                raise EOF('End of output.')
+            raise TIMEOUT('No output.')
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.closed = True
+
+
+class TestSessionGroup(object):
+
+    def setUp(self):
+        self.children = [socketspawn(timeout=5) for i in range(50)]
+
+    def tearDown(self):
+        for child in self.children:
+            child.close()
+
+    def send(self, i, data, delay=0):
+        peer = self.children[i].peer
+        if delay:
+            threading.Timer(delay, peer.send, (data.encode('ascii'),)).start()
+        else:
+            peer.send(data.encode('ascii'))
+
+    def test_first_match(self):
+        group = session_group()
+        for child in self.children:
+            group.add(child, ['ready', EOF])
+        self.send(3, 'not yet ')
+        self.send(37, 'get ready!', 0.05)
+        child, index = group.expect()
+        assert (child, index) == (self.children[37], 0)
+        assert child.before == 'get '
+        assert child.after == 'ready'
+        assert group.session is child
+        assert len(group) == 49
+        self.send(3, 'ready', 0.01)
+        child, index = group.expect()
+        assert (child, index) == (self.children[3], 0)
+        assert child.before == 'not yet '
+        group.close()
+        assert len(group) == 0
+
+    def test_buffered(self):
+        child = self.children[0]
+        child.buffer = 'xyz'
+        group = session_group()
+        group.add(self.children[1], 'y')
+        group.add(child, 'y')
+        assert group.expect() == (child, 0)
+        assert child.buffer == 'z'
+
+    def test_exact(self):
+        group = session_group()
+        group.add(self.children[0], '.*', exact=True)
+        self.send(0, 'a.*b')
+        assert group.expect() == (self.children[0], 0)
+        assert self.children[0].before == 'a'
+
+    def test_per_session_timeout(self):
+        group = session_group()
+        group.add(self.children[0], ['x', TIMEOUT], timeout=0.05)
+        group.add(self.children[1], 'x', timeout=0.2)
+        assert group.expect() == (self.children[0], 1)
+        assert self.children[0].after is TIMEOUT
+        assert_raises(TIMEOUT, group.expect)
+        assert group.session is self.children[1]
+        assert len(group) == 0
+
+    def test_exception(self):
+        group = session_group()
+        group.add(self.children[0], 'x')
+        group.add(self.children[1], 'x')
+        self.send(1, 'last')
+        self.children[1].peer.shutdown(socket.SHUT_WR)
+        assert_raises(EOF, group.expect)
+        assert group.session is self.children[1]
+        assert self.children[1].before == 'last'
+        assert len(group) == 1
+
+    def test_group_timeout(self):
+        group = session_group()
+        group.add(self.children[0], 'x')
+        assert_raises(TIMEOUT, group.expect, 0.05)
+        assert len(group) == 1
+        self.send(0, 'x')
+        assert group.expect(1) == (self.children[0], 0)
+
+    def test_remove(self):
+        group = session_group()
+        group.add(self.children[0], 'x')
+        assert_raises(ValueError, group.add, self.children[0], 'y')
+        self.send(0, 'abc')
+        assert_raises(TIMEOUT, group.expect, 0.05)
+        group.remove(self.children[0])
+        assert self.children[0].before == 'abc'
+        assert self.children[0].buffer == 'abc'
+        assert_raises(ValueError, group.remove, self.children[0])
+        assert_raises(ValueError, group.expect)
+
+    def test_expect_any(self):
+        self.send(1, 'partial')
+        self.send(2, 'done', 0.05)
+        child, index = expect_any(self.children, ['done', EOF])
+        assert (child, index) == (self.children[2], 0)
+        assert self.children[1].buffer == 'partial'
+        # The children can be used on their own again.
+        self.send(1, ' done')
+        assert self.children[1].expect('done') == 0
+        assert self.children[1].before == 'partial '
+
+    def test_queue(self):
+        children = [queuespawn() for i in range(10)]
+        group = session_group()
+        for child in children:
+            group.add(child, ['ok', EOF])
+        assert_raises(ValueError, group.add, self.children[0], 'x')
+        threading.Timer(0.02, children[4].feed, ('o',)).start()
+        threading.Timer(0.04, children[4].feed, ('k',)).start()
+        threading.Timer(0.06, children[7].feed).start()
+        assert group.expect() == (children[4], 0)
+        assert group.expect() == (children[7], 1)
+        assert children[7].after is EOF
+        group.close()
+        assert [c.waker for c in children] == [None] * 10
+
+    def test_queue_timeout(self):
+        child = queuespawn()
+        group = session_group()
+        group.add(child, 'ok')
+        start = time.time()
+        assert_raises(TIMEOUT, group.expect, 0.05)
+        assert 0.04 < time.time() - start < 1
+        # The waker wakes up a wait with a timeout.
+        threading.Timer(0.02, child.feed, ('ok',)).start()
+        start = time.time()
+        assert group.expect(5) == (child, 0)
+        assert time.time() - start < 1
+
+
+class TestSpawnPool(object):
+
+    def setUp(self):
+        self.made = []
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.close()
+        for child in self.made:
+            child.close()
+
+    def factory(self, command, args, **kwargs):
+        assert (command, args) == ('sh', ['-i'])
+        child = socketspawn(**kwargs)
+        self.made.append(child)
+        return child
+
+    def make_pool(self, size, **kwargs):
+        self.pool = spawn_pool('sh', ['-i'], size, self.factory, **kwargs)
+        end_time = time.time() + 5
+        while len(self.pool) < size and time.time() < end_time:
+            time.sleep(0.01)
+        assert len(self.pool) == size
+        return self.pool
+
+    def test_checkout(self):
+        setups = []
+        pool = self.make_pool(2, setup=setups.append, timeout=7)
+        assert len(setups) == 2
+        child = pool.checkout()
+        assert child in self.made
+        assert child.timeout == 7
+        assert pool.hits == 1 and pool.misses == 0
+        # The pool is refilled in the background.
+        while len(self.made) < 3:
+            time.sleep(0.01)
+        pool.checkin(child)
+        assert len(pool) == 2 or child.closed
+        assert pool.hit_rate == 1.0
+        assert pool.saved > 0
+        pool.close()
+        assert len(pool) == 0
+        assert [c for c in self.made if not c.closed] == []
+        assert_raises(ValueError, pool.checkout)
+
+    def test_miss(self):
+        pool = self.make_pool(0)
+        child = pool.checkout()
+        assert pool.misses == 1 and pool.hits == 0
+        assert pool.hit_rate == 0.0
+        assert pool.spawns == 1
+        # The pool is full, so the child is closed.
+        pool.checkin(child)
+        assert child.closed
+        assert len(pool) == 0
+
+    def test_reset(self):
+        pool = self.make_pool(1, reset=lambda child: child.buffer == '')
+        child = pool.checkout()
+        child.buffer = 'dirty'
+        pool.checkin(child)
+        assert child.closed
+        assert pool.discarded == 1
+        child = pool.checkout()
+        pool.checkin(child)
+        assert not child.closed
+
+    def test_healthcheck(self):
+        def healthcheck(child):
+            return child.peer.send(tobytes('?'))
+        pool = self.make_pool(2, healthcheck=healthcheck)
+        first = pool._idle[0]
+        first.peer.close()
+        child = pool.checkout()
+        assert child is not first
+        assert first.closed
+        assert pool.discarded == 1
+
+    def test_sweep(self):
+        pool = self.make_pool(2, checkinterval=0.05)
+        dead = pool._idle[0]
+        dead.close()
+        end_time = time.time() + 5
+        while dead in pool._idle and time.time() < end_time:
+            time.sleep(0.01)
+        assert dead not in pool._idle
+        while len(pool) < 2 and time.time() < end_time:
+            time.sleep(0.01)
+        assert len(pool) == 2
+        assert pool.discarded == 1
+
+    def test_sweep_takes_out(self):
+        pool = self.make_pool(2, checkinterval=0.01)
+        pooled = []
+        for child in pool._idle:
+            def isalive(child=child):
+                pooled.append(child in pool._idle)
+                return not child.closed
+            child.isalive = isalive
+        end_time = time.time() + 5
+        while len(pooled) < 10 and time.time() < end_time:
+            time.sleep(0.01)
+        # A child that is probed cannot be checked out at the same time.
+        assert len(pooled) >= 10 and True not in pooled
+        assert pool.discarded == 0
+        child = pool.checkout()
+        assert pool.hits == 1
+        pool.checkin(child)
+
+    def test_broken(self):
+        def setup(child):
+            raise EOF('The child died.')
+        pool = spawn_pool('sh', ['-i'], 1, self.factory, setup=setup)
+        self.pool = pool
+        assert_raises(EOF, pool.checkout)
+        while not pool.errors:
+            time.sleep(0.01)
+        assert len(pool) == 0
+        assert [c for c in self.made if not c.closed] == []
+
+
+class commandspawn(socketspawn):
+    """A socketspawn whose other end plays a command: 'echo TEXT' writes the
+    text, 'ask' asks for a password and echoes it, 'hang' writes nothing.
+    The exit status is 0 for the commands that finish."""
+
+    searchercache = searcher_cache(10)
+
+    def __init__(self, command, **kwargs):
+        super(commandspawn, self).__init__(**kwargs)
+        self.command = command
+        self.finished = False
+        thread = threading.Thread(target=self.play)
+        thread.setDaemon(True)
+        thread.start()
+
+    def play(self):
+        name = self.command.split(' ')[0]
+        if name == 'hang':
+            return
+        if name == 'echo':
+            self.peer.sendall(tobytes(self.command[5:] + '\r\n'))
+        elif name == 'ask':
+            self.peer.sendall(tobytes('Password: '))
+            try:
+                reply = self.peer.recv(100)
+            except socket.error:
+                return  # Closed by the test.
+            if not reply:
+                return
+            self.peer.sendall(tobytes('got ') + reply)
+        self.finished = True
+        self.peer.shutdown(socket.SHUT_WR)
+
+    def close(self):
+        if not self.closed and self.finished:
+            self.exitstatus = 0
+        super(commandspawn, self).close()
+
+
+class TestRunMany(object):
+
+    def setUp(self):
+        self.made = []
+        self.most = 0
+
+    def tearDown(self):
+        for child in self.made:
+            child.close()
+
+    def factory(self, command, **kwargs):
+        child = commandspawn(command, **kwargs)
+        self.made.append(child)
+        running = len([c for c in self.made if not c.closed])
+        self.most = max(self.most, running)
+        return child
+
+    def test_run_many(self):
+        commandspawn.searchercache.clear()
+        commands = ['echo %d' % i for i in range(20)]
+        results = list(run_many(commands, concurrency=4,
+                                factory=self.factory))
+        assert sorted(results) == sorted([(c, c[5:] + '\r\n', 0)
+                                          for c in commands])
+        assert self.most == 4
+        assert [c for c in self.made if not c.closed] == []
+        # The searchers were reused.
+        assert commandspawn.searchercache.misses <= 4
+
+    def test_events(self):
+        results = list(run_many(['ask', 'echo x'],
+                                events={'Password: ': 'secret\n'},
+                                factory=self.factory))
+        assert sorted(results) == [('ask', 'Password: got secret\n', 0),
+                                   ('echo x', 'x\r\n', 0)]
+
+    def test_timeout(self):
+        results = list(run_many(['hang', 'echo x'], timeout=0.1,
+                                factory=self.factory))
+        assert results == [('echo x', 'x\r\n', 0), ('hang', '', None)]
+        assert self.made[0].closed
+
+    def test_callback(self):
+        seen = []
+        def stop(d):
+            seen.append(d)
+            return True
+        results = list(run_many(['ask'], events={'Password: ': stop},
+                                extra_args='extra', factory=self.factory))
+        assert results == [('ask', 'Password: ', None)]
+        assert seen == [{'child': self.made[0], 'command': 'ask',
+                         'event_count': 0, 'extra_args': 'extra'}]
+
+    def test_close(self):
+        results = run_many(['echo x', 'hang'], factory=self.factory)
+        assert results.next() == ('echo x', 'x\r\n', 0)
+        results.close()
+        assert [c for c in self.made if not c.closed] == []
+
+
+class slowfile(object):
+    """A file object that records its writes and flushes."""
+
+    def __init__(self):
+        self.writes = []
+        self.flushes = 0
+
+    def write(self, s):
+        self.writes.append(s)
+
+    def flush(self):
+        self.flushes += 1
+
+
+def bounded(func, limit=5):
+    """Call `func' in a thread and return its result, or raise what it
+    raised. A call that takes more than `limit' seconds fails the test
+    instead of holding it up."""
+    result = []
+    def run():
+        try:
+            result.append((True, func()))
+        except Exception, e:
+            result.append((False, e))
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+    thread.join(limit)
+    assert result, '%s did not return within %s seconds' % (func, limit)
+    ok, value = result[0]
+    if not ok:
+        raise value
+    return value
+
+
+class TestLogWriter(object):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, path, compressed=False):
+        if compressed:
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_batch(self):
+        out = slowfile()
+        writer = log_writer(out, interval=60)
+        for i in range(100):
+            writer.write('%d,' % i)
+            writer.flush()
+        assert out.writes == []
+        # The thread waits for the interval; sync() does not.
+        bounded(writer.sync)
+        assert out.writes == [''.join(['%d,' % i for i in range(100)])]
+        assert out.flushes == 1
+        assert writer.chunks == 100 and writer.batches == 1
+        writer.write('x')
+        bounded(writer.sync)
+        assert out.writes[1:] == ['x']
+        bounded(writer.close)
+        assert_raises(ValueError, writer.write, 'x')
+        writer.close()
+
+    def test_threshold(self):
+        out = slowfile()
+        writer = log_writer(out, interval=60, threshold=10)
+        writer.write('x' * 10)
+        end_time = time.time() + 5
+        while not out.writes and time.time() < end_time:
+            time.sleep(0.01)
+        assert out.writes == ['x' * 10]
+        writer.close()
+
+    def test_interval(self):
+        out = slowfile()
+        writer = log_writer(out, interval=0.05)
+        writer.write('abc')
+        end_time = time.time() + 5
+        while not out.writes and time.time() < end_time:
+            time.sleep(0.01)
+        assert out.writes == ['abc']
+        writer.close()
+
+    def test_path(self):
+        writer = log_writer(self.path, interval=60)
+        writer.write('text\n')
+        writer.write(tobytes('bytes\n'))
+        writer.close()
+        assert self.read(self.path) == tobytes('text\nbytes\n')
+        # A path is appended to.
+        writer = log_writer(self.path)
+        writer.write('more\n')
+        writer.close()
+        assert self.read(self.path) == tobytes('text\nbytes\nmore\n')
+
+    def test_compress(self):
+        writer = log_writer(self.path, threshold=100, compress=True)
+        data = ''.join(['line %d\n' % i for i in range(1000)])
+        for i in range(0, len(data), 37):
+            writer.write(data[i:i+37])
+        writer.close()
+        assert self.read(self.path, True) == tobytes(data)
+        assert os.path.getsize(self.path) < len(data) // 2
+
+    def test_rotate(self):
+        writer = log_writer(self.path, threshold=1, maxbytes=10, backups=2)
+        for c in 'abcd':
+            writer.write(c * 10)
+            writer.sync()
+        writer.close()
+        assert writer.rotations == 4
+        assert self.read(self.path) == tobytes('')
+        assert self.read(self.path + '.1') == tobytes('d' * 10)
+        assert self.read(self.path + '.2') == tobytes('c' * 10)
+        assert not os.path.exists(self.path + '.3')
+        assert_raises(ValueError, log_writer, slowfile(), maxbytes=10)
+
+    def test_error(self):
+        class brokenfile(slowfile):
+            def write(self, s):
+                raise IOError('disk full')
+        writer = log_writer(brokenfile(), interval=60)
+        writer.write('x')
+        assert_raises(IOError, bounded, writer.sync)
+        # The thread has stopped, so the error is kept.
+        assert_raises(IOError, writer.write, 'y')
+        assert_raises(IOError, bounded, writer.sync)
+        assert len(writer._pending) == 0
+        assert_raises(IOError, bounded, writer.close)
+        writer.close()
+
+    def test_sync_early(self):
+        gate = threading.Event()
+        class latewriter(log_writer):
+            def _writer(self):
+                gate.wait()
+                log_writer._writer(self)
+        out = slowfile()
+        writer = latewriter(out, interval=60)
+        writer.write('x')
+        # sync() is called before the thread waits for its notify.
+        def sync():
+            threading.Timer(0.1, gate.set).start()
+            writer.sync()
+        bounded(sync)
+        assert out.writes == ['x']
+        bounded(writer.close)
+
+    def test_threshold_count(self):
+        out = slowfile()
+        writer = log_writer(out, interval=60, threshold=100)
+        for i in range(10):
+            writer.write('x' * 9)
+        bounded(writer.sync)
+        # The bytes of the batch are not counted towards the next one.
+        writer.write('x' * 50)
+        writer.write('x' * 50)
+        end_time = time.time() + 5
+        while len(out.writes) < 2 and time.time() < end_time:
+            time.sleep(0.01)
+        assert out.writes[1:] == ['x' * 100]
+        writer.close()
+
+    def test_spawn(self):
+        child = socketspawn(timeout=5)
+        child.logfile_read = log_writer(self.path, interval=60)
+        child.logfile_send = slowfile()
+        child.send('hello\n')
+        child.peer.sendall(tobytes('line\n'))
+        child.expect('line')
+        assert child.logfile_send.writes == ['hello\n']
+        child.close()
+        # terminate() writes the logs.
+        child.terminate()
+        assert self.read(self.path) == tobytes('line\n')
+        child.logfile_read.close()
@@ -0,0 +1,238 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+import os
+import sys
+import socket
+import random
+import threading
+import subprocess
+from winpexpect_mux import (mux_channel, demuxer, relay, encode_packets,
+                            encode_eof, STDIN, STDOUT, STDERR, CONTROL)
+
+from nose.tools import assert_raises
+
+from helpers import b, reader_of
+
+
+def socket_channel(sock):
+    """Return a mux_channel over a socket."""
+    return mux_channel(sock.recv, sock.sendall)
+
+
+class TestPackets(object):
+
+    def test_encode(self):
+        data = encode_packets(STDOUT, b('abc'))
+        assert data == b('\x01\x00\x00\x03abc')
+        assert encode_eof(STDERR) == b('\x02\x01\x00\x00')
+
+    def test_split(self):
+        data = encode_packets(STDIN, b('x') * 10, 4)
+        items = demuxer(reader_of([data])).next_packets()
+        assert items == [(STDIN, 'data', b('x') * 10)]
+        assert len(data) == 10 + 3 * 4
+        assert_raises(ValueError, encode_packets, STDIN, b(''), 65536)
+
+    def test_coalesce(self):
+        data = encode_packets(STDOUT, b('a')) + encode_packets(STDOUT, b('b')) \
+                + encode_packets(STDERR, b('x')) + encode_packets(STDOUT, b('c')) \
+                + encode_eof(STDOUT) + encode_packets(STDERR, b(''))
+        demux = demuxer(reader_of([data]))
+        assert demux.next_packets() == [(STDOUT, 'data', b('ab')),
+                                        (STDERR, 'data', b('x')),
+                                        (STDOUT, 'data', b('c')),
+                                        (STDOUT, 'eof', b('')),
+                                        (STDERR, 'data', b(''))]
+        assert demux.packets == 6
+        assert demux.next_packets() == []
+
+    def test_partial(self):
+        data = encode_packets(STDOUT, b('hello')) + encode_eof(STDOUT)
+        chunks = [data[i:i+1] for i in range(len(data))]
+        demux = demuxer(reader_of(chunks))
+        items = []
+        while True:
+            packets = demux.next_packets()
+            if not packets:
+                break
+            items += packets
+        assert items == [(STDOUT, 'data', b('hello')), (STDOUT, 'eof', b(''))]
+
+    def test_truncated(self):
+        data = encode_packets(STDOUT, b('hello'))
+        demux = demuxer(reader_of([data[:-1]]))
+        assert_raises(ValueError, demux.next_packets)
+
+    def test_fuzz(self):
+        rnd = random.Random(3)
+        sent = {STDIN: [], STDOUT: [], STDERR: []}
+        parts = []
+        for i in range(500):
+            stream = rnd.choice(list(sent.keys()))
+            data = os.urandom(rnd.randint(0, 3000))
+            sent[stream].append(data)
+            parts.append(encode_packets(stream, data, rnd.randint(1, 1024)))
+        data = b('').join(parts)
+        pos = [0]
+        def read(size):
+            size = rnd.randint(1, 5000)
+            chunk = data[pos[0]:pos[0]+size]
+            pos[0] += len(chunk)
+            return chunk
+        demux = demuxer(read)
+        received = dict([(stream, []) for stream in sent])
+        while True:
+            items = demux.next_packets()
+            if not items:
+                break
+            for stream, status, chunk in items:
+                received[stream].append(chunk)
+        for stream in sent:
+            assert b('').join(received[stream]) == b('').join(sent[stream])
+
+
+class TestChannel(object):
+
+    def setUp(self):
+        self.parent, self.child = socket.socketpair()
+
+    def tearDown(self):
+        self.parent.close()
+        self.child.close()
+
+    def test_serve(self):
+        channel = socket_channel(self.parent)
+        other = socket_channel(self.child)
+        other.send(STDOUT, b('out'))
+        other.send(STDERR, b('err'))
+        other.send(CONTROL, b('ignored'))
+        other.send_eof(STDOUT)
+        other.send(STDOUT, b('late'))
+        self.child.shutdown(socket.SHUT_WR)
+        delivered = []
+        channel.serve(lambda *item: delivered.append(item))
+        assert delivered == [(STDOUT, 'data', b('out')),
+                             (STDERR, 'data', b('err')),
+                             (STDOUT, 'eof', b('')),
+                             (STDERR, 'eof', b(''))]
+
+    def test_serve_broken(self):
+        self.child.sendall(encode_packets(STDOUT, b('abc'))[:-1])
+        self.child.shutdown(socket.SHUT_WR)
+        delivered = []
+        socket_channel(self.parent).serve(lambda *i: delivered.append(i))
+        assert [item[:2] for item in delivered] == [(STDOUT, 'error'),
+                                                    (STDERR, 'error')]
+
+    def test_serve_read_error(self):
+        parts = [encode_packets(STDOUT, b('abc'))]
+        def read(size):
+            if not parts:
+                raise IOError(109, 'The pipe has been ended.')
+            return parts.pop(0)
+        delivered = []
+        mux_channel(read, None).serve(lambda *i: delivered.append(i))
+        assert delivered[0] == (STDOUT, 'data', b('abc'))
+        assert [item[:2] for item in delivered[1:]] == [(STDOUT, 'error'),
+                                                        (STDERR, 'error')]
+        assert 'The pipe has been ended.' in delivered[1][2]
+
+    def test_control(self):
+        channel = socket_channel(self.parent)
+        other = socket_channel(self.child)
+        other.send(STDOUT, b('early'))
+        other.send_control([('status', 'ok'), ('pid', 42)])
+        other.send(STDERR, b('after'))
+        message, others = channel.receive_control()
+        assert message == {'status': 'ok', 'pid': '42'}
+        assert others[0] == (STDOUT, 'data', b('early'))
+        self.child.shutdown(socket.SHUT_WR)
+        message, rest = channel.receive_control()
+        assert message is None
+        assert others[1:] + rest == [(STDERR, 'data', b('after'))]
+
+    def test_concurrent_send(self):
+        channel = socket_channel(self.parent)
+        other = socket_channel(self.child)
+        def send(stream):
+            for i in range(200):
+                channel.send(stream, b('%d' % stream) * 1000)
+            channel.send_eof(stream)
+        threads = [threading.Thread(target=send, args=(stream,))
+                   for stream in (STDOUT, STDERR)]
+        for thread in threads:
+            thread.start()
+        output = {STDOUT: [], STDERR: []}
+        def deliver(stream, status, data):
+            output[stream].append(data)
+        # This returns when both streams have ended.
+        other.serve(deliver)
+        for thread in threads:
+            thread.join()
+        assert b('').join(output[STDOUT]) == b('1') * 200000
+        assert b('').join(output[STDERR]) == b('2') * 200000
+
+
+class TestRelay(object):
+    """The relay around a real child, as the stub of winspawn runs it."""
+
+    script = ('import sys\n'
+              'for line in iter(sys.stdin.readline, ""):\n'
+              '    sys.stdout.write(line.upper()); sys.stdout.flush()\n'
+              '    sys.stderr.write(str(len(line)) + "\\n")\n'
+              '    sys.stderr.flush()\n')
+
+    def setUp(self):
+        self.parent, self.child = socket.socketpair()
+        self.proc = subprocess.Popen([sys.executable, '-c', self.script],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        stdin = self.proc.stdin.fileno()
+        outputs = {STDOUT: self.read(self.proc.stdout),
+                   STDERR: self.read(self.proc.stderr)}
+        self.relay = threading.Thread(target=relay,
+                args=(socket_channel(self.child),
+                      lambda data: os.write(stdin, data),
+                      self.proc.stdin.close, outputs))
+        self.relay.start()
+        self.channel = socket_channel(self.parent)
+
+    def tearDown(self):
+        self.relay.join()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.parent.close()
+        self.child.close()
+
+    def read(self, f):
+        return lambda size: os.read(f.fileno(), size)
+
+    def test_relay(self):
+        self.channel.send(STDIN, b('hello\n'))
+        self.channel.send(STDIN, b('world\n'))
+        self.channel.send_eof(STDIN)
+        output = {STDOUT: [], STDERR: []}
+        def deliver(stream, status, data):
+            output[stream].append(data)
+        self.channel.serve(deliver)
+        # The relay runs until the channel ends.
+        self.parent.shutdown(socket.SHUT_WR)
+        assert b('').join(output[STDOUT]) == b('HELLO\nWORLD\n')
+        assert b('').join(output[STDERR]) == b('6\n6\n')
+        assert self.proc.wait() == 0
+
+    def test_quit(self):
+        self.channel.send(STDIN, b('one\n'))
+        self.channel.send_control([('op', 'quit')])
+        self.relay.join(10)
+        assert not self.relay.is_alive()
+        # The relay closed the stdin of the child, which then exits.
+        assert self.proc.wait() == 0
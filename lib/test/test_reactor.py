@@ -0,0 +1,383 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+import os
+import sys
+import time
+import threading
+from Queue import Queue, Empty
+from winpexpect_io import (reactor, select_transport, ChunkBuffer,
+                           output_queue, output_streams)
+
+from nose.tools import assert_raises
+
+
+class collector(object):
+    """A reactor callback that collects what it gets."""
+
+    def __init__(self):
+        self.data = []
+        self.status = None
+        self.done = threading.Event()
+
+    def __call__(self, status, data):
+        if status == 'data':
+            self.data.append(data)
+        else:
+            self.status = status
+            self.done.set()
+
+    def getvalue(self):
+        return ''.encode('ascii').join(self.data)
+
+
+class TestReactor(object):
+
+    def setUp(self):
+        self.reactor = reactor(transport=select_transport)
+        self.pipes = []
+
+    def tearDown(self):
+        self.reactor.close()
+        for fd in self.pipes:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def pipe(self):
+        r, w = os.pipe()
+        self.pipes += [r, w]
+        return r, w
+
+    def test_read(self):
+        r, w = self.pipe()
+        sink = collector()
+        self.reactor.register(r, sink, 4)
+        os.write(w, 'hello world'.encode('ascii'))
+        os.close(w)
+        assert sink.done.wait(5)
+        assert sink.status == 'eof'
+        assert sink.getvalue() == 'hello world'.encode('ascii')
+        assert max([len(chunk) for chunk in sink.data]) <= 4
+        assert len(self.reactor) == 0
+
+    def test_many(self):
+        sinks = []
+        writers = []
+        for i in range(200):
+            r, w = self.pipe()
+            sink = collector()
+            self.reactor.register(r, sink)
+            sinks.append(sink)
+            writers.append(w)
+        assert self.reactor.threads == 1
+        assert len(self.reactor) == 200
+        for i, w in enumerate(writers):
+            os.write(w, ('child %d' % i).encode('ascii'))
+            os.close(w)
+        for i, sink in enumerate(sinks):
+            assert sink.done.wait(5)
+            assert sink.getvalue() == ('child %d' % i).encode('ascii')
+
+    def test_unregister(self):
+        r, w = self.pipe()
+        sink = collector()
+        key = self.reactor.register(r, sink)
+        os.write(w, 'a'.encode('ascii'))
+        while not sink.data:
+            time.sleep(0.01)
+        self.reactor.unregister(key)
+        self.reactor.unregister(key)
+        assert len(self.reactor) == 0
+        os.write(w, 'b'.encode('ascii'))
+        os.close(w)
+        time.sleep(0.05)
+        assert sink.data == ['a'.encode('ascii')]
+        assert sink.status is None
+        # The data that was not read is still in the pipe.
+        assert os.read(r, 10) == 'b'.encode('ascii')
+
+    def test_threads(self):
+        pool = reactor(threads=3, transport=select_transport)
+        try:
+            sinks = []
+            for i in range(9):
+                r, w = self.pipe()
+                sink = collector()
+                pool.register(r, sink)
+                sinks.append((sink, w))
+            assert [worker.sources for worker in pool._workers] == [3, 3, 3]
+            for sink, w in sinks:
+                os.close(w)
+            for sink, w in sinks:
+                assert sink.done.wait(5)
+            assert [worker.sources for worker in pool._workers] == [0, 0, 0]
+        finally:
+            pool.close()
+        assert_raises(ValueError, pool.register, 0, collector())
+
+    def test_bad_callback(self):
+        r1, w1 = self.pipe()
+        r2, w2 = self.pipe()
+        def bad(status, data):
+            raise RuntimeError('bad callback')
+        sink = collector()
+        self.reactor.register(r1, bad)
+        self.reactor.register(r2, sink)
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            os.write(w1, 'x'.encode('ascii'))
+            os.write(w2, 'y'.encode('ascii'))
+            os.close(w2)
+            assert sink.done.wait(5)
+            while len(self.reactor):
+                time.sleep(0.01)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        assert sink.getvalue() == 'y'.encode('ascii')
+
+    def test_pause(self):
+        r, w = self.pipe()
+        sink = collector()
+        key = self.reactor.register(r, sink)
+        # Pauses are counted, and a resume() may come first.
+        self.reactor.resume(key)
+        self.reactor.pause(key)
+        os.write(w, 'a'.encode('ascii'))
+        while not sink.data:
+            time.sleep(0.01)
+        self.reactor.pause(key)
+        os.write(w, 'b'.encode('ascii'))
+        time.sleep(0.05)
+        assert sink.data == ['a'.encode('ascii')]
+        self.reactor.resume(key)
+        os.close(w)
+        assert sink.done.wait(5)
+        assert sink.getvalue() == 'ab'.encode('ascii')
+
+    def test_pause_from_callback(self):
+        r, w = self.pipe()
+        sink = collector()
+        def output(status, data):
+            sink(status, data)
+            return True
+        key = self.reactor.register(r, output, 1)
+        os.write(w, 'ab'.encode('ascii'))
+        while not sink.data:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        assert sink.data == ['a'.encode('ascii')]
+        self.reactor.resume(key)
+        while len(sink.data) < 2:
+            time.sleep(0.01)
+        assert sink.getvalue() == 'ab'.encode('ascii')
+
+
+class TestOutputQueue(object):
+
+    def test_queue(self):
+        queue = output_queue()
+        assert_raises(Empty, queue.get, False)
+        assert_raises(Empty, queue.get, True, 0.01)
+        assert not queue.put((1, 'data', 'abc'))
+        assert not queue.put((None, 'timeout', None))
+        assert queue.qsize() == 2
+        assert queue.nbytes == 3
+        assert queue.get() == (1, 'data', 'abc')
+        assert queue.get() == (None, 'timeout', None)
+        assert queue.nbytes == 0
+        assert queue.maxbytes == 3
+        assert queue.stalls == 0
+
+    def test_timeout(self):
+        queue = output_queue()
+        threads = threading.active_count()
+        for i in range(20):
+            start = time.time()
+            assert_raises(Empty, queue.get, True, 0.02)
+            assert time.time() - start >= 0.019
+        # One timer thread at most, not one per get().
+        assert threading.active_count() <= threads + 1
+
+    def test_wakeup(self):
+        queue = output_queue()
+        def put():
+            time.sleep(0.05)
+            queue.put((1, 'data', 'x'))
+        thread = threading.Thread(target=put)
+        thread.start()
+        start = time.time()
+        assert queue.get(True, 10) == (1, 'data', 'x')
+        assert time.time() - start < 5
+        thread.join()
+
+    def test_watermarks(self):
+        queue = output_queue(10, 4)
+        resumed = []
+        assert not queue.put((1, 'data', 'x' * 6), resumed.append)
+        assert queue.put((1, 'data', 'x' * 4))
+        assert queue.put((1, 'data', 'x' * 3), lambda: resumed.append(1))
+        assert queue.nbytes == 13
+        assert queue.stalls == 1
+        queue.get()
+        assert resumed == []
+        queue.get()
+        assert resumed == [1]
+        assert queue.nbytes == 3
+        assert queue.maxbytes == 13
+        assert queue.stalltime > 0
+        assert not queue.put((1, 'data', 'x' * 3))
+
+    def test_wait_writable(self):
+        queue = output_queue(4)
+        queue.put((1, 'data', 'abcd'))
+        def get():
+            time.sleep(0.05)
+            queue.get()
+        thread = threading.Thread(target=get)
+        thread.start()
+        queue.wait_writable()
+        thread.join()
+        assert queue.nbytes == 0
+        assert queue.stalltime >= 0.04
+
+    def test_close(self):
+        queue = output_queue(4)
+        resumed = []
+        queue.put((1, 'data', 'abcd'), lambda: resumed.append(1))
+        thread = threading.Thread(target=queue.wait_writable)
+        thread.start()
+        queue.close()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert resumed == [1]
+        assert queue.qsize() == 0
+        assert not queue.put((1, 'data', 'abcd'))
+        assert queue.qsize() == 0
+
+
+class TestChunkBuffer(object):
+
+    def test_read(self):
+        buf = ChunkBuffer('abc')
+        buf.add('defg')
+        buf.add('')
+        buf.add('h')
+        assert len(buf) == 8
+        assert buf.read(2) == 'ab'
+        assert buf.read(3) == 'cde'
+        assert len(buf) == 3
+        assert buf.read(10) == 'fgh'
+        assert len(buf) == 0
+        assert buf.read(10) == ''
+
+    def test_empty(self):
+        empty = ''.encode('ascii')
+        buf = ChunkBuffer()
+        assert buf.read(10) == empty and type(buf.read(10)) is bytes
+        buf.add('abc'.encode('ascii'))
+        assert buf.read(0) == empty
+        assert buf.read(-1) == empty
+        assert buf.read(2) == 'ab'.encode('ascii')
+        assert ChunkBuffer(empty='').read(5) == ''
+        buf = ChunkBuffer('abc')
+        assert buf.read(0) == '' and type(buf.read(0)) is str
+        assert len(buf) == 3
+
+    def test_whole_chunk(self):
+        chunk = 'x' * 100
+        buf = ChunkBuffer(chunk)
+        assert buf.read(100) is chunk
+        buf.add(chunk)
+        buf.add('y')
+        assert buf.read(100) is chunk
+
+    def test_bytes(self):
+        chunks = [('%d-' % i).encode('ascii') for i in range(100)]
+        buf = ChunkBuffer()
+        for chunk in chunks:
+            buf.add(chunk)
+        data = []
+        while len(buf):
+            data.append(buf.read(7))
+            assert type(data[-1]) is type(chunks[0])
+        assert ''.encode('ascii').join(data) == ''.encode('ascii').join(chunks)
+
+    def test_drain(self):
+        queue = Queue()
+        buf = ChunkBuffer()
+        for item in ((1, 'data', 'abc'), (2, 'data', 'de'), (1, 'data', 'f'),
+                     (2, 'eof', ''), (1, 'data', 'g')):
+            queue.put(item)
+        assert buf.drain(queue, 4) is None
+        assert buf.read(100) == 'abcde'
+        assert buf.drain(queue, 100) == (2, 'eof', '')
+        assert buf.read(100) == 'f'
+        assert buf.drain(queue, 100) is None
+        assert buf.read(100) == 'g'
+        assert queue.qsize() == 0
+
+
+class TestOutputStreams(object):
+
+    def streams(self, items, sink=None):
+        queue = output_queue()
+        for item in items:
+            queue.put(item)
+        streams = output_streams(queue, 1, sink)
+        get = lambda timeout: queue.get(True, timeout)
+        return streams, get
+
+    def test_separate(self):
+        streams, get = self.streams([(1, 'data', 'a'), (2, 'data', 'x'),
+                                     (1, 'data', 'b'), (2, 'data', 'y'),
+                                     (2, 'eof', ''), (1, 'data', 'c')])
+        assert streams.read('stderr', 100, get, 0) == ('stderr', 'data', 'xy')
+        assert streams.read('stderr', 100, get, 0) == ('stderr', 'eof', '')
+        assert streams.read('stdout', 100, get, 0) == ('stdout', 'data', 'abc')
+        assert_raises(Empty, streams.read, 'stdout', 100, get, 0.01)
+        assert streams.read('stderr', 100, get, 0) == ('stderr', 'eof', '')
+
+    def test_both(self):
+        streams, get = self.streams([(1, 'data', 'a'), (1, 'data', 'b'),
+                                     (2, 'data', 'x'), (1, 'data', 'c'),
+                                     (2, 'data', 'y'), (2, 'data', 'z'),
+                                     (2, 'eof', '')])
+        data = [streams.read('both', 100, get, 0) for i in range(4)]
+        assert data == [('stdout', 'data', 'ab'), ('stderr', 'data', 'x'),
+                        ('stdout', 'data', 'c'), ('stderr', 'data', 'yz')]
+        # Both streams must have ended.
+        assert_raises(Empty, streams.read, 'both', 100, get, 0)
+        streams._feed((1, 'eof', ''))
+        assert streams.read('both', 100, get, 0) == ('stdout', 'eof', '')
+
+    def test_origins(self):
+        streams, get = self.streams([(1, 'data', 'abc'), (2, 'data', 'xy'),
+                                     (1, 'data', 'de')])
+        streams.mark('stderr', 4)
+        for i in range(3):
+            streams.read('both', 100, get, 0)
+        assert streams.origins(6) == [('stdout', 2), ('stderr', 2),
+                                      ('stdout', 2)]
+        assert streams.origins(6) == []
+        streams.mark('stdout', 3)
+        streams.mark('stderr', 3)
+        streams.mark('stdout', 3)
+        streams.trim(4)
+        assert streams.origins(100) == [('stderr', 3), ('stdout', 3)]
+
+    def test_sink(self):
+        sunk = []
+        streams, get = self.streams([(2, 'data', 'x'), (1, 'data', 'a'),
+                                     (2, 'data', 'y'), (1, 'data', 'b')],
+                                    sunk.append)
+        assert streams.read('stdout', 100, get, 0) == ('stdout', 'data', 'ab')
+        assert sunk == ['x', 'y']
@@ -0,0 +1,168 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+import os
+import time
+import shutil
+import tempfile
+from pexpect import EOF, TIMEOUT, ExceptionPexpect
+from pexpect_replay import (transcript, read_transcript, replayspawn, READ,
+                            SEND, END, STDERR_READ)
+
+from nose.tools import assert_raises
+
+from helpers import b, socketspawn
+
+
+class TestTranscript(object):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.pxt')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, records):
+        """Write a transcript of (tag, data) records."""
+        log = transcript(self.path)
+        for tag, data in records:
+            log.record(tag, data)
+        log.close()
+
+    def test_roundtrip(self):
+        self.write([(READ, 'login: '), (SEND, b('root\n')), (END, b(''))])
+        records = read_transcript(self.path)
+        assert [(tag, data) for tag, when, data in records] == \
+                [(READ, b('login: ')), (SEND, b('root\n')), (END, b(''))]
+        times = [when for tag, when, data in records]
+        assert times[0] == 0 and times == sorted(times)
+        # A tag, two 32 bit numbers and the data per record.
+        assert os.path.getsize(self.path) == 5 + 3 * 9 + 7 + 5
+
+    def test_unicode_path(self):
+        log = transcript(unicode(self.path))
+        log.record_read('out')
+        log.record_read('err', 'stderr')
+        log.close()
+        records = read_transcript(unicode(self.path))
+        assert [(tag, data) for tag, when, data in records] == \
+                [(READ, b('out')), (STDERR_READ, b('err'))]
+
+    def test_invalid(self):
+        f = open(self.path, 'wb')
+        f.write(b('not a transcript'))
+        f.close()
+        assert_raises(ValueError, read_transcript, self.path)
+        self.write([(READ, 'output')])
+        f = open(self.path, 'rb')
+        data = f.read()
+        f.close()
+        f = open(self.path, 'wb')
+        f.write(data[:-1])
+        f.close()
+        assert_raises(ValueError, read_transcript, self.path)
+
+    def test_record(self):
+        child = socketspawn(timeout=5)
+        child.transcript = transcript(self.path)
+        child.peer.sendall(b('Password: '))
+        child.expect('Password: ')
+        child.sendline('secret')
+        assert child.peer.recv(100) == b('secret\n')
+        child.peer.sendall(b('ok\n'))
+        child.expect('ok')
+        child.peer.close()
+        child.expect(EOF)
+        child.close()
+        child.transcript.close()
+        records = read_transcript(self.path)
+        assert [tag for tag, when, data in records][-1] == END
+        assert b('').join([data for tag, when, data in records
+                           if tag == READ]) == b('Password: ok\n')
+        assert b('').join([data for tag, when, data in records
+                           if tag == SEND]) == b('secret\n')
+
+
+class TestReplay(object):
+
+    def session(self, delay=0.0):
+        return [(READ, 0.0, b('Password: ')),
+                (SEND, 1.0, b('secret')), (SEND, 1.0, b('\n')),
+                (READ, 1.0 + delay, b('Welcome\n$ ')),
+                (SEND, 2.0, b('exit')), (SEND, 2.0, b('\n')),
+                (READ, 2.0 + delay, b('bye\n')), (END, 2.0 + delay, b(''))]
+
+    def test_replay(self):
+        child = replayspawn(self.session(), timeout=5)
+        child.expect('Password: ')
+        child.sendline('secret')
+        child.expect(r'\$ ')
+        assert child.before == 'Welcome\n'
+        child.sendline('exit')
+        child.expect(EOF)
+        assert child.before == 'bye\n'
+        assert not child.isalive()
+        assert child.sent == [b('secret'), b('\n'), b('exit'), b('\n')]
+        child.close()
+        assert_raises(ValueError, child.read_nonblocking)
+
+    def test_stderr(self):
+        records = [(READ, 0.0, b('out\n')), (STDERR_READ, 0.0, b('err\n')),
+                   (END, 0.0, b(''))]
+        child = replayspawn(records, timeout=5)
+        child.expect(EOF)
+        assert child.before == 'out\nerr\n'
+
+    def test_waits_for_send(self):
+        child = replayspawn(self.session(), timeout=5)
+        start = time.time()
+        # Without speed the replay does not wait.
+        assert child.expect(['Welcome', TIMEOUT]) == 1
+        assert time.time() - start < 1
+        assert child.before == 'Password: '
+
+    def test_strict(self):
+        child = replayspawn(self.session())
+        child.expect('Password: ')
+        assert_raises(ExceptionPexpect, child.sendline, 'wrong')
+        child = replayspawn(self.session(), strict=False)
+        child.expect('Password: ')
+        child.sendline('wrong')
+        child.expect(r'\$ ')
+
+    def test_speed(self):
+        child = replayspawn(self.session(0.2), speed=2.0, timeout=5)
+        child.expect('Password: ')
+        start = time.time()
+        child.sendline('secret')
+        child.expect(r'\$ ')
+        elapsed = time.time() - start
+        assert 0.09 < elapsed < 1, elapsed
+        # Output that is not due within the timeout is a TIMEOUT.
+        child.sendline('exit')
+        assert_raises(TIMEOUT, child.read_nonblocking, 100, 0.01)
+        child.expect('bye')
+
+    def test_rerecord(self):
+        path = tempfile.mktemp()
+        try:
+            child = replayspawn(self.session())
+            child.transcript = transcript(path)
+            child.expect('Password: ')
+            child.sendline('secret')
+            child.expect(r'\$ ')
+            child.sendline('exit')
+            child.expect(EOF)
+            child.close()
+            child.transcript.close()
+            records = read_transcript(path)
+            assert [(tag, data) for tag, when, data in records] == \
+                    [(tag, data) for tag, when, data in self.session()]
+        finally:
+            os.remove(path)
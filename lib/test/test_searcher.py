@@ -0,0 +1,409 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+import re
+import random
+from pexpect import (searcher_string, searcher_re, pattern_maxwidth,
+                     pattern_margin, pattern_literal, combine_patterns,
+                     expect_buffer, EOF, TIMEOUT)
+
+
+def find_first(strings, buffer, freshlen, searchwindowsize=None):
+    """Reference implementation: one find() per string."""
+    first_match = len(buffer)
+    best = None
+    for index, s in enumerate(strings):
+        if searchwindowsize is None:
+            offset = -(freshlen+len(s))
+        else:
+            offset = -searchwindowsize
+        n = buffer.find(s, offset)
+        if n >= 0 and n < first_match:
+            first_match = n
+            best = (index, n)
+    return best
+
+
+def feed(searcher, chunks, searchwindowsize=None, chunked=False):
+    """Feed chunks to a searcher like expect_loop() does."""
+    buffer = ''
+    if chunks:
+        buffer = chunks[0][:0]
+    incoming = expect_buffer()
+    freshlen = 0
+    for chunk in chunks:
+        buffer += chunk
+        incoming.append(chunk)
+        freshlen = len(chunk)
+        if chunked:
+            index = searcher.search(incoming, freshlen, searchwindowsize)
+        else:
+            index = searcher.search(buffer, freshlen, searchwindowsize)
+        if index >= 0:
+            return buffer, index, searcher.start, searcher.end
+    return buffer, -1, None, None
+
+
+class TestSearcherString(object):
+
+    searcher = searcher_string
+
+    def test_earliest_then_leftmost(self):
+        s = self.searcher(['bar', 'foo', 'foobar'])
+        assert s.search('foobar', 6) == 1
+        assert (s.start, s.end, s.match) == (0, 3, 'foo')
+        s = self.searcher(['foobar', 'foo'])
+        assert s.search('foobar', 6) == 0
+        assert s.match == 'foobar'
+
+    def test_longer_pattern_starts_earlier(self):
+        s = self.searcher(['cd', 'abcdef'])
+        assert s.search('xabcdef', 7) == 1
+        assert s.start == 1
+
+    def test_duplicates(self):
+        s = self.searcher(['ab', 'ab'])
+        assert s.search('xxab', 4) == 0
+
+    def test_eof_timeout(self):
+        s = self.searcher([EOF, 'a', TIMEOUT])
+        assert s.eof_index == 0
+        assert s.timeout_index == 2
+        assert s.search('bab', 3) == 1
+
+    def test_no_match(self):
+        s = self.searcher(['abc'])
+        assert s.search('xyz', 3) == -1
+        assert s.search('', 0) == -1
+
+    def test_straddling_chunks(self):
+        s = self.searcher(['Password:', 'login:'])
+        buffer, index, start, end = feed(s, ['xx Pass', 'wo', 'rd: yy'])
+        assert index == 0
+        assert buffer[start:end] == 'Password:'
+
+    def test_empty_string(self):
+        s = self.searcher(['abc', ''])
+        assert s.search('xxabc', 5) == 1
+        assert s.start == 0
+
+    def test_searchwindowsize(self):
+        s = self.searcher(['abc', 'c'])
+        assert s.search('xabc', 4, 2) == 1
+        assert s.start == 3
+
+    def test_new_buffer_resets_state(self):
+        s = self.searcher(['abc'])
+        assert s.search('xxab', 4) == -1
+        assert s.search('c', 1) == -1
+        assert s.search('abc', 3) == 0
+
+    def test_discardable(self):
+        s = self.searcher(['abc', 'de'])
+        assert s.discardable(10) == 7
+        assert s.discardable(10, 2) == 8
+        assert s.discardable(2) == 0
+
+    def test_random(self):
+        rnd = random.Random(1234)
+        alphabet = 'abc\r\n'
+        for i in range(300):
+            strings = []
+            for j in range(rnd.randint(1, 8)):
+                n = rnd.randint(1, 5)
+                strings.append(''.join([rnd.choice(alphabet)
+                                        for k in range(n)]))
+            text = ''.join([rnd.choice(alphabet) for k in range(60)])
+            chunks = []
+            pos = 0
+            while pos < len(text):
+                n = rnd.randint(1, 7)
+                chunks.append(text[pos:pos+n])
+                pos += n
+            sws = rnd.choice([None, None, 5, 10])
+            buffer, index, start, end = feed(self.searcher(strings),
+                                             chunks, sws, i % 2)
+            ref = None
+            refbuf = ''
+            for chunk in chunks:
+                refbuf += chunk
+                ref = find_first(strings, refbuf, len(chunk), sws)
+                if ref is not None:
+                    break
+            assert refbuf == buffer
+            if ref is None:
+                assert index == -1
+            else:
+                assert (index, start) == ref
+                assert buffer[start:end] == strings[index]
+
+    def test_threshold(self):
+        strings = ['s%d' % i for i in range(searcher_string.automaton_threshold)]
+        assert searcher_string(strings[1:] + [''])._automaton is None
+        assert searcher_string(strings)._automaton is not None
+
+
+class automaton_searcher(searcher_string):
+    """A searcher_string that uses the automaton for any number of strings."""
+
+    automaton_threshold = 1
+
+
+class TestSearcherAutomaton(TestSearcherString):
+
+    searcher = automaton_searcher
+
+
+class TestSearcherBytes(object):
+
+    def tobytes(self, s):
+        if bytes is str:
+            return s
+        return s.encode('latin-1')
+
+    def test_string(self):
+        b = self.tobytes
+        s = searcher_string([b('\xe9t\xe9'), b('t')])
+        buffer, index, start, end = feed(s, [b('x\xe9'), b('t\xe9')], None,
+                                         True)
+        assert (index, start, end) == (0, 1, 4)
+
+    def test_re(self):
+        b = self.tobytes
+        s = searcher_re([re.compile(b('\xe9+t')), re.compile(b('[\x80-\xff]'))],
+                        combine=True)
+        buffer, index, start, end = feed(s, [b('x\xe9'), b('\xe9t')], None,
+                                         True)
+        assert index == 1 and start == 1
+        s = searcher_re([re.compile(b('\xe9+t'))])
+        buffer, index, start, end = feed(s, [b('x\xe9'), b('\xe9t')], None,
+                                         True)
+        assert buffer[start:end] == b('\xe9\xe9t')
+
+
+class TestSearcherRe(object):
+
+    def test_maxwidth(self):
+        assert pattern_maxwidth(re.compile('abc')) == 3
+        assert pattern_maxwidth(re.compile(r'a{2,5}b')) == 6
+        assert pattern_maxwidth(re.compile(r'x(?=yz)')) == 3
+        assert pattern_maxwidth(re.compile(r'(?<=ab)c')) == 1
+        assert pattern_maxwidth(re.compile(r'\$ $')) == 2
+        assert pattern_maxwidth(re.compile(r'a*')) is None
+        assert pattern_maxwidth(re.compile(r'x(?=y*)')) is None
+        assert pattern_maxwidth(re.compile(r'(a)\1')) is None
+
+    def test_margin(self):
+        assert pattern_margin(re.compile('abc')) == 1
+        assert pattern_margin(re.compile(r'(?<=ab)c')) == 3
+        assert pattern_margin(re.compile(r'(?<!a)c(?<=bc)')) == 4
+
+    def test_literal(self):
+        assert pattern_literal(re.compile('Password:')) == 'Password:'
+        assert pattern_literal(re.compile(r'\$ $')) == '$ '
+        assert pattern_literal(re.compile(r'ERROR\d+')) == 'ERROR'
+        assert pattern_literal(re.compile(r'(ab)+c')) == 'ab'
+        assert pattern_literal(re.compile(r'x(?:yz)?w')) == 'x'
+        assert pattern_literal(re.compile(r'(?<=abc)d')) == 'd'
+        assert pattern_literal(re.compile('ab|cd')) is None
+        assert pattern_literal(re.compile(r'\d+')) is None
+        assert pattern_literal(re.compile('abc', re.I)) is None
+        assert pattern_literal(re.compile('(?i)abc')) is None
+
+    def test_prefilter(self):
+        s = searcher_re([re.compile(r'ERROR\d+'), re.compile(r'\$ $')])
+        assert s.search('xxxx', 4) == -1
+        assert (s.regex_calls, s.regex_skipped) == (0, 2)
+        assert s.search('xxxx$ ', 2) == 1
+        assert (s.regex_calls, s.regex_skipped) == (1, 3)
+        assert (s.start, s.end) == (4, 6)
+        s = searcher_re([re.compile('ab'), re.compile(r'\d')], combine=True)
+        assert s.search('xxxx', 4) == -1
+        assert (s.regex_calls, s.regex_skipped) == (1, 1)
+
+    def test_prefilter_straddling(self):
+        s = searcher_re([re.compile('ERR.*!')])
+        buffer, index, start, end = feed(s, ['xxER', 'Ryy', 'z', '!'],
+                                         chunked=True)
+        assert (index, start, end) == (0, 2, 9)
+        assert (s.regex_calls, s.regex_skipped) == (3, 1)
+
+    def test_prefilter_random(self):
+        rnd = random.Random(8765)
+        alphabet = 'ab\n'
+        atoms = ['a', 'b', 'ab', 'ba', '.', '[ab]', 'b+', '(ab)+', '(a|b)',
+                 '\n', '^', '$', '(?=ab)', '(?<=b)', 'a*']
+        for i in range(300):
+            patterns = []
+            for j in range(rnd.randint(1, 4)):
+                p = ''.join([rnd.choice(atoms)
+                             for k in range(rnd.randint(1, 4))])
+                patterns.append(re.compile(p, rnd.choice([0, re.M])))
+            text = ''.join([rnd.choice(alphabet) for k in range(30)])
+            s = searcher_re(patterns, combine=i % 2)
+            # Like expect(), ignore empty matches at the end of the buffer.
+            ref = (-1, len(text), None)
+            for n, p in enumerate(patterns):
+                m = p.search(text)
+                if m is not None and m.start() < ref[1]:
+                    ref = (n, m.start(), m.end())
+            index = s.search(text, len(text))
+            if ref[0] == -1:
+                assert index == -1
+            else:
+                assert (index, s.start, s.end) == ref
+
+    def test_discardable(self):
+        s = searcher_re([re.compile('abc'), re.compile(r'(?<=xy)z')])
+        assert s.discardable(10) == 6
+        s = searcher_re([re.compile('abc'), re.compile(r'a.*z')])
+        assert s.discardable(10) == 0
+        assert s.discardable(10, 5) == 4
+        assert searcher_re([EOF]).discardable(10) == 10
+
+    def test_straddling_chunks(self):
+        s = searcher_re([re.compile('Pass(word)?:')])
+        buffer, index, start, end = feed(s, ['xx Pass', 'wo', 'rd: yy'])
+        assert index == 0
+        assert buffer[start:end] == 'Password:'
+
+    def test_anchors(self):
+        s = searcher_re([re.compile('^abc')])
+        assert feed(s, ['xab', 'c'])[1] == -1
+        s = searcher_re([re.compile(r'(?<=x)abc')])
+        assert feed(s, ['yyyyx', 'ab', 'c'])[1] == 0
+        s = searcher_re([re.compile(r'ab\B')])
+        assert feed(s, ['xab', 'c'])[1] == 0
+        s = searcher_re([re.compile('^abc')])
+        assert feed(s, ['xxxx', 'ab', 'c'], chunked=True)[1] == -1
+        s = searcher_re([re.compile('(?m)^abc')])
+        assert feed(s, ['xxx\n', 'ab', 'c'], chunked=True)[1] == 0
+        s = searcher_re([re.compile(r'(?<=xy)abc')])
+        assert feed(s, ['xxxy', 'ab', 'c'], chunked=True)[1] == 0
+
+    def test_maxwidths_hint(self):
+        s = searcher_re([re.compile('E.*!'), EOF], [5, None])
+        assert s.eof_index == 1
+        buffer, index, start, end = feed(s, ['xxEabc', 'd!'])
+        assert (index, start, end) == (0, 2, 8)
+
+    def test_random(self):
+        rnd = random.Random(4321)
+        alphabet = 'ab\n'
+        atoms = ['a', 'b', '\\n', '.', '[ab]', 'a?', 'b{1,3}', '(a|bb)',
+                 '^', '$', r'\b', '(?=a)', '(?!b)', '(?<=a)', 'a*', '.+?']
+        for i in range(300):
+            patterns = []
+            for j in range(rnd.randint(1, 4)):
+                p = ''.join([rnd.choice(atoms)
+                             for k in range(rnd.randint(1, 4))])
+                patterns.append(re.compile(p, re.DOTALL|rnd.choice([0, re.M])))
+            text = ''.join([rnd.choice(alphabet) for k in range(40)])
+            incremental = searcher_re(patterns)
+            full = searcher_re(patterns)
+            sws = rnd.choice([None, None, 6])
+            buffer = ''
+            incoming = expect_buffer()
+            pos = 0
+            while pos < len(text):
+                chunk = text[pos:pos+rnd.randint(1, 5)]
+                pos += len(chunk)
+                buffer += chunk
+                incoming.append(chunk)
+                if i % 2:
+                    index = incremental.search(incoming, len(chunk), sws)
+                else:
+                    index = incremental.search(buffer, len(chunk), sws)
+                ref = full.search(buffer, len(buffer), sws)
+                assert index == ref
+                if index >= 0:
+                    assert incremental.start == full.start
+                    assert incremental.end == full.end
+                    break
+
+
+class TestCombinedSearcherRe(object):
+
+    def test_partition(self):
+        patterns = [re.compile('a(b)c'), re.compile(r'(x)\1'),
+                    re.compile('(?i)abc'), re.compile('d+'),
+                    re.compile('ef', re.M), re.compile('gh')]
+        searches = [(n, p, pattern_maxwidth(p))
+                    for n, p in enumerate(patterns)]
+        combined, separate = combine_patterns(searches)
+        assert [n for n, p, w in separate] == [1, 2, 3, 4]
+        assert len(combined) == 1
+        regex, members, width = combined[0]
+        assert members == [(0, patterns[0]), (5, patterns[5])]
+        assert width == 3
+
+    def test_match_groups(self):
+        patterns = [re.compile(r'x(?P<n>\d{1,3})y'), re.compile('a(b)?(c)')]
+        s = searcher_re(patterns, combine=True)
+        assert not s._separate
+        assert s.search('zzacx12y', 8) == 1
+        assert s.match.groups() == (None, 'c')
+        assert s.match.re is patterns[1]
+        assert s.search('zzx12y', 6) == 0
+        assert s.match.group('n') == '12'
+        assert (s.start, s.end) == (2, 6)
+
+    def test_earliest_then_leftmost(self):
+        patterns = [re.compile(p) for p in ('bar', 'foo', 'foobar')]
+        s = searcher_re(patterns, combine=True)
+        assert s.search('foobar', 6) == 1
+
+    def test_alternations(self):
+        patterns = [re.compile('ab|c'), re.compile('d|b')]
+        s = searcher_re(patterns, combine=True)
+        assert len(s._combined) == 1
+        assert s.search('xxdb', 4) == 1
+        assert s.search('xxbab', 5) == 1
+
+    def test_many_patterns(self):
+        patterns = [re.compile('(p)(%d)!' % i) for i in range(200)]
+        s = searcher_re(patterns, combine=True)
+        assert len(s._combined) > 1
+        assert s.search('..p150!..p20!', 13) == 150
+        assert s.match.group(2) == '150'
+
+    def test_random(self):
+        rnd = random.Random(5678)
+        alphabet = 'ab\n'
+        atoms = ['a', 'b', '\\n', '.', '[ab]', 'a?', 'b{1,3}', '(a|bb)',
+                 '^', '$', r'\b', '(?=a)', '(?!b)', '(?<=a)', 'a*', '.+?',
+                 r'(a)\1', '(?P<x>b)']
+        for i in range(300):
+            patterns = []
+            for j in range(rnd.randint(1, 6)):
+                p = ''.join([rnd.choice(atoms)
+                             for k in range(rnd.randint(1, 4))])
+                try:
+                    patterns.append(re.compile(p, rnd.choice([0, re.M])))
+                except re.error:
+                    pass
+            text = ''.join([rnd.choice(alphabet) for k in range(40)])
+            combined = searcher_re(patterns, combine=True)
+            separate = searcher_re(patterns)
+            buffer = ''
+            incoming = expect_buffer()
+            pos = 0
+            while pos < len(text):
+                chunk = text[pos:pos+rnd.randint(1, 5)]
+                pos += len(chunk)
+                buffer += chunk
+                incoming.append(chunk)
+                index = combined.search(incoming, len(chunk))
+                assert index == separate.search(buffer, len(chunk))
+                if index >= 0:
+                    assert combined.start == separate.start
+                    assert combined.end == separate.end
+                    assert combined.match.groups() == separate.match.groups()
+                    assert combined.match.lastindex == \
+                            separate.match.lastindex
+                    break
@@ -7,7 +7,7 @@
 # file "AUTHORS" for a complete overview.
 
 import os
-from winpexpect import winspawn, TIMEOUT, ExceptionPexpect
+from winpexpect import winspawn, EOF, TIMEOUT, ExceptionPexpect
 
 from nose.tools import assert_raises
 
@@ -88,3 +88,35 @@ class TestWinspawn(object):
         cwd = ps.readline().strip()
         assert cwd == dir
         ps.terminate()
+
+    def test_short_lived(self):
+        # The child can exit before the pipes are connected.
+        for broker in (None, True):
+            for i in range(10):
+                child = winspawn('cmd.exe /c echo hi', broker=broker)
+                child.expect('hi')
+                child.expect(EOF)
+                child.wait()
+                assert child.exitstatus == 0
+                child.close()
+
+    def test_broker_error(self):
+        # The child never opens the pipes, so waiting for them would hang.
+        class broker(object):
+            def __init__(self, reply):
+                self.reply = reply
+                self.requests = []
+            def spawn(self, command, *args):
+                self.requests.append(command)
+                return self.reply
+        fake = broker({'status': 'error', 'message': 'Access is denied.'})
+        try:
+            winspawn('powershell.exe -command -', broker=fake)
+        except ExceptionPexpect, e:
+            assert 'Access is denied.' in str(e)
+        else:
+            assert False, 'The broker error was not raised.'
+        assert len(fake.requests) == 1
+        fake = broker({})
+        assert_raises(ExceptionPexpect, winspawn,
+                      'powershell.exe -command -', broker=fake)
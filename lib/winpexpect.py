@@ -12,25 +12,27 @@ import pywintypes
 import itertools
 import random
 
-from Queue import Queue, Empty
-from threading import Thread
+from Queue import Empty
+from threading import Thread, Lock
 
-from pexpect import spawn, ExceptionPexpect, EOF, TIMEOUT
+from pexpect import (spawn, searcher_cache, expect_buffer, ExceptionPexpect,
+                     EOF, TIMEOUT, MAXBUFFER)
 from subprocess import list2cmdline
 
 from msvcrt import open_osfhandle
 from win32api import (SetHandleInformation, GetCurrentProcess, OpenProcess,
                       CloseHandle, GetCurrentThread)
-from win32pipe import CreateNamedPipe, ConnectNamedPipe
+from win32pipe import CreateNamedPipe, ConnectNamedPipe, CreatePipe
 from win32process import (STARTUPINFO, CreateProcess, CreateProcessAsUser,
 			  GetExitCodeProcess, TerminateProcess, ExitProcess)
-from win32event import WaitForSingleObject, INFINITE
+from win32event import WaitForSingleObject, CreateEvent, INFINITE
 from win32security import (LogonUser, OpenThreadToken, OpenProcessToken,
                            GetTokenInformation, TokenUser, ACL_REVISION_DS,
                            ConvertSidToStringSid, ConvertStringSidToSid,
                            SECURITY_ATTRIBUTES, SECURITY_DESCRIPTOR, ACL,
                            LookupAccountName)
-from win32file import CreateFile, ReadFile, WriteFile
+from win32file import (CreateFile, ReadFile, WriteFile, GetOverlappedResult,
+                       AllocateReadBuffer, FILE_FLAG_OVERLAPPED)
 
 from win32con import (HANDLE_FLAG_INHERIT, STARTF_USESTDHANDLES,
                       STARTF_USESHOWWINDOW, CREATE_NEW_CONSOLE, SW_HIDE,
@@ -39,8 +41,13 @@ from win32con import (HANDLE_FLAG_INHERIT, STARTF_USESTDHANDLES,
                       TOKEN_ALL_ACCESS, GENERIC_READ, GENERIC_WRITE,
                       OPEN_EXISTING, PROCESS_ALL_ACCESS, MAXIMUM_ALLOWED)
 from winerror import (ERROR_PIPE_BUSY, ERROR_HANDLE_EOF, ERROR_BROKEN_PIPE,
-                      ERROR_ACCESS_DENIED)
-from pywintypes import error as WindowsError
+                      ERROR_ACCESS_DENIED, ERROR_IO_PENDING, ERROR_NO_DATA)
+from pywintypes import error as WindowsError, OVERLAPPED
+
+import winpexpect_io
+import winpexpect_mux
+from winpexpect_io import ChunkBuffer
+from winpexpect_broker import broker, broker_client, frame_codec
 
 
 # Compatibility with Python < 2.6
@@ -51,18 +58,6 @@ except ImportError:
         d = dict(zip(fields, [None]*len(fields)))
         return type(name, (object,), d)
 
-# Compatbility wiht Python 3
-if sys.version_info[0] == 3:
-
-    _WriteFile = WriteFile
-    def WriteFile(handle, s):
-        return _WriteFile(handle, s.encode('ascii'))
-
-    _ReadFile = ReadFile
-    def ReadFile(handle, size):
-        err, data = _ReadFile(handle, size)
-        return err, data.decode('ascii')
-
 
 def split_command_line(cmdline):
     """Split a command line into a command and its arguments according to
@@ -140,38 +135,32 @@ def which(command):
                 return fname
 
 
-def _read_header(handle, bufsize=4096):
-    """INTERNAL: read a stub header from a handle."""
-    header = ''
-    while '\n\n' not in header:
-        err, data = ReadFile(handle, bufsize)
-        header += data
-    return header
-
-
-def _parse_header(header):
-    """INTERNAL: pass the stub header format."""
-    parsed = {}
-    lines = header.split('\n')
-    for line in lines:
-        if not line:
-            break
-        p1 = line.find('=')
-        if p1 == -1:
-            if line.startswith(' '):  # Continuation
-                if key is None:
-                    raise ValueError, 'Continuation on first line.'
-                input[key] += '\n' + line[1:]
-            else:
-                raise ValueError, 'Expecting key=value format'
-        key = line[:p1]
-        parsed[key] = line[p1+1:]
-    return parsed
+def _read_file(handle):
+    """INTERNAL: return a read(size) function for the control channel on
+    `handle'. It returns an empty string at the end."""
+    def read(size):
+        try:
+            err, data = ReadFile(handle, size)
+        except WindowsError, e:
+            if e.winerror in (ERROR_BROKEN_PIPE, ERROR_HANDLE_EOF):
+                return ''.encode('ascii')
+            raise
+        return data
+    return read
+
+
+def _write_file(handle):
+    """INTERNAL: return a write(s) function for the control channel on
+    `handle'."""
+    def write(s):
+        WriteFile(handle, s)
+    return write
 
 
-def _quote_header(s):
-    """INTENAL: quote a string to be used in a stub header."""
-    return s.replace('\n', '\n ')
+def _control_channel(handle):
+    """INTERNAL: return the frame codec of the control channel on
+    `handle'. See winpexpect_broker."""
+    return frame_codec(_read_file(handle), _write_file(handle))
 
 
 def _get_current_sid():
@@ -204,17 +193,21 @@ def _create_security_attributes(*sids, **kwargs):
     return attr
 
 
-def _create_named_pipe(template, sids=None):
-    """INTERNAL: create a named pipe."""
+def _create_named_pipe(template, sids=None, overlapped=False, bufsize=1):
+    """INTERNAL: create a named pipe. If `overlapped' is set, our end of the
+    pipe is opened for overlapped I/O."""
     if sids is None:
         sattrs = None
     else:
         sattrs = _create_security_attributes(*sids)
+    mode = PIPE_ACCESS_DUPLEX
+    if overlapped:
+        mode |= FILE_FLAG_OVERLAPPED
     for i in range(100):
         name = template % random.randint(0, 999999)
         try:
-            pipe = CreateNamedPipe(name, PIPE_ACCESS_DUPLEX,
-                                   0, 1, 1, 1, 100000, sattrs)
+            pipe = CreateNamedPipe(name, mode, 0, 1, bufsize, bufsize, 100000,
+                                   sattrs)
             SetHandleInformation(pipe, HANDLE_FLAG_INHERIT, 0)
         except WindowsError, e:
             if e.winerror != ERROR_PIPE_BUSY:
@@ -224,12 +217,58 @@ def _create_named_pipe(template, sids=None):
     raise ExceptionPexpect, 'Could not create pipe after 100 attempts.'
 
 
-def _stub(cmd_name, stdin_name, stdout_name, stderr_name):
-    """INTERNAL: Stub process that will start up the child process."""
-    # Open the 4 pipes (command, stdin, stdout, stderr)
-    cmd_pipe = CreateFile(cmd_name, GENERIC_READ|GENERIC_WRITE, 0, None,
-                          OPEN_EXISTING, 0, None)
-    SetHandleInformation(cmd_pipe, HANDLE_FLAG_INHERIT, 1)
+def _connect_named_pipe(pipe, overlapped=False):
+    """INTERNAL: wait for the client of a named pipe to connect. A client
+    that was first is connected, also when it has closed its end already,
+    as a child that exits at once does; what it wrote can still be read."""
+    ov = None
+    if overlapped:
+        ov = OVERLAPPED()
+        ov.hEvent = CreateEvent(None, True, False, None)
+    try:
+        try:
+            # This returns ERROR_PIPE_CONNECTED if the client was first.
+            if ConnectNamedPipe(pipe, ov) == ERROR_IO_PENDING:
+                GetOverlappedResult(pipe, ov, True)
+        except WindowsError, e:
+            if e.winerror != ERROR_NO_DATA:
+                raise
+    finally:
+        if ov is not None:
+            CloseHandle(ov.hEvent)
+
+
+def _overlapped_file(handle):
+    """INTERNAL: return read(size) and write(s) functions for `handle', which
+    is opened for overlapped I/O, so that one thread can write while another
+    waits in a read. Errors are raised as IOError, and read() returns an
+    empty string at the end."""
+    def io(func, arg):
+        ov = OVERLAPPED()
+        ov.hEvent = CreateEvent(None, True, False, None)
+        try:
+            try:
+                func(handle, arg, ov)
+                return GetOverlappedResult(handle, ov, True)
+            except WindowsError, e:
+                if e.winerror in (ERROR_BROKEN_PIPE, ERROR_HANDLE_EOF):
+                    return 0
+                raise IOError(e.winerror, e.strerror)
+        finally:
+            CloseHandle(ov.hEvent)
+    def read(size):
+        buf = AllocateReadBuffer(size)
+        nbytes = io(ReadFile, buf)
+        return bytes(buf[:nbytes])
+    def write(s):
+        if s and not io(WriteFile, s):
+            raise IOError(ERROR_BROKEN_PIPE, 'The pipe has been ended.')
+    return read, write
+
+
+def _open_child_pipes(stdin_name, stdout_name, stderr_name):
+    """INTERNAL: Open the client ends of the stdin, stdout and stderr pipes
+    of a child, to be inherited by it."""
     stdin_pipe = CreateFile(stdin_name, GENERIC_READ, 0, None,
                             OPEN_EXISTING, 0, None)
     SetHandleInformation(stdin_pipe, HANDLE_FLAG_INHERIT, 1)
@@ -239,13 +278,84 @@ def _stub(cmd_name, stdin_name, stdout_name, stderr_name):
     stderr_pipe = CreateFile(stderr_name, GENERIC_WRITE, 0, None,
                              OPEN_EXISTING, 0, None)
     SetHandleInformation(stderr_pipe, HANDLE_FLAG_INHERIT, 1)
+    return stdin_pipe, stdout_pipe, stderr_pipe
+
+
+def _stub(cmd_name, stdin_name, stdout_name, stderr_name):
+    """INTERNAL: Stub process that will start up the child process."""
+    # Open the 4 pipes (command, stdin, stdout, stderr)
+    cmd_pipe = CreateFile(cmd_name, GENERIC_READ|GENERIC_WRITE, 0, None,
+                          OPEN_EXISTING, 0, None)
+    SetHandleInformation(cmd_pipe, HANDLE_FLAG_INHERIT, 1)
+    pipes = _open_child_pipes(stdin_name, stdout_name, stderr_name)
 
     # Learn what we need to do..
-    header = _read_header(cmd_pipe)
-    input = _parse_header(header)
-    if 'command' not in input or 'args' not in input:
+    channel = _control_channel(cmd_pipe)
+    try:
+        input = channel.receive()
+    except ValueError:
+        input = None
+    if not input or 'command' not in input or 'args' not in input:
         ExitProcess(2)
 
+    try:
+        pid = _create_child(input, pipes, os.environ, os.getcwd())
+    except WindowsError, e:
+        channel.send([('status', 'error'), ('message', str(e))])
+        ExitProcess(3)
+
+    # Pass back results and exit
+    channel.send([('status', 'ok'), ('pid', pid)])
+    ExitProcess(0)
+
+
+def _mux_stub(pipe_name):
+    """INTERNAL: Stub process that starts the child and then relays its
+    stdin, stdout and stderr over one pipe. See winpexpect_mux."""
+    pipe = CreateFile(pipe_name, GENERIC_READ|GENERIC_WRITE, 0, None,
+                      OPEN_EXISTING, FILE_FLAG_OVERLAPPED, None)
+    read, write = _overlapped_file(pipe)
+    channel = winpexpect_mux.mux_channel(read, write)
+    try:
+        input, early = channel.receive_control()
+    except (ValueError, IOError):
+        input = None
+    if not input or 'command' not in input or 'args' not in input:
+        ExitProcess(2)
+
+    # The child gets one end of three anonymous pipes, the relay the other.
+    stdin_read, stdin_write = CreatePipe(None, 0)
+    stdout_read, stdout_write = CreatePipe(None, 0)
+    stderr_read, stderr_write = CreatePipe(None, 0)
+    pipes = (stdin_read, stdout_write, stderr_write)
+    for handle in pipes:
+        SetHandleInformation(handle, HANDLE_FLAG_INHERIT, 1)
+    try:
+        pid = _create_child(input, pipes, os.environ, os.getcwd())
+    except WindowsError, e:
+        channel.send_control([('status', 'error'), ('message', str(e))])
+        ExitProcess(3)
+    for handle in pipes:
+        CloseHandle(handle)
+    channel.send_control([('status', 'ok'), ('pid', pid)])
+
+    def write_stdin(data):
+        try:
+            WriteFile(stdin_write, data)
+        except WindowsError, e:
+            raise IOError(e.winerror, e.strerror)
+    outputs = {winpexpect_mux.STDOUT: _read_file(stdout_read),
+               winpexpect_mux.STDERR: _read_file(stderr_read)}
+    winpexpect_mux.relay(channel, write_stdin, stdin_write.Close, outputs,
+                         early)
+    ExitProcess(0)
+
+
+def _create_child(input, pipes, env, cwd):
+    """INTERNAL: Start the child process that is described by the parsed
+    header `input', with `pipes' as its stdin, stdout and stderr. Return
+    its pid."""
+    stdin_pipe, stdout_pipe, stderr_pipe = pipes
     # http://msdn.microsoft.com/en-us/library/ms682499(VS.85).aspx
     startupinfo = STARTUPINFO()
     startupinfo.dwFlags |= STARTF_USESTDHANDLES | STARTF_USESHOWWINDOW
@@ -263,39 +373,98 @@ def _stub(cmd_name, stdin_name, stdout_name, stderr_name):
     else:
         sattrs = None
 
-    try:
-        res = CreateProcess(input['command'], input['args'], sattrs, None,
-                            True, CREATE_NEW_CONSOLE, os.environ, os.getcwd(),
-                            startupinfo)
-    except WindowsError, e:
-        message = _quote_header(str(e))
-        WriteFile(cmd_pipe, 'status=error\nmessage=%s\n\n' % message)
-        ExitProcess(3)
-    else:
-        pid = res[2]
+    res = CreateProcess(input['command'], input['args'], sattrs, None,
+                        True, CREATE_NEW_CONSOLE, env, cwd, startupinfo)
+    res[0].Close()
+    res[1].Close()
+    return res[2]
 
-    # Pass back results and exit
-    err, nbytes = WriteFile(cmd_pipe, 'status=ok\npid=%s\n\n' % pid)
+
+def _broker_main(cmd_name):
+    """INTERNAL: Broker process that starts child processes on the requests
+    of winspawn instances in its parent, until the parent closes the
+    command pipe. See winpexpect_broker."""
+    cmd_pipe = CreateFile(cmd_name, GENERIC_READ|GENERIC_WRITE, 0, None,
+                          OPEN_EXISTING, 0, None)
+    def create_process(request):
+        pipes = _open_child_pipes(request['stdin'], request['stdout'],
+                                  request['stderr'])
+        try:
+            env = request.get('env', os.environ)
+            cwd = request.get('cwd', os.getcwd())
+            return _create_child(request, pipes, env, cwd)
+        finally:
+            # The child has its own handles, which it inherited.
+            for pipe in pipes:
+                CloseHandle(pipe)
+    broker(_read_file(cmd_pipe), _write_file(cmd_pipe), create_process,
+           frame_codec).serve()
     ExitProcess(0)
 
 
-class ChunkBuffer(object):
-    """A buffer that allows a chunk of data to be read in smaller reads."""
+class spawn_broker(object):
+    """A broker process that starts the children of winspawn instances
+    instead of a stub per child. See winpexpect_broker. It is started in
+    the constructor. Children with another username are still started by a
+    stub. The broker runs in a console of its own, like the stubs."""
 
-    def __init__(self, chunk=''):
-        self.add(chunk)
+    pipe_template = r'\\.\pipe\winpexpect-broker-%06d'
 
-    def add(self, chunk):
-        self.chunk = chunk
-        self.offset = 0 
+    def __init__(self):
+        sids = [_get_current_sid()]
+        cmd_pipe, cmd_name = _create_named_pipe(self.pipe_template, sids)
+        startupinfo = STARTUPINFO()
+        startupinfo.dwFlags |= STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = SW_HIDE
+        python = os.path.join(sys.exec_prefix, 'python.exe')
+        pycmd = 'import winpexpect; winpexpect._broker_main(r"%s")' % cmd_name
+        pyargs = join_command_line([python, '-c', pycmd])
+        res = CreateProcess(python, pyargs, None, None, False,
+                            CREATE_NEW_CONSOLE, None, None, startupinfo)
+        self.handle = res[0]
+        res[1].Close()
+        self.pid = res[2]
+        ConnectNamedPipe(cmd_pipe)
+        self.cmd_pipe = cmd_pipe
+        self.client = broker_client(_read_file(cmd_pipe),
+                                    _write_file(cmd_pipe), frame_codec)
+        self.closed = False
 
-    def read(self, size):
-        data = self.chunk[self.offset:self.offset+size]
-        self.offset += size
-        return data
+    def spawn(self, command, args, stdin, stdout, stderr, cwd=None,
+              env=None, parent_sid=None):
+        """Start a child and return the parsed reply of the broker."""
+        if self.closed:
+            raise ExceptionPexpect, 'The spawn broker is closed.'
+        return self.client.spawn(command, args, stdin, stdout, stderr, cwd,
+                                 env, parent_sid)
 
-    def __len__(self):
-        return max(0, len(self.chunk)-self.offset)
+    def close(self):
+        """Stop the broker process. Its children keep running."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.client.quit()
+        finally:
+            CloseHandle(self.cmd_pipe)
+            WaitForSingleObject(self.handle, INFINITE)
+            CloseHandle(self.handle)
+
+
+_default_broker = None
+_default_broker_lock = Lock()
+
+def default_broker():
+    """Return the spawn broker that is shared by all winspawn instances that
+    are created with broker=True. It is started on first use."""
+    global _default_broker
+    _default_broker_lock.acquire()
+    try:
+        if _default_broker is None or _default_broker.closed:
+            _default_broker = spawn_broker()
+        return _default_broker
+    finally:
+        _default_broker_lock.release()
 
 
 class winspawn(spawn):
@@ -323,18 +492,80 @@ class winspawn(spawn):
     # service).
 
     pipe_buffer = 4096
+    mux_buffer = 65536
     pipe_template = r'\\.\pipe\winpexpect-%06d'
+    searchercache = searcher_cache(100)
+    output_waker = None
 
     def __init__(self, command, args=[], timeout=30, maxread=2000,
                  searchwindowsize=None, logfile=None, cwd=None, env=None,
-                 username=None, domain=None, password=None):
-        """Constructor."""
+                 username=None, domain=None, password=None, lowlatency=False,
+                 binary=False, reactor=None, maxqueue=None,
+                 separate_stderr=False, stderr_sink=None, broker=None,
+                 multiplex=False):
+        """Constructor. If `reactor' is given, the output of the child is
+        read by that winpexpect_io.reactor instead of by two threads of its
+        own. Pass True to use the reactor that is shared by default.
+
+        If `maxqueue' is given, no more output is read from the child while
+        that many bytes of it are queued, until half of it is consumed. The
+        pipes then fill up and the child blocks in its writes. The queue is
+        available as `child_output'; its attributes `nbytes', `maxbytes',
+        `stalls' and `stalltime' tell how full it is and how often and how
+        long the child was held up.
+
+        If `separate_stderr' is set, stdout and stderr are buffered apart,
+        and expect() takes a `stream' argument that says which of them to
+        search: 'stdout', 'stderr' or 'both'. The default is in `stream',
+        which is 'stdout' then. If `stderr_sink' is given, a file-like
+        object or a callable, all of stderr goes there instead and only
+        stdout can be searched.
+
+        If `broker' is given, a spawn_broker, the child is started by that
+        broker instead of by a new stub process. Pass True to use the
+        broker that is shared by default. A child with a `username' is
+        always started by a stub.
+
+        If `multiplex' is set, the stub stays as a relay between us and the
+        child, and stdin, stdout and stderr share one pipe to it, which is
+        read by one thread. See winpexpect_mux. This cannot be combined
+        with a `reactor' or a `broker'."""
+        if multiplex and (reactor is not None or broker is not None):
+            raise ValueError('multiplex cannot be combined with a reactor '
+                             'or a broker.')
+        if reactor is True:
+            reactor = winpexpect_io.default_reactor()
+        self.reactor = reactor
+        if broker is True:
+            broker = default_broker()
+        self.broker = broker
+        self.multiplex = multiplex
+        self.mux = None
+        self.mux_pipe = None
+        self.mux_reader = None
+        self.stub_handle = None
+        self.reactor_keys = {}
         self.username = username
         self.domain = domain
         self.password = password
         self.child_handle = None
-        self.child_output = Queue()
-        self.chunk_buffer = ChunkBuffer()
+        self.child_output = winpexpect_io.output_queue(maxqueue)
+        if binary:
+            self.chunk_buffer = ChunkBuffer(empty=''.encode('ascii'))
+        else:
+            self.chunk_buffer = ChunkBuffer(empty='')
+        self.pending_output = None
+        if hasattr(stderr_sink, 'write'):
+            stderr_sink = stderr_sink.write
+        self.stderr_sink = stderr_sink
+        self.separate_stderr = separate_stderr or stderr_sink is not None
+        if self.separate_stderr:
+            self.stream = 'stdout'
+        else:
+            self.stream = 'both'
+        self.output_streams = None
+        self.stream_buffers = {}    # Of the streams not in self._buffer.
+        self.buffer_stream = self.stream
         self.stdout_handle = None
         self.stdout_eof = False
         self.stdout_reader = None
@@ -343,7 +574,8 @@ class winspawn(spawn):
         self.stderr_reader = None
         super(winspawn, self).__init__(command, args, timeout=timeout,
                 maxread=maxread, searchwindowsize=searchwindowsize,
-                logfile=logfile, cwd=cwd, env=env)
+                logfile=logfile, cwd=cwd, env=env, lowlatency=lowlatency,
+                binary=binary)
 
     def __del__(self):
         try:
@@ -373,18 +605,153 @@ class winspawn(spawn):
         sids = [_get_current_sid()]
         if self.username and self.password:
             sids.append(_lookup_sid(self.domain, self.username))
-        cmd_pipe, cmd_name = _create_named_pipe(self.pipe_template, sids)
+        if self.multiplex:
+            self._spawn_mux(command, args, sids)
+            self.terminated = False
+            self.closed = False
+            return
         stdin_pipe, stdin_name = _create_named_pipe(self.pipe_template, sids)
-        stdout_pipe, stdout_name = _create_named_pipe(self.pipe_template, sids)
-        stderr_pipe, stderr_name = _create_named_pipe(self.pipe_template, sids)
+        # The reactor uses overlapped I/O on the output pipes.
+        overlapped = self.reactor is not None
+        stdout_pipe, stdout_name = _create_named_pipe(self.pipe_template, sids,
+                                                      overlapped)
+        stderr_pipe, stderr_name = _create_named_pipe(self.pipe_template, sids,
+                                                      overlapped)
+
+        pipes = (stdin_pipe, stdout_pipe, stderr_pipe)
+        try:
+            if self.broker is not None and \
+                    not (self.username and self.password):
+                # The broker passes on our environment and directory, as a
+                # stub would inherit them.
+                env = self.env
+                if env is None:
+                    env = os.environ
+                output = self.broker.spawn(command, args, stdin_name,
+                                           stdout_name, stderr_name,
+                                           self.cwd or os.getcwd(), env)
+                stub_handle = None
+            else:
+                output, stub_handle = self._spawn_stub(command, args, sids,
+                        stdin_name, stdout_name, stderr_name)
+        except:
+            for pipe in pipes:
+                CloseHandle(pipe)
+            raise
+
+        # A child that did not start may never open the pipes, so the reply
+        # is checked before waiting for them. A child that did start has
+        # opened them, and may have closed them again if it exited already.
+        if not output or output.get('status') != 'ok':
+            for pipe in pipes:
+                CloseHandle(pipe)
+            if stub_handle is not None:
+                WaitForSingleObject(stub_handle, INFINITE)
+                CloseHandle(stub_handle)
+            m = 'Child did not start up correctly. '
+            m += (output or {}).get('message', '')
+            raise ExceptionPexpect, m
+        _connect_named_pipe(stdin_pipe)
+        _connect_named_pipe(stdout_pipe, overlapped)
+        _connect_named_pipe(stderr_pipe, overlapped)
+        self.pid = int(output['pid'])
+        self.child_handle = OpenProcess(PROCESS_ALL_ACCESS, False, self.pid)
+        if stub_handle is not None:
+            WaitForSingleObject(stub_handle, INFINITE)
+            CloseHandle(stub_handle)
 
+        # Start up the I/O threads
+        self.child_fd = open_osfhandle(stdin_pipe.Detach(), 0)  # for pexpect
+        self.stdout_handle = stdout_pipe
+        self.stderr_handle = stderr_pipe
+        if self.separate_stderr:
+            self.output_streams = winpexpect_io.output_streams(
+                    self.child_output, stdout_pipe, self.stderr_sink)
+        if self.reactor is not None:
+            for handle in (stdout_pipe, stderr_pipe):
+                key = self.reactor.register(handle,
+                        self._reactor_output(handle), self.maxread)
+                self.reactor_keys[handle] = key
+        else:
+            self.stdout_reader = Thread(target=self._child_reader,
+                                        args=(self.stdout_handle,))
+            self.stdout_reader.start()
+            self.stderr_reader = Thread(target=self._child_reader,
+                                        args=(self.stderr_handle,))
+            self.stderr_reader.start()
+        self.terminated = False
+        self.closed = False
+
+    def _spawn_stub(self, command, args, sids, stdin_name, stdout_name,
+                    stderr_name):
+        """INTERNAL: Start a stub process that starts the child. Return the
+        parsed reply of the stub and the handle of the stub process."""
+        cmd_pipe, cmd_name = _create_named_pipe(self.pipe_template, sids)
+        pycmd = 'import winpexpect; winpexpect._stub(r"%s", r"%s", r"%s", r"%s")' \
+                    % (cmd_name, stdin_name, stdout_name, stderr_name)
+        stub_handle, token = self._start_stub(pycmd)
+
+        ConnectNamedPipe(cmd_pipe)
+
+        # Tell the stub what to do. It exits after its reply.
+        channel = _control_channel(cmd_pipe)
+        channel.send(self._stub_request(command, args, token))
+        try:
+            output = channel.receive() or {}
+        except ValueError, e:
+            output = {'message': str(e)}
+        CloseHandle(cmd_pipe)
+        return output, stub_handle
+
+    def _spawn_mux(self, command, args, sids):
+        """INTERNAL: Start the child through a stub that stays as a relay,
+        with all the streams of the child on one pipe."""
+        pipe, name = _create_named_pipe(self.pipe_template, sids, True,
+                                        self.mux_buffer)
+        pycmd = 'import winpexpect; winpexpect._mux_stub(r"%s")' % name
+        stub_handle, token = self._start_stub(pycmd)
+        _connect_named_pipe(pipe, True)
+
+        read, write = _overlapped_file(pipe)
+        channel = winpexpect_mux.mux_channel(read, write)
+        channel.send_control(self._stub_request(command, args, token))
+        try:
+            # The relay sends no output before its reply.
+            output, early = channel.receive_control()
+        except (ValueError, IOError), e:
+            output = {'message': str(e)}
+        if not output or output.get('status') != 'ok':
+            CloseHandle(pipe)
+            WaitForSingleObject(stub_handle, INFINITE)
+            CloseHandle(stub_handle)
+            m = 'Child did not start up correctly. '
+            m += (output or {}).get('message', '')
+            raise ExceptionPexpect, m
+        self.pid = int(output['pid'])
+        self.child_handle = OpenProcess(PROCESS_ALL_ACCESS, False, self.pid)
+        self.stub_handle = stub_handle
+        self.mux = channel
+        self.mux_pipe = pipe
+        self.stdout_handle = winpexpect_mux.STDOUT
+        self.stderr_handle = winpexpect_mux.STDERR
+        if self.separate_stderr:
+            self.output_streams = winpexpect_io.output_streams(
+                    self.child_output, self.stdout_handle, self.stderr_sink)
+        streams = (self.stdout_handle, self.stderr_handle)
+        wait = self.child_output.wait_writable
+        self.mux_reader = Thread(target=channel.serve,
+                                 args=(self._mux_output, streams, wait))
+        self.mux_reader.start()
+
+    def _start_stub(self, pycmd):
+        """INTERNAL: Start a stub process that runs `pycmd', as the user of
+        the child. Return the handle of the stub and the logon token, or
+        None if the stub runs as the current user."""
         startupinfo = STARTUPINFO()
         startupinfo.dwFlags |= STARTF_USESHOWWINDOW
         startupinfo.wShowWindow = SW_HIDE
 
         python = os.path.join(sys.exec_prefix, 'python.exe')
-        pycmd = 'import winpexpect; winpexpect._stub(r"%s", r"%s", r"%s", r"%s")' \
-                    % (cmd_name, stdin_name, stdout_name, stderr_name)
         pyargs = join_command_line([python, '-c', pycmd])
 
         # Create a new token or run as the current process.
@@ -399,44 +766,16 @@ class winspawn(spawn):
             res = CreateProcess(python, pyargs, None, None, False,
                                 CREATE_NEW_CONSOLE, self.env, self.cwd,
                                 startupinfo)
-        child_handle = res[0]
         res[1].Close()  # don't need thread handle
+        return res[0], token
 
-        ConnectNamedPipe(cmd_pipe)
-        ConnectNamedPipe(stdin_pipe)
-        ConnectNamedPipe(stdout_pipe)
-        ConnectNamedPipe(stderr_pipe)
-
-        # Tell the stub what to do and wait for it to exit
-        WriteFile(cmd_pipe, 'command=%s\n' % command)
-        WriteFile(cmd_pipe, 'args=%s\n' % args)
+    def _stub_request(self, command, args, token):
+        """INTERNAL: Return the request that tells a stub what to start."""
+        request = [('command', command), ('args', args)]
         if token:
             parent_sid = ConvertSidToStringSid(_get_current_sid())
-            WriteFile(cmd_pipe, 'parent_sid=%s\n' % str(parent_sid))
-        WriteFile(cmd_pipe, '\n')
-
-        header = _read_header(cmd_pipe)
-        output = _parse_header(header)
-        if output['status'] != 'ok':
-            m = 'Child did not start up correctly. '
-            m += output.get('message', '')
-            raise ExceptionPexpect, m
-        self.pid = int(output['pid'])
-        self.child_handle = OpenProcess(PROCESS_ALL_ACCESS, False, self.pid)
-        WaitForSingleObject(child_handle, INFINITE)
-
-        # Start up the I/O threads
-        self.child_fd = open_osfhandle(stdin_pipe.Detach(), 0)  # for pexpect
-        self.stdout_handle = stdout_pipe
-        self.stdout_reader = Thread(target=self._child_reader,
-                                    args=(self.stdout_handle,))
-        self.stdout_reader.start()
-        self.stderr_handle = stderr_pipe
-        self.stderr_reader = Thread(target=self._child_reader,
-                                    args=(self.stderr_handle,))
-        self.stderr_reader.start()
-        self.terminated = False
-        self.closed = False
+            request.append(('parent_sid', str(parent_sid)))
+        return request
 
     def terminate(self):
         """Terminate the child process. This also closes all the file
@@ -460,16 +799,30 @@ class winspawn(spawn):
         """Close all communications channels with the child."""
         if self.closed:
             return
-        os.close(self.child_fd)
-        CloseHandle(self.stdout_handle)
-        CloseHandle(self.stderr_handle)
-        # File descriptors are closed, nothing can be added to the queue
-        # anymore. Empty it in case a thread was blocked on put().
-        while self.child_output.qsize():
-            self.child_output.get()
-        # Now the threads are ready to be joined.
-        self.stdout_reader.join()
-        self.stderr_reader.join()
+        self._sync_logs()
+        for key in self.reactor_keys.values():
+            self.reactor.unregister(key)
+        if self.mux is not None:
+            # The relay exits on 'quit', which ends the channel.
+            try:
+                self.mux.send_control([('op', 'quit')])
+            except IOError:
+                pass
+        else:
+            os.close(self.child_fd)
+            CloseHandle(self.stdout_handle)
+            CloseHandle(self.stderr_handle)
+        # This releases reader threads that wait for a full queue. Their
+        # next read fails on the closed handle.
+        self.child_output.close()
+        if self.stdout_reader is not None:
+            self.stdout_reader.join()
+            self.stderr_reader.join()
+        if self.mux_reader is not None:
+            self.mux_reader.join()
+            CloseHandle(self.mux_pipe)
+            WaitForSingleObject(self.stub_handle, INFINITE)
+            CloseHandle(self.stub_handle)
         self.closed = True
 
     def wait(self, timeout=None):
@@ -507,9 +860,11 @@ class winspawn(spawn):
         process."""
         status = 'data'
         while True:
+            self.child_output.wait_writable()
             try:
                 err, data = ReadFile(handle, self.maxread)
                 assert err == 0  # not expecting error w/o overlapped io
+                data = self._decode(data)
             except WindowsError, e:
                 if e.winerror == ERROR_BROKEN_PIPE:
                     status = 'eof'
@@ -517,10 +872,64 @@ class winspawn(spawn):
                 else:
                     status = 'error'
                     data = e.winerror
-            self.child_output.put((handle, status, data))
+            self._queue_output(handle, status, data)
             if status != 'data':
                 break
 
+    def _mux_output(self, stream, status, data):
+        """INTERNAL: Queue output that arrived on the multiplexed channel,
+        like _child_reader() does."""
+        if status == 'data':
+            data = self._decode(data)
+        elif status == 'eof':
+            data = ''
+        self._queue_output(stream, status, data)
+
+    def _write(self, s):
+        """INTERNAL: this is send() without the delaybeforesend. With
+        multiplex, the data is sent to the relay."""
+        if self.mux is None:
+            return super(winspawn, self)._write(s)
+        if self.logfile is not None:
+            self.logfile.write(s)
+            self.logfile.flush()
+        if self.logfile_send is not None:
+            self.logfile_send.write(s)
+            self.logfile_send.flush()
+        if self.transcript is not None:
+            self.transcript.record_send(s)
+        return self.mux.send(winpexpect_mux.STDIN, self._encode(s))
+
+    def _reactor_output(self, handle):
+        """INTERNAL: Return the reactor callback for the output `handle'. It
+        queues the output like _child_reader() does. When the queue is full
+        the handle is paused until it is consumed."""
+        def resume():
+            self.reactor.resume(self.reactor_keys[handle])
+        def output(status, data):
+            if status == 'data':
+                data = self._decode(data)
+            elif status == 'eof':
+                data = ''
+            return self._queue_output(handle, status, data, resume)
+        return output
+
+    def _queue_output(self, handle, status, data, resume=None):
+        """INTERNAL: Queue output of the child for read_nonblocking(). This
+        returns True if the queue is full; `resume' is then called when it
+        is not anymore."""
+        stalled = self.child_output.put((handle, status, data), resume)
+        waker = self.output_waker
+        if waker is not None:
+            waker()
+        return stalled
+
+    def _get_output(self, timeout):
+        """INTERNAL: Get the next item from the output queue, or raise Empty
+        after `timeout' seconds. The queue blocks until then; it does not
+        poll."""
+        return self.child_output.get(timeout=timeout)
+
     def _set_eof(self, handle):
         """INTERNAL: mark a file handle as end-of-file."""
         if handle == self.stdout_handle:
@@ -528,32 +937,162 @@ class winspawn(spawn):
         elif handle == self.stderr_handle:
             self.stderr_eof = True
 
+    def _add_reader(self, loop, callback):
+        """INTERNAL: Make the asyncio event loop call `callback' when there is
+        output. The pipes cannot be added to the event loop, but the reader
+        threads wake it up with call_soon_threadsafe() after they queue
+        something."""
+        self.output_waker = lambda: loop.call_soon_threadsafe(callback)
+        # Output that was queued before the waker was set.
+        if self.child_output.qsize():
+            loop.call_soon(callback)
+
+    def _remove_reader(self, loop):
+        """INTERNAL: Undo _add_reader()."""
+        self.output_waker = None
+
+    def _set_output_waker(self, waker):
+        """INTERNAL: The reader threads call `waker' after they queue output,
+        which is how a session_group waits for many winspawns at once."""
+        self.output_waker = waker
+        return True
+
+    def _add_writer(self, loop, callback):
+        """INTERNAL: The stdin pipe cannot be added to the event loop, so
+        send_async() writes from a thread."""
+        return False
+
+    def expect(self, pattern, timeout=-1, searchwindowsize=None,
+               maxwidths=None, before_sink=-1, stream=None):
+        """This is spawn.expect(). With separate_stderr, `stream' is the
+        output that is searched; see the constructor."""
+        self._select_stream(stream)
+        return super(winspawn, self).expect(pattern, timeout,
+                searchwindowsize, maxwidths, before_sink)
+
+    def expect_list(self, pattern_list, timeout=-1, searchwindowsize=-1,
+                    maxwidths=None, before_sink=-1, stream=None):
+        """This is spawn.expect_list(), with `stream' as for expect()."""
+        self._select_stream(stream)
+        return super(winspawn, self).expect_list(pattern_list, timeout,
+                searchwindowsize, maxwidths, before_sink)
+
+    def expect_exact(self, pattern_list, timeout=-1, searchwindowsize=-1,
+                     before_sink=-1, stream=None):
+        """This is spawn.expect_exact(), with `stream' as for expect()."""
+        self._select_stream(stream)
+        return super(winspawn, self).expect_exact(pattern_list, timeout,
+                searchwindowsize, before_sink)
+
+    def _select_stream(self, stream):
+        """INTERNAL: Make `stream' the output that is read and searched.
+        The unmatched output of the stream that was searched before is kept
+        in its own buffer, or, for 'both', split over the two."""
+        if stream is None:
+            stream = self.stream
+        if stream not in ('stdout', 'stderr', 'both'):
+            raise ValueError('Unknown stream: %r' % (stream,))
+        if not self.separate_stderr:
+            if stream != 'both':
+                raise ValueError('stdout and stderr are not separated.')
+            return
+        if self.stderr_sink is not None and stream != 'stdout':
+            raise ValueError('stderr goes to stderr_sink.')
+        if stream == self.buffer_stream:
+            return
+        self._unread_lines()
+        current = self._buffer
+        if self.buffer_stream == 'both':
+            for name in ('stdout', 'stderr'):
+                self.stream_buffers[name] = expect_buffer(self._empty)
+            for name, length in self.output_streams.origins(len(current)):
+                self.stream_buffers[name].extend(current.split(length))
+        else:
+            self.stream_buffers[self.buffer_stream] = current
+        if stream == 'both':
+            current = expect_buffer(self._empty)
+            for name in ('stdout', 'stderr'):
+                buf = self.stream_buffers.pop(name, None)
+                if buf is not None:
+                    self.output_streams.mark(name, len(buf))
+                    current.extend(buf)
+        else:
+            current = self.stream_buffers.pop(stream, None)
+            if current is None:
+                current = expect_buffer(self._empty)
+        self._buffer = current
+        self.buffer_stream = stream
+
     def read_nonblocking(self, size=1, timeout=-1):
-        """INTERNAL: Non blocking read."""
-        if len(self.chunk_buffer):
-            return self.chunk_buffer.read(size)
-        if self.stdout_eof and self.stderr_eof:
-            assert self.child_output.qsize() == 0
-            return ''
+        """INTERNAL: Non blocking read. This waits for output only if none
+        is buffered, and then returns all output that is queued, up to
+        `size', so that expect() does not search after every small chunk."""
+        if self.output_streams is not None:
+            return self._read_stream(size, timeout)
+        buf = self.chunk_buffer
+        if not len(buf):
+            item = self.pending_output
+            self.pending_output = None
+            if item is None:
+                if self.stdout_eof and self.stderr_eof:
+                    assert self.child_output.qsize() == 0
+                    return self._empty
+                if timeout == -1:
+                    timeout = self.timeout
+                try:
+                    item = self._get_output(timeout)
+                except Empty:
+                    raise TIMEOUT, 'Timeout exceeded in read_nonblocking().'
+            handle, status, data = item
+            if status == 'data':
+                buf.add(data)
+            elif status == 'eof':
+                self._set_eof(handle)
+                self._log_eof()
+                raise EOF, 'End of file in read_nonblocking().'
+            elif status == 'error':
+                self._set_eof(handle)
+                raise OSError, data
+        if self.pending_output is None:
+            # An EOF or error that is queued after the data is kept for the
+            # next call.
+            self.pending_output = buf.drain(self.child_output, size)
+        data = buf.read(size)
+        self._log_read(data)
+        return data
+
+    def _read_stream(self, size, timeout):
+        """INTERNAL: read_nonblocking() with separate_stderr. This reads
+        the stream that is selected by _select_stream()."""
         if timeout == -1:
             timeout = self.timeout
-        try:    
-            handle, status, data = self.child_output.get(timeout=timeout)
+        streams = self.output_streams
+        try:
+            stream, status, data = streams.read(self.buffer_stream, size,
+                                                self._get_output, timeout)
         except Empty:
             raise TIMEOUT, 'Timeout exceeded in read_nonblocking().'
-        if status == 'data':
-            self.chunk_buffer.add(data)
-        elif status == 'eof':
-            self._set_eof(handle)
+        if status == 'eof':
+            self._log_eof()
             raise EOF, 'End of file in read_nonblocking().'
         elif status == 'error':
-            self._set_eof(handle)
             raise OSError, data
-        buf = self.chunk_buffer.read(size)
+        if self.buffer_stream == 'both' and len(streams.segments) > 1000:
+            # Only the origins of what can still be unmatched are needed.
+            unread = self._lines[self._linepos:]
+            streams.trim(len(self._buffer) + sum(map(len, unread)) +
+                         len(data))
+        self._log_read(data, stream)
+        return data
+
+    def _log_read(self, data, stream=None):
+        """INTERNAL: Write output that was read to the logfiles. `stream' is
+        the stream it was read from, with separate_stderr."""
         if self.logfile is not None:
-            self.logfile.write(buf)
+            self.logfile.write(data)
             self.logfile.flush()
         if self.logfile_read is not None:
-            self.logfile_read.write(buf)
+            self.logfile_read.write(data)
             self.logfile_read.flush()
-        return buf
+        if self.transcript is not None:
+            self.transcript.record_read(data, stream)
@@ -0,0 +1,399 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""The control protocol of winspawn, and a broker that speaks it.
+
+By default winspawn starts every child through a stub: a new python.exe
+that opens the pipes of the child, calls CreateProcess() and exits. That
+is an interpreter start-up for every child. A broker is a stub that stays:
+it is started once, and then starts any number of children on requests
+that it reads from one control channel::
+
+    broker = winpexpect.spawn_broker()
+    child = winspawn('cmd.exe', broker=broker)
+
+Requests and replies are sets of fields, such as the command, the args,
+the env and the cwd of the child, or the status and pid in a reply. Two
+codecs put them on the channel. The header codec writes key=value lines,
+ended by an empty line. The frame codec, which is the default and which
+winspawn uses with its stub and its broker, writes binary frames: a version and a length, and then
+each field as an id, a length and a value. Values need no quoting, and a
+frame is read with one pass over the data.
+
+Nothing here depends on Windows: the broker works over any channel that it
+can read and write, and with any function that starts a process, which is
+how it is tested.
+"""
+
+import sys
+import struct
+import threading
+
+
+# Compatibility with Python 3: frames are bytes, fields are text.
+if sys.version_info[0] == 3:
+
+    def _encode(s):
+        return s.encode('utf-8')
+
+    def _decode(b):
+        return b.decode('utf-8')
+
+else:
+
+    def _encode(s):
+        if isinstance(s, unicode):
+            return s.encode('utf-8')
+        return s
+
+    def _decode(b):
+        return b
+
+
+def _parse_header(header):
+    """INTERNAL: parse the stub header format. A line that starts with a
+    space continues the value of the line before it."""
+    parsed = {}
+    key = None
+    lines = header.split('\n')
+    for line in lines:
+        if not line:
+            break
+        p1 = line.find('=')
+        if line.startswith(' '):  # Continuation
+            if key is None:
+                raise ValueError, 'Continuation on first line.'
+            parsed[key] += '\n' + line[1:]
+            continue
+        if p1 == -1:
+            raise ValueError, 'Expecting key=value format'
+        key = line[:p1]
+        parsed[key] = line[p1+1:]
+    return parsed
+
+
+def _quote_header(s):
+    """INTERNAL: quote a string to be used in a stub header."""
+    return s.replace('\n', '\n ')
+
+
+def _format_header(fields):
+    """INTERNAL: format a header from a sequence of (key, value) tuples."""
+    lines = []
+    for key, value in fields:
+        if key == 'env':
+            value = _format_env(value)
+        lines.append('%s=%s\n' % (key, _quote_header(str(value))))
+    lines.append('\n')
+    return ''.join(lines)
+
+
+def _format_env(env, sep='\n'):
+    """INTERNAL: format an environment as one NAME=value per line, or per
+    `sep'."""
+    return sep.join(['%s=%s' % item for item in sorted(env.items())])
+
+
+def _parse_env(value, sep='\n'):
+    """INTERNAL: parse an environment that was formatted by _format_env().
+    Names may start with '=', as the current directories per drive do."""
+    env = {}
+    for line in value.split(sep):
+        if not line:
+            continue
+        p1 = line.find('=', 1)
+        if p1 == -1:
+            raise ValueError, 'Expecting NAME=value format'
+        env[line[:p1]] = line[p1+1:]
+    return env
+
+
+# The frame format. A frame is a header with the version of the protocol
+# and the size of the body, and a body with the fields. A field is its id,
+# the size of its value, and the value in UTF-8. The env is one value, with
+# its NAME=value entries separated by NUL characters. Fields with an
+# unknown id are skipped, so fields can be added in the same version.
+
+PROTOCOL_VERSION = 1
+MAX_FRAME_SIZE = 16 << 20
+
+_frame_header = struct.Struct('>BI')
+_field_header = struct.Struct('>BI')
+
+_field_ids = {'op': 1, 'command': 2, 'args': 3, 'env': 4, 'cwd': 5,
+              'parent_sid': 6, 'status': 7, 'pid': 8, 'message': 9,
+              'stdin': 10, 'stdout': 11, 'stderr': 12}
+_field_names = dict([(id, name) for name, id in _field_ids.items()])
+
+
+def encode_frame(fields):
+    """Encode a sequence of (key, value) tuples as a frame. The values are
+    strings, except 'env', which is a dictionary, and 'pid', which may be
+    an integer."""
+    parts = [None]
+    size = 0
+    for key, value in fields:
+        try:
+            id = _field_ids[key]
+        except KeyError:
+            raise ValueError, 'Unknown field: %s' % key
+        if key == 'env':
+            value = _format_env(value, '\0')
+        elif not isinstance(value, basestring):
+            value = str(value)
+        value = _encode(value)
+        parts.append(_field_header.pack(id, len(value)))
+        parts.append(value)
+        size += _field_header.size + len(value)
+    parts[0] = _frame_header.pack(PROTOCOL_VERSION, size)
+    return ''.encode('ascii').join(parts)
+
+
+def _check_frame_header(data, maxsize=MAX_FRAME_SIZE):
+    """INTERNAL: check a frame header and return the size of the body."""
+    version, size = _frame_header.unpack(data)
+    if version != PROTOCOL_VERSION:
+        raise ValueError, 'Unsupported protocol version: %d' % version
+    if size > maxsize:
+        raise ValueError, 'Frame too large: %d bytes' % size
+    return size
+
+
+def decode_body(body):
+    """Decode the body of a frame into a dictionary of fields."""
+    fields = {}
+    pos = 0
+    end = len(body)
+    while pos < end:
+        if end - pos < _field_header.size:
+            raise ValueError, 'Truncated field header'
+        id, size = _field_header.unpack_from(body, pos)
+        pos += _field_header.size
+        if size > end - pos:
+            raise ValueError, 'Truncated field value'
+        name = _field_names.get(id)
+        if name is not None:
+            value = _decode(body[pos:pos+size])
+            if name == 'env':
+                value = _parse_env(value, '\0')
+            fields[name] = value
+        pos += size
+    return fields
+
+
+def decode_frames(data, maxsize=MAX_FRAME_SIZE):
+    """Decode the complete frames at the start of `data'. Return a list of
+    dictionaries of fields, and the number of bytes they took."""
+    frames = []
+    pos = 0
+    end = len(data)
+    while end - pos >= _frame_header.size:
+        size = _check_frame_header(data[pos:pos+_frame_header.size], maxsize)
+        start = pos + _frame_header.size
+        if size > end - start:
+            break
+        frames.append(decode_body(data[start:start+size]))
+        pos = start + size
+    return frames, pos
+
+
+class header_reader(object):
+    """Reads headers from a channel, one after the other. Data that was read
+    after the end of one header is kept for the next."""
+
+    def __init__(self, read, bufsize=4096):
+        """Constructor. `read(size)' returns at most `size' characters from
+        the channel, or an empty string at the end."""
+        self.read = read
+        self.bufsize = bufsize
+        self.pending = ''
+
+    def next_header(self):
+        """Return the next header, including the empty line that ends it,
+        or '' if the channel ended first. Each read is searched for the end
+        of the header just once, and the parts are joined at the end."""
+        parts = []
+        data = self.pending
+        tail = ''   # The end of the previous part, for a split '\n\n'.
+        while True:
+            pos = (tail + data).find('\n\n')
+            if pos >= 0:
+                pos += 2 - len(tail)
+                parts.append(data[:pos])
+                self.pending = data[pos:]
+                return ''.join(parts)
+            if data:
+                parts.append(data)
+                tail = data[-1:]
+            data = self.read(self.bufsize)
+            if not data:
+                self.pending = ''
+                return ''
+
+
+class frame_reader(object):
+    """Reads frames from a channel, one after the other."""
+
+    def __init__(self, read, bufsize=65536, maxsize=MAX_FRAME_SIZE):
+        """Constructor. `read(size)' returns at most `size' bytes from the
+        channel, or an empty string at the end."""
+        self.read = read
+        self.bufsize = bufsize
+        self.maxsize = maxsize
+        self.buffer = ''.encode('ascii')
+        self.offset = 0
+
+    def _take(self, size):
+        """INTERNAL: return the next `size' bytes, or None if the channel
+        ended first."""
+        available = len(self.buffer) - self.offset
+        if available >= size:
+            data = self.buffer[self.offset:self.offset+size]
+            self.offset += size
+            return data
+        parts = [self.buffer[self.offset:]]
+        while available < size:
+            data = self.read(max(self.bufsize, size - available))
+            if not data:
+                self.buffer = ''.encode('ascii').join(parts)
+                self.offset = 0
+                return None
+            parts.append(data)
+            available += len(data)
+        self.buffer = ''.encode('ascii').join(parts)
+        self.offset = size
+        return self.buffer[:size]
+
+    def next_frame(self):
+        """Return the fields of the next frame, or None if the channel ended
+        before it. A channel that ends inside a frame raises ValueError."""
+        header = self._take(_frame_header.size)
+        if header is None:
+            if self.offset < len(self.buffer):
+                raise ValueError, 'Truncated frame header'
+            return None
+        body = self._take(_check_frame_header(header, self.maxsize))
+        if body is None:
+            raise ValueError, 'Truncated frame'
+        return decode_body(body)
+
+
+class header_codec(object):
+    """Sends and receives messages as headers. The channel carries text."""
+
+    def __init__(self, read, write):
+        self.reader = header_reader(read)
+        self.write = write
+
+    def send(self, fields):
+        self.write(_format_header(fields))
+
+    def receive(self):
+        """Return the next message, or None at the end of the channel."""
+        header = self.reader.next_header()
+        if not header:
+            return None
+        message = _parse_header(header)
+        if 'env' in message:
+            message['env'] = _parse_env(message['env'])
+        return message
+
+
+class frame_codec(object):
+    """Sends and receives messages as frames. The channel carries bytes."""
+
+    def __init__(self, read, write):
+        self.reader = frame_reader(read)
+        self.write = write
+
+    def send(self, fields):
+        self.write(encode_frame(fields))
+
+    def receive(self):
+        """Return the next message, or None at the end of the channel."""
+        return self.reader.next_frame()
+
+
+class broker(object):
+    """Starts children on requests that it reads from a channel, until the
+    channel ends or it is asked to quit.
+
+    A request has the 'command' and 'args', the names of the pipes for
+    'stdin', 'stdout' and 'stderr', and optionally 'cwd', 'env' (a
+    dictionary) and 'parent_sid'. The reply has 'status' 'ok' and the 'pid'
+    of the child, or 'status' 'error' and a 'message'. The request with
+    'op' 'quit' stops the broker."""
+
+    def __init__(self, read, write, create_process, codec=frame_codec):
+        """Constructor. `read(size)' and `write(s)' read and write the
+        channel, in the format of `codec', by default frames. `create_process(request)' starts
+        a child for a request and returns its pid."""
+        self.channel = codec(read, write)
+        self.create_process = create_process
+        self.spawns = 0
+
+    def serve(self):
+        """Handle requests until the channel ends or 'op=quit'."""
+        while True:
+            request = self.channel.receive()
+            if request is None:
+                return
+            if request.get('op') == 'quit':
+                self.channel.send([('status', 'ok')])
+                return
+            self.channel.send(self.handle(request))
+
+    def handle(self, request):
+        """Handle a spawn request and return the fields of the reply."""
+        if 'command' not in request or 'args' not in request:
+            return [('status', 'error'),
+                    ('message', 'The command and the args are required.')]
+        try:
+            pid = self.create_process(request)
+        except Exception, e:
+            # An error is sent back; the broker keeps serving.
+            return [('status', 'error'), ('message', str(e))]
+        self.spawns += 1
+        return [('status', 'ok'), ('pid', pid)]
+
+
+class broker_client(object):
+    """The other end of the channel of a broker. The requests of several
+    threads are sent one at a time."""
+
+    def __init__(self, read, write, codec=frame_codec):
+        self.channel = codec(read, write)
+        self._lock = threading.Lock()
+
+    def request(self, fields):
+        """Send a request with `fields', a sequence of (key, value) tuples,
+        and return the reply. An empty reply means that the broker is
+        gone."""
+        self._lock.acquire()
+        try:
+            self.channel.send(fields)
+            return self.channel.receive() or {}
+        finally:
+            self._lock.release()
+
+    def spawn(self, command, args, stdin, stdout, stderr, cwd=None,
+              env=None, parent_sid=None):
+        """Ask the broker to start a child and return the parsed reply."""
+        fields = [('command', command), ('args', args), ('stdin', stdin),
+                  ('stdout', stdout), ('stderr', stderr)]
+        if cwd is not None:
+            fields.append(('cwd', cwd))
+        if env is not None:
+            fields.append(('env', env))
+        if parent_sid is not None:
+            fields.append(('parent_sid', parent_sid))
+        return self.request(fields)
+
+    def quit(self):
+        """Ask the broker to stop."""
+        return self.request([('op', 'quit')])
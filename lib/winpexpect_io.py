@@ -0,0 +1,941 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""Shared I/O for winspawn.
+
+By default winspawn starts two threads for every child, to read its stdout
+and its stderr. With hundreds of children that is hundreds of threads, each
+with its own stack, that all compete for the GIL. A reactor reads the pipes
+of all children with a small, fixed number of threads instead, and hands
+every chunk that it reads to a callback::
+
+    reactor = winpexpect_io.reactor(threads=2)
+    child = winspawn('cmd.exe', reactor=reactor)
+
+How the pipes are waited on is up to a transport. On Windows this is an I/O
+completion port with overlapped reads. Elsewhere file descriptors are
+polled, which is also how the reactor is tested.
+
+A transport reads from a set of pipes for one reactor thread. It has these
+methods; add(), remove(), pause(), resume() and wakeup() may be called from
+any thread, wait() only from the reactor thread:
+
+    add(key, source, size)  Start reading from `source', a file descriptor
+                            or a handle, at most `size' bytes at a time.
+                            What is read is reported under `key'.
+    remove(key)             Stop reading for `key'. The source is not
+                            closed.
+    pause(key)              Stop reading for `key' until resume(key). Nothing
+                            that was read already is lost.
+    resume(key)             Undo pause().
+    wait()                  Wait until something was read, or until wakeup()
+                            is called, and return a list of (key, status,
+                            data) tuples. The status is 'data', 'eof' or
+                            'error'; for 'error' the data is the error
+                            number. A key is not reported after 'eof' or
+                            'error'.
+    wakeup()                Make a wait() in another thread return.
+    close()                 Release the resources of the transport.
+"""
+
+import os
+import sys
+import heapq
+import atexit
+import errno
+import time
+import select
+import threading
+import traceback
+
+from collections import deque
+from Queue import Empty
+
+try:
+    import pywintypes
+    from win32file import (CreateIoCompletionPort, GetQueuedCompletionStatus,
+                           PostQueuedCompletionStatus, ReadFile,
+                           AllocateReadBuffer, INVALID_HANDLE_VALUE)
+    from win32event import INFINITE
+    from winerror import ERROR_BROKEN_PIPE, ERROR_HANDLE_EOF
+except ImportError:
+    pywintypes = None
+
+
+_empty = ''.encode('ascii')
+
+# Python 2 cannot join memoryviews.
+try:
+    _empty.join([memoryview(_empty)])
+    _join_views = True
+except TypeError:
+    _join_views = False
+
+# On Python 2, Condition.wait() with a timeout polls, with sleeps of up to
+# 50ms. Python 3 blocks on a lock with a timeout.
+_timed_wait_polls = sys.version_info[0] < 3
+
+
+class _deadline_timer(object):
+    """INTERNAL: One thread that notifies conditions at their deadlines, so
+    that on Python 2 the waiters can wait without a timeout. The thread is
+    started when it is first needed and only runs while somebody waits."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._deadlines = []    # A heap of [time, sequence, condition].
+        self._sequence = 0
+        self._thread = None
+        self._stopped = False
+
+    def add(self, deadline, condition):
+        """Notify `condition' at `deadline', a time.time(). Return the
+        entry to pass to remove()."""
+        self._lock.acquire()
+        try:
+            self._sequence += 1
+            entry = [deadline, self._sequence, condition]
+            heapq.heappush(self._deadlines, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._changed.notify()
+            return entry
+        finally:
+            self._lock.release()
+
+    def remove(self, entry):
+        """Cancel the deadline `entry'."""
+        self._lock.acquire()
+        try:
+            entry[2] = None
+            # Let the thread drop it, rather than wait for it.
+            self._changed.notify()
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """Stop the thread. This is called at exit: a daemon thread of
+        Python 2 that is in a wait with a timeout when the interpreter shuts
+        down prints an error."""
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            self._changed.notify()
+            thread = self._thread
+        finally:
+            self._lock.release()
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        """INTERNAL: The thread."""
+        deadlines = self._deadlines
+        while True:
+            self._lock.acquire()
+            try:
+                while True:
+                    if self._stopped:
+                        return
+                    while deadlines and deadlines[0][2] is None:
+                        heapq.heappop(deadlines)
+                    if not deadlines:
+                        self._changed.wait()
+                        continue
+                    remaining = deadlines[0][0] - time.time()
+                    if remaining <= 0:
+                        condition = heapq.heappop(deadlines)[2]
+                        break
+                    self._changed.wait(remaining)
+            finally:
+                self._lock.release()
+            # Not under our lock: the waiter holds its own lock when it
+            # calls add().
+            condition.acquire()
+            try:
+                condition.notifyAll()
+            finally:
+                condition.release()
+
+_timer = _deadline_timer()
+atexit.register(_timer.stop)
+
+
+def timed_wait(condition, end_time):
+    """Wait on `condition', which the caller holds, until it is notified or
+    `end_time', a time.time(), has passed. Unlike Condition.wait() with a
+    timeout this does not poll on Python 2: the shared timer thread
+    notifies the condition at the deadline."""
+    remaining = end_time - time.time()
+    if remaining <= 0:
+        return
+    if not _timed_wait_polls:
+        condition.wait(remaining)
+        return
+    entry = _timer.add(end_time, condition)
+    try:
+        condition.wait()
+    finally:
+        _timer.remove(entry)
+
+
+class ChunkBuffer(object):
+    """A buffer that allows chunks of data to be read in reads of any size.
+
+    A chunk that is read whole is returned as is, without a copy. A read
+    that spans chunks joins its parts with one allocation, from memoryview
+    slices of the chunks where that is possible.
+
+    A read of an empty buffer, or of 0 characters, returns `empty', the
+    empty string of the type of the chunks. It is bytes until the first
+    chunk is added."""
+
+    __slots__ = ('chunks', 'offset', 'length', 'empty')
+
+    def __init__(self, chunk=_empty, empty=_empty):
+        self.chunks = deque()
+        self.offset = 0         # Into the first chunk.
+        self.length = 0
+        self.empty = empty
+        self.add(chunk)
+
+    def add(self, chunk):
+        if chunk:
+            self.chunks.append(chunk)
+            self.length += len(chunk)
+            self.empty = chunk[:0]
+
+    def read(self, size):
+        chunks = self.chunks
+        want = min(size, self.length)
+        if want <= 0:
+            return self.empty
+        parts = []
+        self.length -= want
+        while want:
+            chunk = chunks[0]
+            start = self.offset
+            end = start + want
+            if end >= len(chunk):
+                end = len(chunk)
+                chunks.popleft()
+                self.offset = 0
+            else:
+                self.offset = end
+            parts.append((chunk, start, end))
+            want -= end - start
+        if len(parts) == 1:
+            chunk, start, end = parts[0]
+            return chunk[start:end]  # The chunk itself if it is read whole.
+        chunk = parts[0][0]
+        if _join_views and isinstance(chunk, bytes):
+            return _empty.join([memoryview(c)[s:e] for c, s, e in parts])
+        return chunk[:0].join([c[s:e] for c, s, e in parts])
+
+    def drain(self, queue, size):
+        """Move the data that is waiting in `queue', a queue of (handle,
+        status, data) items like winspawn.child_output, to the buffer until
+        the buffer holds at least `size' characters. This does not block.
+        The first item that is not data is returned, for the caller to
+        handle after the data that is buffered; or None."""
+        while self.length < size:
+            try:
+                item = queue.get(False)
+            except Empty:
+                return None
+            if item[1] != 'data':
+                return item
+            self.add(item[2])
+        return None
+
+    def __len__(self):
+        return self.length
+
+
+class output_queue(object):
+    """The queue of (handle, status, data) items that winspawn's readers put
+    the output of the child on. It has the get(), put() and qsize() methods
+    of Queue.Queue, but it also counts the bytes of the data items.
+
+    If `highwater' is set, the queue stalls when it holds that many bytes,
+    until it is down to `lowwater' bytes again (by default half of
+    highwater). A stalled queue does not refuse items. Instead, the readers
+    wait with wait_writable() before each read, or they are paused, so that
+    the pipe fills up and the child blocks in its writes.
+
+    The attributes `nbytes' and `maxbytes' are the current and the largest
+    number of bytes in the queue. `stalls' counts the stalls and `stalltime'
+    is the number of seconds the queue was stalled, for the stalls that
+    ended."""
+
+    def __init__(self, highwater=None, lowwater=None):
+        if lowwater is None and highwater is not None:
+            lowwater = highwater // 2
+        self.highwater = highwater
+        self.lowwater = lowwater
+        self.nbytes = 0
+        self.maxbytes = 0
+        self.stalls = 0
+        self.stalltime = 0.0
+        self.closed = False
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._readable = threading.Condition(self._lock)
+        self._writable = threading.Condition(self._lock)
+        self._stalled = None    # The time the stall started.
+        self._resume = []       # Called when the stall ends.
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, item, resume=None):
+        """Add `item' to the queue. This does not block. It returns True if
+        the queue is stalled; `resume', if given, is then called when the
+        stall ends. Once the queue is closed, items are dropped."""
+        self._lock.acquire()
+        try:
+            if self.closed:
+                return False
+            self._items.append(item)
+            if item[1] == 'data':
+                self.nbytes += len(item[2])
+                self.maxbytes = max(self.maxbytes, self.nbytes)
+                if self._stalled is None and self.highwater is not None \
+                        and self.nbytes >= self.highwater:
+                    self._stalled = time.time()
+                    self.stalls += 1
+            self._readable.notify()
+            if self._stalled is None:
+                return False
+            if resume is not None:
+                self._resume.append(resume)
+            return True
+        finally:
+            self._lock.release()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the first item, like Queue.get(). Waiting with
+        a timeout does not poll: on Python 2 a shared timer thread wakes
+        the waiter at the deadline."""
+        resume = []
+        self._lock.acquire()
+        try:
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while not self._items:
+                if not block:
+                    raise Empty
+                if timeout is None:
+                    self._readable.wait()
+                elif end_time <= time.time():
+                    raise Empty
+                else:
+                    timed_wait(self._readable, end_time)
+            item = self._items.popleft()
+            if item[1] == 'data':
+                self.nbytes -= len(item[2])
+                if self._stalled is not None and self.nbytes <= self.lowwater:
+                    resume = self._end_stall()
+        finally:
+            self._lock.release()
+        for callback in resume:
+            callback()
+        return item
+
+    def wait_writable(self):
+        """Wait until the queue is not stalled, or closed."""
+        self._lock.acquire()
+        try:
+            while self._stalled is not None and not self.closed:
+                self._writable.wait()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Drop all items and end a stall, for good."""
+        resume = []
+        self._lock.acquire()
+        try:
+            self.closed = True
+            self._items.clear()
+            self.nbytes = 0
+            if self._stalled is not None:
+                resume = self._end_stall()
+        finally:
+            self._lock.release()
+        for callback in resume:
+            callback()
+
+    def _end_stall(self):
+        """INTERNAL: Let the readers continue and return the callbacks to
+        call once the lock is released. Called with the lock held."""
+        self.stalltime += time.time() - self._stalled
+        self._stalled = None
+        self._writable.notifyAll()
+        resume = self._resume
+        self._resume = []
+        return resume
+
+
+class output_streams(object):
+    """Splits the output of a winspawn child, a queue of (handle, status,
+    data) items, into its stdout and its stderr. Each stream has a buffer
+    of its own, so that reading one leaves the output of the other for
+    later. Output on stderr can be passed to `sink' instead, a callable that
+    is called with every chunk.
+
+    The streams are read with read(), as 'stdout', 'stderr' or 'both'. The
+    output of both streams is returned in the order it was queued, except
+    for output that was buffered while only one of them was read.
+    origins() tells which stream the output of 'both' came from."""
+
+    def __init__(self, queue, stdout, sink=None):
+        """Constructor. `stdout' is the handle of stdout in the items of
+        `queue'; any other handle is stderr."""
+        self.queue = queue
+        self.stdout = stdout
+        self.sink = sink
+        self.chunks = {'stdout': ChunkBuffer(), 'stderr': ChunkBuffer()}
+        self.status = {'stdout': None, 'stderr': None}  # (status, data)
+        self.segments = deque()  # (stream, length) of the 'both' reads
+        self.last = 'stdout'    # The stream that was read last.
+
+    def read(self, stream, size, get, timeout=None):
+        """Return the next output of `stream' as a (stream, status, data)
+        item. This is up to `size' characters of data, or, once all of it
+        is read, 'eof' or 'error' with an error number for as long as it is
+        read. For 'both' that is when both streams have ended, and the
+        status of stdout is returned. `get(timeout)' is called to wait for
+        the next queued item; it raises Empty after `timeout' seconds."""
+        if stream == 'both':
+            # The data of the stream that was read last is older than that
+            # of the other, because the drain stops at the other stream.
+            if self.last == 'stdout':
+                names = ('stdout', 'stderr')
+            else:
+                names = ('stderr', 'stdout')
+        else:
+            names = (stream,)
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while True:
+            for name in names:
+                buf = self.chunks[name]
+                if len(buf):
+                    self._drain(buf, size, name, stream == 'both')
+                    data = buf.read(size)
+                    if stream == 'both':
+                        self.mark(name, len(data))
+                    self.last = name
+                    return (name, 'data', data)
+            if None not in [self.status[name] for name in names]:
+                if stream == 'both':
+                    stream = 'stdout'
+                return (stream,) + self.status[stream]
+            if timeout is not None:
+                timeout = max(0, end_time - time.time())
+            self._feed(get(timeout))
+
+    def mark(self, stream, length):
+        """Record that `length' characters of `stream' were added to the
+        output of 'both'."""
+        if length:
+            self.segments.append((stream, length))
+
+    def origins(self, length):
+        """Return (stream, length) tuples for the last `length' characters
+        that were added to the output of 'both', oldest first. This forgets
+        all that was recorded."""
+        result = []
+        segments = self.segments
+        while length > 0 and segments:
+            stream, n = segments.pop()
+            n = min(n, length)
+            result.append((stream, n))
+            length -= n
+        segments.clear()
+        result.reverse()
+        return result
+
+    def trim(self, length):
+        """Forget what was recorded of the output of 'both', except for the
+        last `length' characters."""
+        segments = self.segments
+        total = sum([n for stream, n in segments])
+        while segments and total - segments[0][1] >= length:
+            total -= segments.popleft()[1]
+
+    def _feed(self, item):
+        """INTERNAL: Add a queued item to the streams. This returns the
+        name of the stream."""
+        handle, status, data = item
+        if handle == self.stdout:
+            name = 'stdout'
+        else:
+            name = 'stderr'
+        if status != 'data':
+            self.status[name] = (status, data)
+        elif name == 'stderr' and self.sink is not None:
+            self.sink(data)
+        else:
+            self.chunks[name].add(data)
+        return name
+
+    def _drain(self, buf, size, name, ordered):
+        """INTERNAL: Move what is queued to the streams, until `buf', the
+        buffer of stream `name', holds `size' characters. If `ordered' is
+        set this also stops after an item of the other stream. This does
+        not block."""
+        while len(buf) < size:
+            try:
+                item = self.queue.get(False)
+            except Empty:
+                return
+            if self._feed(item) != name and ordered:
+                return
+
+
+class select_transport(object):
+    """A transport for file descriptors, such as the ends of os.pipe(). It
+    uses poll() where there is one and select() elsewhere. wakeup() writes
+    to a pipe of its own."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}         # key -> fd, for remove()
+        self._changes = []      # (operation, fd, key, size) for wait()
+        self._sources = {}      # fd -> (key, size), owned by wait()
+        self._paused = set()    # fds, owned by wait()
+        self._signalled = False
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+            self._poll.register(self._wakeup_r, select.POLLIN)
+        else:
+            self._poll = None
+
+    def add(self, key, source, size):
+        self._lock.acquire()
+        try:
+            self._keys[key] = source
+            self._changes.append(('add', source, key, size))
+        finally:
+            self._lock.release()
+        self.wakeup()
+
+    def remove(self, key):
+        self._change('remove', key)
+
+    def pause(self, key):
+        self._change('pause', key)
+
+    def resume(self, key):
+        self._change('resume', key)
+
+    def _change(self, operation, key):
+        """INTERNAL: Queue a change for `key' for the next wait()."""
+        self._lock.acquire()
+        try:
+            if operation == 'remove':
+                fd = self._keys.pop(key, None)
+            else:
+                fd = self._keys.get(key)
+            if fd is None:
+                return
+            self._changes.append((operation, fd, key, 0))
+        finally:
+            self._lock.release()
+        self.wakeup()
+
+    def wakeup(self):
+        self._lock.acquire()
+        try:
+            if self._signalled:
+                return
+            self._signalled = True
+        finally:
+            self._lock.release()
+        os.write(self._wakeup_w, 'x'.encode('ascii'))
+
+    def wait(self):
+        self._apply_changes()
+        try:
+            if self._poll is not None:
+                ready = [fd for fd, event in self._poll.poll()]
+            else:
+                fds = [fd for fd in self._sources if fd not in self._paused]
+                fds.append(self._wakeup_r)
+                ready = select.select(fds, [], [])[0]
+        except (select.error, OSError), e:
+            # A source that was closed before its removal was applied.
+            if e.args[0] in (errno.EINTR, errno.EBADF):
+                return []
+            raise
+        if self._wakeup_r in ready:
+            os.read(self._wakeup_r, 512)
+            self._lock.acquire()
+            self._signalled = False
+            self._lock.release()
+            # Changes made before _signalled was reset did not write to the
+            # wakeup pipe. Apply them now, before anything is read.
+            self._apply_changes()
+        results = []
+        for fd in ready:
+            if fd not in self._sources or fd in self._paused:
+                continue
+            key, size = self._sources[fd]
+            try:
+                data = os.read(fd, size)
+            except OSError, e:
+                results.append((key, 'error', e.errno))
+                self._drop(fd, key)
+                continue
+            if data:
+                results.append((key, 'data', data))
+            else:
+                results.append((key, 'eof', data))
+                self._drop(fd, key)
+        return results
+
+    def _apply_changes(self):
+        """INTERNAL: Apply the changes that were made since the last
+        wait()."""
+        self._lock.acquire()
+        try:
+            changes = self._changes
+            self._changes = []
+        finally:
+            self._lock.release()
+        for operation, fd, key, size in changes:
+            if operation == 'add':
+                self._sources[fd] = (key, size)
+                self._paused.discard(fd)
+                self._register(fd)
+            elif fd not in self._sources or self._sources[fd][0] is not key:
+                continue
+            elif operation == 'remove':
+                self._drop(fd, key)
+            elif operation == 'pause' and fd not in self._paused:
+                self._paused.add(fd)
+                if self._poll is not None:
+                    self._poll.unregister(fd)
+            elif operation == 'resume' and fd in self._paused:
+                self._paused.discard(fd)
+                self._register(fd)
+
+    def _register(self, fd):
+        """INTERNAL: Start polling `fd'."""
+        if self._poll is not None:
+            self._poll.register(fd, select.POLLIN)
+
+    def _drop(self, fd, key):
+        """INTERNAL: Stop reading from `fd'."""
+        del self._sources[fd]
+        if fd in self._paused:
+            self._paused.discard(fd)
+        elif self._poll is not None:
+            self._poll.unregister(fd)
+        self._lock.acquire()
+        try:
+            if self._keys.get(key) == fd:
+                del self._keys[key]
+        finally:
+            self._lock.release()
+
+    def close(self):
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+
+class iocp_transport(object):
+    """A transport for Windows handles that were opened for overlapped I/O.
+    There is a read in progress on every handle, and all reads complete on
+    one I/O completion port. The reads are started by the reactor thread,
+    because on older versions of Windows I/O is cancelled when the thread
+    that started it exits."""
+
+    def __init__(self):
+        self._port = CreateIoCompletionPort(INVALID_HANDLE_VALUE, None, 0, 0)
+        self._lock = threading.Lock()
+        self._active = set()    # The keys that were not removed.
+        self._added = []        # (key, handle, size, new) to start reading.
+        self._reads = {}        # key -> (handle, size, overlapped, buffer)
+        self._paused = set()
+        self._idle = {}         # key -> (handle, size), paused between reads
+        self._results = []      # Reads that failed to start.
+
+    def add(self, key, source, size):
+        self._lock.acquire()
+        try:
+            self._active.add(key)
+            self._added.append((key, source, size, True))
+        finally:
+            self._lock.release()
+        self.wakeup()
+
+    def remove(self, key):
+        # The read in progress completes when the handle is closed. Its
+        # buffer must stay alive until then.
+        self._lock.acquire()
+        try:
+            self._active.discard(key)
+            self._paused.discard(key)
+            self._idle.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def pause(self, key):
+        # The read in progress completes, but the next one is not started.
+        self._lock.acquire()
+        try:
+            if key in self._active:
+                self._paused.add(key)
+        finally:
+            self._lock.release()
+
+    def resume(self, key):
+        self._lock.acquire()
+        try:
+            self._paused.discard(key)
+            if key not in self._idle:
+                return
+            handle, size = self._idle.pop(key)
+            self._added.append((key, handle, size, False))
+        finally:
+            self._lock.release()
+        self.wakeup()
+
+    def wakeup(self):
+        PostQueuedCompletionStatus(self._port, 0, 0, None)
+
+    def wait(self):
+        self._lock.acquire()
+        try:
+            added = self._added
+            self._added = []
+        finally:
+            self._lock.release()
+        for key, handle, size, new in added:
+            if new:
+                CreateIoCompletionPort(handle, self._port, 0, 0)
+            self._start_read(key, handle, size)
+        if self._results:
+            results = self._results
+            self._results = []
+            return results
+        rc, nbytes, ckey, overlapped = \
+                GetQueuedCompletionStatus(self._port, INFINITE)
+        if overlapped is None:
+            return []  # wakeup()
+        key = overlapped.object
+        handle, size, overlapped, buf = self._reads.pop(key)
+        self._lock.acquire()
+        try:
+            active = key in self._active
+            if rc != 0:
+                self._active.discard(key)
+        finally:
+            self._lock.release()
+        if not active:
+            return []
+        if rc == 0:
+            data = bytes(buf[:nbytes])
+            self._lock.acquire()
+            try:
+                paused = key in self._paused
+                if paused:
+                    self._idle[key] = (handle, size)
+            finally:
+                self._lock.release()
+            if not paused:
+                self._start_read(key, handle, size)
+            if not data:
+                return []
+            return [(key, 'data', data)]
+        if rc in (ERROR_BROKEN_PIPE, ERROR_HANDLE_EOF):
+            return [(key, 'eof', _empty)]
+        return [(key, 'error', rc)]
+
+    def _start_read(self, key, handle, size):
+        """INTERNAL: Start an overlapped read on `handle'."""
+        overlapped = pywintypes.OVERLAPPED()
+        overlapped.object = key
+        buf = AllocateReadBuffer(size)
+        try:
+            ReadFile(handle, buf, overlapped)
+        except pywintypes.error, e:
+            self._lock.acquire()
+            try:
+                self._active.discard(key)
+            finally:
+                self._lock.release()
+            if e.winerror in (ERROR_BROKEN_PIPE, ERROR_HANDLE_EOF):
+                self._results.append((key, 'eof', _empty))
+            else:
+                self._results.append((key, 'error', e.winerror))
+            return
+        self._reads[key] = (handle, size, overlapped, buf)
+
+    def close(self):
+        self._port.Close()
+
+
+if pywintypes is not None:
+    default_transport = iocp_transport
+else:
+    default_transport = select_transport
+
+
+class reactor(object):
+    """Reads from many pipes with a fixed number of threads.
+
+    Every source that is registered is read from by one of the threads, the
+    one with the fewest sources, and every chunk that is read is passed to a
+    callback in that thread. The threads are daemon threads."""
+
+    def __init__(self, threads=1, transport=None):
+        """Constructor. `transport' is the transport class, by default
+        iocp_transport on Windows and select_transport elsewhere."""
+        if transport is None:
+            transport = default_transport
+        self._lock = threading.Lock()
+        self._callbacks = {}    # key -> (callback, worker)
+        self._paused = {}       # key -> pause() calls minus resume() calls
+        self._workers = [_worker(self, transport()) for i in range(threads)]
+        self.closed = False
+        for worker in self._workers:
+            worker.thread.start()
+
+    def __len__(self):
+        return len(self._callbacks)
+
+    @property
+    def threads(self):
+        return len(self._workers)
+
+    def register(self, source, callback, size=4096):
+        """Start reading from `source', a file descriptor or a handle,
+        depending on the transport. `callback(status, data)' is called for
+        every chunk of at most `size' bytes with status 'data', and finally
+        once with 'eof' or with 'error' and an error number. The callback is
+        called from a reactor thread; it should be quick and not block. If
+        it returns a true value the source is paused, as with pause(). This
+        returns a key for unregister(), pause() and resume()."""
+        if self.closed:
+            raise ValueError('The reactor is closed.')
+        key = object()
+        self._lock.acquire()
+        try:
+            worker = min(self._workers, key=lambda w: w.sources)
+            worker.sources += 1
+            self._callbacks[key] = (callback, worker)
+        finally:
+            self._lock.release()
+        worker.transport.add(key, source, size)
+        return key
+
+    def unregister(self, key):
+        """Stop reading for `key'. The source is not closed. The callback is
+        not called anymore, unless it was being called already."""
+        entry = self._forget(key)
+        if entry is not None:
+            entry[1].transport.remove(key)
+
+    def pause(self, key):
+        """Stop reading for `key' until resume() is called, so that the pipe
+        fills up and the writer blocks. Calls to pause() and resume() are
+        counted, so they may come in any order."""
+        self._adjust(key, 1)
+
+    def resume(self, key):
+        """Undo one pause()."""
+        self._adjust(key, -1)
+
+    def _adjust(self, key, n):
+        """INTERNAL: Pause or resume `key'."""
+        self._lock.acquire()
+        try:
+            entry = self._callbacks.get(key)
+            if entry is None:
+                return
+            count = self._paused.get(key, 0)
+            self._paused[key] = count + n
+            if count <= 0 < count + n:
+                entry[1].transport.pause(key)
+            elif count + n <= 0 < count:
+                entry[1].transport.resume(key)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Stop the reactor threads."""
+        self.closed = True
+        for worker in self._workers:
+            worker.transport.wakeup()
+        for worker in self._workers:
+            worker.thread.join()
+            worker.transport.close()
+
+    def _forget(self, key):
+        """INTERNAL: Remove the callback for `key' and return its entry."""
+        self._lock.acquire()
+        try:
+            entry = self._callbacks.pop(key, None)
+            self._paused.pop(key, None)
+            if entry is not None:
+                entry[1].sources -= 1
+            return entry
+        finally:
+            self._lock.release()
+
+    def _run(self, transport):
+        """INTERNAL: The reactor thread."""
+        while not self.closed:
+            for key, status, data in transport.wait():
+                if status == 'data':
+                    entry = self._callbacks.get(key)
+                else:
+                    entry = self._forget(key)
+                if entry is None:
+                    continue
+                try:
+                    if entry[0](status, data):
+                        self.pause(key)
+                except Exception:
+                    # One bad callback should not stop the other sources.
+                    traceback.print_exc()
+                    self.unregister(key)
+
+
+class _worker(object):
+    """INTERNAL: A reactor thread and its transport."""
+
+    def __init__(self, reactor, transport):
+        self.transport = transport
+        self.sources = 0
+        self.thread = threading.Thread(target=reactor._run, args=(transport,))
+        self.thread.setDaemon(True)
+
+
+_default_reactor = None
+_default_lock = threading.Lock()
+
+def default_reactor():
+    """Return the reactor that is shared by all winspawn instances that are
+    created with reactor=True. It is created on first use, with one
+    thread."""
+    global _default_reactor
+    _default_lock.acquire()
+    try:
+        if _default_reactor is None:
+            _default_reactor = reactor()
+        return _default_reactor
+    finally:
+        _default_lock.release()
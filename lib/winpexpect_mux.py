@@ -0,0 +1,292 @@
+#
+# This file is part of WinPexpect. WinPexpect is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# WinPexpect is copyright (c) 2008-2010 by the WinPexpect authors. See the
+# file "AUTHORS" for a complete overview.
+
+"""One channel for all the streams of a child.
+
+By default winspawn creates four named pipes for every child: one for the
+stub to report back on, and the stdin, stdout and stderr of the child. Each
+is a kernel object with a security descriptor and a handshake, and the
+output pipes are read by a thread each. With a multiplexed transport there
+is one duplex pipe. The stub stays next to the child as a relay, and the
+stdin, stdout and stderr of the child and a control stream travel over the
+pipe in small packets that are tagged with their stream::
+
+    child = winspawn('cmd.exe', multiplex=True)
+
+A packet is the stream id, flags, and the size of the data, followed by the
+data. A packet with the EOF flag ends its stream. The control stream
+carries frames of winpexpect_broker. Nothing here depends on Windows: a
+channel works over any read and write functions, which is how it is
+tested.
+"""
+
+import struct
+import threading
+
+from winpexpect_broker import encode_frame, decode_frames
+
+
+STDIN = 0
+STDOUT = 1
+STDERR = 2
+CONTROL = 3
+
+FLAG_EOF = 1
+
+MAX_PACKET = 16384
+
+_packet_header = struct.Struct('>BBH')
+_empty = ''.encode('ascii')
+
+
+def encode_packets(stream, data, maxpacket=MAX_PACKET):
+    """Encode `data' for `stream' as packets of at most `maxpacket' bytes
+    of data each."""
+    if maxpacket > 0xffff:
+        raise ValueError, 'Packets are at most 65535 bytes.'
+    if len(data) <= maxpacket:
+        return _packet_header.pack(stream, 0, len(data)) + data
+    parts = []
+    for pos in range(0, len(data), maxpacket):
+        chunk = data[pos:pos+maxpacket]
+        parts.append(_packet_header.pack(stream, 0, len(chunk)))
+        parts.append(chunk)
+    return _empty.join(parts)
+
+
+def encode_eof(stream):
+    """Encode the packet that ends `stream'."""
+    return _packet_header.pack(stream, FLAG_EOF, 0)
+
+
+class demuxer(object):
+    """Reads packets from a channel and splits them into their streams."""
+
+    def __init__(self, read, bufsize=65536):
+        """Constructor. `read(size)' returns at most `size' bytes from the
+        channel, or an empty string at the end."""
+        self.read = read
+        self.bufsize = bufsize
+        self.buffer = _empty
+        self.offset = 0
+        self.packets = 0
+
+    def next_packets(self):
+        """Return the packets that are available, reading from the channel
+        if none are. The result is a list of (stream, status, data) tuples
+        with status 'data' or 'eof'. The data of consecutive packets of the
+        same stream is joined. An empty list means that the channel ended;
+        a channel that ends inside a packet raises ValueError."""
+        while True:
+            items = self._parse()
+            if items:
+                return items
+            data = self.read(self.bufsize)
+            if not data:
+                if self.offset < len(self.buffer):
+                    raise ValueError, 'Truncated packet'
+                return []
+            if self.offset < len(self.buffer):
+                self.buffer = self.buffer[self.offset:] + data
+            else:
+                self.buffer = data
+            self.offset = 0
+
+    def _parse(self):
+        """INTERNAL: parse the complete packets in the buffer."""
+        items = []
+        parts = []  # The data of the last item, if it is 'data'.
+        buf = self.buffer
+        pos = self.offset
+        end = len(buf)
+        hsize = _packet_header.size
+        while end - pos >= hsize:
+            stream, flags, size = _packet_header.unpack_from(buf, pos)
+            if size > end - pos - hsize:
+                break
+            pos += hsize
+            self.packets += 1
+            if flags & FLAG_EOF:
+                status = 'eof'
+            else:
+                status = 'data'
+            if status == 'data' and parts and items[-1][0] == stream:
+                parts.append(buf[pos:pos+size])
+            else:
+                self._join_last(items, parts)
+                items.append((stream, status, _empty))
+                parts = []
+                if status == 'data':
+                    parts.append(buf[pos:pos+size])
+            pos += size
+        self._join_last(items, parts)
+        self.offset = pos
+        return items
+
+    def _join_last(self, items, parts):
+        """INTERNAL: set the data of the last item to the joined `parts'."""
+        if parts:
+            items[-1] = (items[-1][0], 'data', _empty.join(parts))
+
+
+class mux_channel(object):
+    """One end of a multiplexed channel."""
+
+    def __init__(self, read, write, bufsize=65536, maxpacket=MAX_PACKET):
+        """Constructor. `read(size)' and `write(s)' read and write the
+        channel. Writes may come from several threads; each write() call
+        gets whole packets."""
+        self.demuxer = demuxer(read, bufsize)
+        self.write = write
+        self.maxpacket = maxpacket
+        self.control = _empty
+        self._lock = threading.Lock()
+
+    def send(self, stream, data):
+        """Send `data' on `stream'. Return the number of bytes sent."""
+        packets = encode_packets(stream, data, self.maxpacket)
+        self._lock.acquire()
+        try:
+            self.write(packets)
+        finally:
+            self._lock.release()
+        return len(data)
+
+    def send_eof(self, stream):
+        """End `stream'."""
+        self._lock.acquire()
+        try:
+            self.write(encode_eof(stream))
+        finally:
+            self._lock.release()
+
+    def send_control(self, fields):
+        """Send a control message with `fields', a sequence of (key, value)
+        tuples."""
+        self.send(CONTROL, encode_frame(fields))
+
+    def receive(self):
+        """Return the next packets; see demuxer.next_packets()."""
+        return self.demuxer.next_packets()
+
+    def control_messages(self, data):
+        """Add `data' of the control stream and return the control messages
+        that are complete."""
+        self.control += data
+        messages, used = decode_frames(self.control)
+        self.control = self.control[used:]
+        return messages
+
+    def receive_control(self):
+        """Wait for a control message. Return it, or None if the channel
+        ended first, and the packets of other streams that came before it,
+        as a list."""
+        others = []
+        while True:
+            items = self.receive()
+            if not items:
+                return None, others
+            for i in range(len(items)):
+                stream, status, data = items[i]
+                if stream != CONTROL:
+                    others.append(items[i])
+                    continue
+                messages = self.control_messages(data)
+                if messages:
+                    others.extend(items[i+1:])
+                    return messages[0], others
+
+    def serve(self, deliver, streams=(STDOUT, STDERR), wait=None):
+        """Read the channel until all `streams' have ended, and call
+        `deliver(stream, status, data)' for their output. If the channel
+        ends first, the streams that did not end get 'eof'; if it breaks, or
+        reading it fails, they get 'error' with a message. If `wait' is given it is called
+        before every read, to hold off reading."""
+        ended = set()
+        while True:
+            if wait is not None:
+                wait()
+            try:
+                items = self.receive()
+            except (ValueError, EnvironmentError), e:
+                for stream in streams:
+                    if stream not in ended:
+                        deliver(stream, 'error', str(e))
+                return
+            if not items:
+                break
+            for stream, status, data in items:
+                if stream not in streams or stream in ended:
+                    continue
+                if status == 'eof':
+                    ended.add(stream)
+                deliver(stream, status, data)
+            if len(ended) == len(streams):
+                return
+        for stream in streams:
+            if stream not in ended:
+                deliver(stream, 'eof', _empty)
+
+
+def relay(channel, write_stdin, close_stdin, outputs, early=(),
+          bufsize=65536):
+    """Relay the streams of a child over `channel', a mux_channel, until
+    the channel ends or a control message with op 'quit' arrives. This is
+    the other end of winspawn(multiplex=True).
+
+    STDIN data is passed to `write_stdin(data)', and `close_stdin()' is
+    called when STDIN ends. `outputs' maps STDOUT and STDERR to read(size)
+    functions of the output of the child; these are read by a thread each
+    until they return an empty string. `early' are packets that were read
+    before, as returned by receive_control()."""
+    for stream, read in outputs.items():
+        pump = threading.Thread(target=_pump, args=(channel, stream, read,
+                                                    bufsize))
+        pump.setDaemon(True)
+        pump.start()
+    state = {'stdin': True}
+    def handle(items):
+        for stream, status, data in items:
+            if stream == CONTROL:
+                for message in channel.control_messages(data):
+                    if message.get('op') == 'quit':
+                        return False
+            elif stream == STDIN and state['stdin']:
+                if status == 'data':
+                    try:
+                        write_stdin(data)
+                    except EnvironmentError:
+                        # The child closed its stdin; drop the rest.
+                        state['stdin'] = False
+                else:
+                    state['stdin'] = False
+                    close_stdin()
+        return True
+    try:
+        items = list(early)
+        while handle(items):
+            items = channel.receive()
+            if not items:
+                break
+    finally:
+        if state['stdin']:
+            close_stdin()
+
+
+def _pump(channel, stream, read, bufsize):
+    """INTERNAL: send the output of a child on `stream' until it ends."""
+    try:
+        while True:
+            data = read(bufsize)
+            if not data:
+                break
+            channel.send(stream, data)
+        channel.send_eof(stream)
+    except EnvironmentError:
+        # The channel is gone.
+        pass
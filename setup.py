@@ -14,6 +14,12 @@ if sys.version_info[0] == 3:
     from lib2to3.fixes import fix_types
     fix_types._TYPE_MAPPING['StringTypes'] = '(str,)'
 
+# The asyncio support uses syntax that Python 2 cannot compile.
+py_modules = ['pexpect', 'pexpect_replay', 'winpexpect', 'winpexpect_io',
+              'winpexpect_broker', 'winpexpect_mux']
+if sys.version_info >= (3, 5):
+    py_modules.append('pexpect_async')
+
 setup(
     name = 'winpexpect',
     version = '1.5',
@@ -28,7 +34,7 @@ setup(
         'Programming Language :: Python',
         'Operating System :: Microsoft :: Windows'],
     package_dir = {'': 'lib'},
-    py_modules = ['pexpect', 'winpexpect'],
+    py_modules = py_modules,
     test_suite = 'nose.collector',
     install_requires = ['pywin32 >= 214'],
     zip_safe = False,